@@ -1,21 +1,33 @@
 """
 Sets up CPHI-DRAGEN-anno analysis directories and downloads HPO terms from Phenotips.
+Phenotips metadata is fetched in-process (get_HPO_pedigree_genome_clinic.PhenotipsClient) and each family is
+set up as soon as its pedigree and HPO files are available.
 """
 
 from __future__ import annotations
 
 import argparse
 import datetime as _dt
-import glob
+import json
 import logging
-import pandas as pd 
+import os
 import shutil
 import subprocess
 import sys
-from dataclasses import dataclass
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 from pathlib import Path
 from typing import Optional
 
+from family_journal import FamilyJournal, fingerprint, write_sample_row
+from artefact_registry import ArtefactRegistry
+from file_index import DirectoryIndex
+from pedigree_check import pedigree_problems
+from sample_sheet import read_sheet, sample_id_column
+from slurm_array import submit_array
+from vcf_header import VCFHeaderError, read_vcf_samples
 
 logger = logging.getLogger("DRAGEN_setup")
 
@@ -27,7 +39,18 @@ HPO_DIR = BASE / "HPO"
 PED_DIR = BASE / "pedigrees"
 ANALYSES_BASE = BASE / "analyses" 
 PCHSEQ_DIR = Path("/hpf/projects/PCHSeq/")
+FILES_FROM_IRODS = BASE / "files_from_irods"
 PROJECT_DICT = {"sickkidsseq": "SickKidsSeq", "genoderm": "SkinGene"}
+ANALYSIS_COLUMNS = ("Family_ID", "Family_ID_PCHseq", "Sequence_ID", "Sample_type", "LIMS")  # plus TG_ID or Decoder_ID
+
+# Input directories are listed once per run (and cached across runs) instead of globbed per sample
+FILE_INDEX = DirectoryIndex()
+# Latest HPO/pedigree file per family, registered by get_HPO_pedigree_genome_clinic.py
+ARTEFACTS = ArtefactRegistry(dirs={"hpo": HPO_DIR, "pedigree": PED_DIR})
+
+# batch metrics file -> {sample: per-sample metrics file}, so each batch file is split at most once per run
+_split_batches: dict[Path, dict[str, Path]] = {}
+_split_lock = threading.Lock()
 
 
 @dataclass(frozen=True)
@@ -39,10 +62,19 @@ class AnalysisRow:
     family_pchseq: str
     lims: str
 
+
+@dataclass
+class FamilySetupResult:
+    family: str
+    samples: int
+    seconds: float
+    family_dir: Optional[Path] = None
+    error: Optional[str] = None
+
 def _configure_logging(level: str) -> None:
     logging.basicConfig(
         level=getattr(logging, level.upper(), logging.INFO),
-        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+        format="%(asctime)s [%(levelname)s] %(name)s (%(threadName)s): %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
@@ -78,15 +110,19 @@ def ensure_dir(p: Path) -> None:
 def parse_analysis_tsv(path: Path) -> list[AnalysisRow]:
     logger.info("Parsing analysis TSV: %s", path)
     rows: list[AnalysisRow] = []
-    analysis_df = pd.read_csv(path, sep="\t")
-    for index, row in analysis_df.iterrows():
-        family = row["Family_ID"]
-        family_pchseq = row["Family_ID_PCHseq"]
-        sequence_id = row["Sequence_ID"]
-        project_id = row["TG_ID"]
-        sample_type = row["Sample_type"]
-        lims = row["LIMS"]
-        rows.append(AnalysisRow(family=family, family_pchseq=family_pchseq, sequence_id=sequence_id, project_id=project_id, sample_type=sample_type, lims=lims))
+    sheet = read_sheet(path, required=ANALYSIS_COLUMNS)
+    id_col = sample_id_column(sheet[0]) if sheet else "TG_ID"
+    for row in sheet:
+        rows.append(
+            AnalysisRow(
+                family=row["Family_ID"],
+                family_pchseq=row["Family_ID_PCHseq"],
+                sequence_id=row["Sequence_ID"],
+                project_id=row[id_col],
+                sample_type=row["Sample_type"],
+                lims=row["LIMS"],
+            )
+        )
 
     logger.info("Parsed %d row(s) from %s", len(rows), path.name)
     return rows
@@ -100,26 +136,6 @@ def normalize_family_id(family: str) -> str:
     """
     return family.split(".", 1)[0].replace("_", "").replace("-", "")
 
-def init_existing_family_dirs(analysis_rows: list[AnalysisRow], analysis_dir: Path, today: str) -> None:
-    """
-    Set up analysis directories for families that already exist.
-    """
-    logger.info("Resetting samples.tsv for any pre-existing family dirs under %s", analysis_dir)
-    seen: set[str] = set()
-    reset_count = 0
-    for r in analysis_rows:
-        family_norm = normalize_family_id(r.family)
-        if not family_norm or family_norm in seen:
-            continue
-        seen.add(family_norm)
-        family_dir = analysis_dir / family_norm / f"DRAGEN_{today}"
-        if family_dir.is_dir():
-            samples_tsv = family_dir / "samples.tsv"
-            samples_tsv.write_text("sample\tCRAM\tSTR\tmetrics\n")
-            logger.debug("Reset samples.tsv in existing dir: %s", family_dir)
-            reset_count += 1
-    logger.info("Reset samples.tsv for %d existing family dir(s)", reset_count)
-
 def rewrite_config_yaml(config_path: Path, cphi: bool, DRAGEN_version: str, family: str, hpo: Optional[Path], ped: Optional[Path]) -> None:
     logger.debug("Rewriting config %s (family=%s, hpo=%s, ped=%s)", config_path, family, hpo, ped)
     txt = config_path.read_text()
@@ -144,66 +160,81 @@ def rewrite_jobscript(jobscript_path: Path) -> None:
     jobscript_path.write_text(txt)
 
 def find_hpo(project: str, family: str, family_norm: str) -> Optional[Path]:
-    base = HPO_DIR / project
     if ("DSK" in family_norm) or ("GYM" in family_norm) or ("SKS" in family_norm):
-        matches = sorted(base.glob(f"{family_norm}*"), key=lambda p: p.stat().st_mtime, reverse=True)
-        hit = matches[0] if matches else None
+        hit = ARTEFACTS.latest(project, "hpo", family_norm)
     elif "GD" in family:
-        matches = sorted(base.glob(f"{family}*"), key=lambda p: p.stat().st_mtime, reverse=True)
-        hit = matches[0] if matches else None
+        hit = ARTEFACTS.latest(project, "hpo", family)
     else:
         hit = None
     if hit is None:
-        logger.warning("No HPO file found for family=%s (normalized=%s) under %s", family, family_norm, base)
+        logger.warning("No HPO file found for family=%s (normalized=%s) under %s", family, family_norm, HPO_DIR / project)
     else:
         logger.debug("HPO file for family=%s: %s", family, hit)
     return hit
 
 def find_pedigree(DRAGEN_joint_geno_dir: Path, family_pchseq: str, sequence_id: str, family_dir: Path) -> Optional[Path]:
     ped = DRAGEN_joint_geno_dir / f"{family_pchseq}.ped"
-    if not ped.exists(): # singleton
+    if not FILE_INDEX.exists(ped): # singleton
         logger.warning("Expected pedigree not found, assuming singleton sample")
         ped = None
 
     return ped
 
 def find_pedigree_nonCPHI(project: str, family_norm: str, family: str) -> Optional[Path]:
-    base = PED_DIR / project
-    if ("DSK" in family) or ("GYM" in family) or ("SKS" in family):
-        matches = sorted(base.glob(f"{family}*"), key=lambda p: p.stat().st_mtime, reverse=True)
-        hit = matches[0] if matches else None
-    elif "GD" in family:
-        matches = sorted(base.glob(f"{family}*"), key=lambda p: p.stat().st_mtime, reverse=True)
-        hit = matches[0] if matches else None
+    if ("DSK" in family) or ("GYM" in family) or ("SKS" in family) or ("GD" in family):
+        hit = ARTEFACTS.latest(project, "pedigree", family)
     else:
         hit = None
     if hit is None:
-        logger.warning("No pedigree file found for family=%s (normalized=%s) under %s", family, family_norm, base)
+        logger.warning("No pedigree file found for family=%s (normalized=%s) under %s", family, family_norm, PED_DIR / project)
     else:
         logger.debug("Pedigree file for family=%s: %s", family, hit)
     return hit
 
-def setup_family_once(
+def validate_pedigrees(families: dict[str, list[AnalysisRow]], *, project: str, cphi: bool) -> list[str]:
+    """
+    Check, before any family is set up, that every sample is in its family's pedigree: the joint genotyping
+    .ped (sequence IDs) for CPHI, otherwise the latest Phenotips pedigree (sample IDs) in the artefact registry.
+    CPHI singletons without a .ped and families no pedigree is looked up for are skipped. Returns the problems found (pedigree_check), empty if all pass.
+    """
+    expected: dict[str, set[str]] = {}
+    pedigrees: dict[str, Optional[Path]] = {}
+    for family_norm, family_rows in families.items():
+        first = family_rows[0]
+        if cphi:
+            ped = PCHSEQ_DIR / PROJECT_DICT[project] / f"{first.lims}_family" / first.family_pchseq / "output" / f"{first.family_pchseq}.ped"
+            if FILE_INDEX.exists(ped):
+                pedigrees[family_norm] = ped
+            elif len(family_rows) == 1:
+                continue  # setup writes a one-line pedigree for the singleton
+            expected[family_norm] = {_strip_cr(r.sequence_id) for r in family_rows}
+        elif any(tag in first.family for tag in ("DSK", "GYM", "SKS", "GD")):
+            pedigrees[family_norm] = ARTEFACTS.latest(project, "pedigree", first.family)
+            expected[family_norm] = {str(r.project_id) for r in family_rows}
+    problems = pedigree_problems(expected, pedigrees)
+    if not problems:
+        logger.info("Pedigree validation passed for %d family(ies)", len(expected))
+    return problems
+
+
+def find_family_vcfs(
     *,
     family: str,
     project: str,
-    family_norm: str,
     family_pchseq: str,
-    family_dir: Path,
     sequence_id: str,
     lims: str,
     cphi: bool,
-    today: str,
     DRAGEN_version: str,
-) -> None:
+) -> tuple:
     """
-    Ensure family dir exists and has config + units.tsv + samples.tsv, plus cnv/str dirs.
-    Returns (sequence_variant_vcf, SV_vcf, CNV_vcf, repeat_VCF_dir, VNTR_VCF_dir).
+    Locate the family's small variant, SV and CNV VCFs (joint-genotyped if available, otherwise singleton).
+    Returns (sequence_variant_vcf, SV_vcf, CNV_vcf, DRAGEN_joint_geno_dir).
     """
     if cphi:
-        DRAGEN_joint_geno_dir = PCHSEQ_DIR / PROJECT_DICT[project] / f"{lims}_family" / family_pchseq / "output" 
+        DRAGEN_joint_geno_dir = PCHSEQ_DIR / PROJECT_DICT[project] / f"{lims}_family" / family_pchseq / "output"
         DRAGEN_singleton_dir = PCHSEQ_DIR / PROJECT_DICT[project] / f"{lims}" / f"{sequence_id}" / "output"
-        if DRAGEN_joint_geno_dir.exists():
+        if FILE_INDEX.is_dir(DRAGEN_joint_geno_dir):
             sequence_variant_vcf = DRAGEN_joint_geno_dir / f"{family_pchseq}.hard-filtered.vcf.gz"
             SV_vcf = DRAGEN_joint_geno_dir / f"{family_pchseq}.sv.vcf.gz"
             CNV_vcf = DRAGEN_joint_geno_dir / f"{family_pchseq}.cnv.vcf.gz"
@@ -212,24 +243,44 @@ def setup_family_once(
             sequence_variant_vcf = DRAGEN_singleton_dir / f"{sequence_id}.hard-filtered.vcf.gz"
             SV_vcf = DRAGEN_singleton_dir / f"{sequence_id}.sv.vcf.gz"
             CNV_vcf = DRAGEN_singleton_dir / f"{sequence_id}.cnv.vcf.gz"
+        return sequence_variant_vcf, SV_vcf, CNV_vcf, DRAGEN_joint_geno_dir
+
+    if DRAGEN_version == "4.4.6":
+        SV_prefix = "sv"
     else:
-        if DRAGEN_version == "4.4.6":
-            SV_prefix = "sv"
-        else:
-            SV_prefix = "sv.with-inv"
-        try:
-            sequence_variant_vcf = glob.glob(f"/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/files_from_irods/{project}/{lims}/FAM*{family}*hard-filtered.vcf.gz")[0]
-            SV_vcf = glob.glob(f"/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/files_from_irods/{project}/{lims}/FAM*{family}*{SV_prefix}.vcf.gz")[0]
-            CNV_vcf = glob.glob(f"/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/files_from_irods/{project}/{lims}/FAM*{family}*cnv.vcf.gz")[0]
-        except IndexError:
+        SV_prefix = "sv.with-inv"
+    irods_dir = FILES_FROM_IRODS / project / lims
+    for prefix in (f"FAM*{family}", f"{family}"):
+        sequence_variant_vcf = FILE_INDEX.glob(irods_dir, f"{prefix}*hard-filtered.vcf.gz")
+        SV_vcf = FILE_INDEX.glob(irods_dir, f"{prefix}*{SV_prefix}.vcf.gz")
+        CNV_vcf = FILE_INDEX.glob(irods_dir, f"{prefix}*cnv.vcf.gz")
+        if sequence_variant_vcf and SV_vcf and CNV_vcf:
+            return sequence_variant_vcf[0], SV_vcf[0], CNV_vcf[0], None
+        if prefix.startswith("FAM"):
             logger.info("FAM-prefixed VCFs not found, assuming singleton sample")
-            sequence_variant_vcf = glob.glob(f"/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/files_from_irods/{project}/{lims}/{family}*hard-filtered.vcf.gz")[0]
-            SV_vcf = glob.glob(f"/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/files_from_irods/{project}/{lims}/{family}*{SV_prefix}.vcf.gz")[0]
-            CNV_vcf = glob.glob(f"/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/files_from_irods/{project}/{lims}/{family}*cnv.vcf.gz")[0]
+    raise FileNotFoundError(f"Could not find hard-filtered/{SV_prefix}/cnv VCFs for family={family} under {irods_dir}")
 
-    if family_dir.exists():
-        logger.info("Family dir already exists, skipping initial setup: %s", family_dir)
-        return
+
+def setup_family_once(
+    *,
+    family: str,
+    project: str,
+    family_norm: str,
+    family_pchseq: str,
+    family_dir: Path,
+    sequence_id: str,
+    cphi: bool,
+    today: str,
+    DRAGEN_version: str,
+    vcfs: tuple,
+    hpo: Optional[Path],
+    ped: Optional[Path],
+) -> None:
+    """
+    Create the family dir with config + units.tsv + an empty samples.tsv, from the family's resolved VCFs
+    (find_family_vcfs), HPO file and pedigree (None for a singleton pedigree).
+    """
+    sequence_variant_vcf, SV_vcf, CNV_vcf, DRAGEN_joint_geno_dir = vcfs
 
     logger.info("Setting up family dir: %s (family=%s, family_pchseq=%s)", family_dir, family, family_pchseq)
     ensure_dir(family_dir)
@@ -246,12 +297,6 @@ def setup_family_once(
 
     config_path = family_dir / "config.yaml"
     jobscript_path = family_dir / "CPHI_DRAGEN_anno.sh"
-    hpo = find_hpo(project, family, family_norm)
-    if cphi:
-        ped = find_pedigree(DRAGEN_joint_geno_dir, family_pchseq, sequence_id, family_dir)
-    else:
-        ped = find_pedigree_nonCPHI(project, family_norm, family)
-    
     if ped:
         logger.debug("Copying pedigree %s -> %s", ped, family_dir / f"{family_pchseq}.ped")
         shutil.copy2(ped, family_dir / f"{family_pchseq}.ped")
@@ -294,6 +339,85 @@ def submit_cphi_dragen_anno_slurm(family_dir: Path) -> None:
     _run(["sbatch", str(script)], cwd=family_dir)
 
 
+def split_batch_metrics(batch_metrics: Path) -> dict[str, Path]:
+    """
+    Split a per-batch DRAGEN metrics TSV ({lims}.metrics.tsv) into {sample}.metrics.tsv files next to it, in one
+    streaming pass (header plus each sample's lines, copied verbatim). Existing per-sample files are left alone.
+    Returns sample -> per-sample metrics file for every sample in the batch.
+    """
+    with _split_lock:
+        if batch_metrics in _split_batches:
+            return _split_batches[batch_metrics]
+        out_dir = batch_metrics.parent
+        outputs: dict[str, Path] = {}
+        handles: dict[str, tuple] = {}
+        try:
+            with batch_metrics.open(newline="") as f:
+                header = f.readline()
+                columns = header.rstrip("\r\n").split("\t")
+                if "#sample" not in columns:
+                    raise ValueError(f"No #sample column in batch metrics file {batch_metrics}")
+                sample_col = columns.index("#sample")
+                for line in f:
+                    fields = line.rstrip("\r\n").split("\t")
+                    if len(fields) <= sample_col:
+                        continue
+                    sample = fields[sample_col]
+                    if sample not in outputs:
+                        outputs[sample] = out_dir / f"{sample}.metrics.tsv"
+                        if FILE_INDEX.exists(outputs[sample]):
+                            continue
+                        tmp = out_dir / f".{sample}.metrics.tsv.{os.getpid()}.tmp"
+                        handles[sample] = (tmp, tmp.open("w", newline=""))
+                        handles[sample][1].write(header)
+                    if sample in handles:
+                        handles[sample][1].write(line)
+            for tmp, h in handles.values():
+                h.close()
+            for sample, (tmp, _) in handles.items():
+                os.replace(tmp, outputs[sample])
+        finally:
+            for tmp, h in handles.values():
+                h.close()
+                if tmp.exists():
+                    tmp.unlink()
+        logger.info("Split batch metrics %s into %d new per-sample file(s)", batch_metrics, len(handles))
+        FILE_INDEX.invalidate(out_dir)
+        _split_batches[batch_metrics] = outputs
+        return outputs
+
+
+def resolve_sample_inputs(*, project: str, sequence_id: str, lims: str, cphi: bool) -> tuple:
+    """
+    Locate a sample's CRAM, STR VCF and metrics without writing anything.
+    Returns (CRAM, STR, metrics, batch_metrics); batch_metrics is the per-batch metrics file metrics still has
+    to be split from, or None if the per-sample metrics file already exists.
+    """
+    if cphi:
+        dragen_results_dir_sample = PCHSEQ_DIR / PROJECT_DICT[project] / lims / f"{sequence_id}" 
+    else:
+        dragen_results_dir_sample = FILES_FROM_IRODS / project / lims
+    if not FILE_INDEX.is_dir(dragen_results_dir_sample):
+        raise FileNotFoundError(f"DRAGEN results dir does not exist: {dragen_results_dir_sample}")
+    if cphi:
+        CRAM = dragen_results_dir_sample / "output" / f"{sequence_id}.cram"
+        STR = dragen_results_dir_sample / "output" / f"{sequence_id}.repeats.vcf.gz"
+    else:
+        CRAM = dragen_results_dir_sample / f"{sequence_id}.cram"
+        STR = dragen_results_dir_sample / f"{sequence_id}.repeats.vcf.gz"
+    metrics = dragen_results_dir_sample / f"{sequence_id}.metrics.tsv"
+    batch_metrics = None
+    if not FILE_INDEX.exists(CRAM):
+        raise FileNotFoundError(f"CRAM file does not exist: {CRAM}")
+    if not FILE_INDEX.exists(STR):
+        raise FileNotFoundError(f"STR file does not exist: {STR}")
+    if not FILE_INDEX.exists(metrics):
+        batch_metrics = dragen_results_dir_sample / f"{lims}.metrics.tsv" # sometimes the metrics file is per-batch
+        if not FILE_INDEX.exists(batch_metrics):
+            raise FileNotFoundError(f"metrics file does not exist: {metrics}")
+    return CRAM, STR, metrics, batch_metrics
+
+
 def add_sample_inputs(
     *,
     family_dir: Path,
@@ -302,37 +426,314 @@ def add_sample_inputs(
     sequence_id: str,
     lims: str,
     cphi: bool,
+    inputs: Optional[tuple] = None,
 ) -> None:
+    CRAM, STR, metrics, batch_metrics = inputs or resolve_sample_inputs(project=project, sequence_id=sequence_id, lims=lims, cphi=cphi)
+    logger.info("Adding sample %s -> %s/samples.tsv", sequence_id, family_dir)
+    if batch_metrics is not None and not FILE_INDEX.exists(metrics):
+        if sequence_id not in split_batch_metrics(batch_metrics):
+            raise FileNotFoundError(f"Sample {sequence_id} not found in batch metrics file {batch_metrics}")
+    write_sample_row(family_dir / "samples.tsv", sequence_id, (CRAM, STR, metrics))
+
+
+def group_rows_by_family(rows: list[AnalysisRow]) -> dict[str, list[AnalysisRow]]:
+    """Group analysis rows by normalized family ID, keeping sheet order within and across families."""
+    families: dict[str, list[AnalysisRow]] = {}
+    for r in rows:
+        families.setdefault(normalize_family_id(r.family), []).append(r)
+    return families
+
+
+def setup_family(
+    family_rows: list[AnalysisRow],
+    *,
+    analysis_dir: Path,
+    project: str,
+    cphi: bool,
+    today: str,
+    DRAGEN_version: str,
+    submit: bool = True,
+    plan: Optional[dict] = None,
+) -> Path:
+    """
+    Set up one family's analysis dir and add each of its samples; submit the Slurm job unless
+    submit is False (array mode). With a plan entry (plan_family), its resolved inputs are used instead
+    of looking them up again. Steps already completed with the same samples and unchanged inputs
+    (family_journal) are skipped. Returns the family dir.
+    """
+    first = family_rows[0]
+    family_norm = normalize_family_id(first.family)
+    family_dir = analysis_dir / family_norm / f"DRAGEN_{today}"
+    sequence_ids = [_strip_cr(r.sequence_id) for r in family_rows]
+
+    try:
+        vcfs = planned_vcfs(plan) if plan else find_family_vcfs(
+            family=first.family,
+            project=project,
+            family_pchseq=first.family_pchseq,
+            sequence_id=sequence_ids[0],
+            lims=first.lims,
+            cphi=cphi,
+            DRAGEN_version=DRAGEN_version,
+        )
+        sample_inputs = {
+            sequence_id: planned_sample_inputs(plan, sequence_id) if plan else resolve_sample_inputs(project=project, sequence_id=sequence_id, lims=r.lims, cphi=cphi)
+            for r, sequence_id in zip(family_rows, sequence_ids)
+        }
+    except Exception:
+        logger.exception("Failed to resolve inputs for family=%s", first.family)
+        raise
+    hpo = find_hpo(project, first.family, family_norm)
     if cphi:
-        dragen_results_dir_sample = PCHSEQ_DIR / PROJECT_DICT[project] / lims / f"{sequence_id}" 
+        ped = find_pedigree(vcfs[3], first.family_pchseq, sequence_ids[0], family_dir)
     else:
-        dragen_results_dir_sample = Path(f"/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/files_from_irods/{project}/{lims}/")
-    if not Path(dragen_results_dir_sample).exists():
-        raise FileNotFoundError(f"DRAGEN results dir does not exist: {dragen_results_dir_sample}")
-    logger.info("Adding sample %s -> %s/samples.tsv", sequence_id, family_dir)
-    with (family_dir / "samples.tsv").open("a") as out:
-        if cphi:
-            CRAM = dragen_results_dir_sample / "output" / f"{sequence_id}.cram"
-            STR = dragen_results_dir_sample / "output" / f"{sequence_id}.repeats.vcf.gz"
-        else:
-            CRAM = dragen_results_dir_sample / f"{sequence_id}.cram"
-            STR = dragen_results_dir_sample / f"{sequence_id}.repeats.vcf.gz"
-        metrics = dragen_results_dir_sample / f"{sequence_id}.metrics.tsv"
-        if not Path(CRAM).exists():
-            raise FileNotFoundError(f"CRAM file does not exist: {CRAM}")
-        if not Path(STR).exists():
-            raise FileNotFoundError(f"STR file does not exist: {STR}")
-        if not Path(metrics).exists():
-            try:
-                metrics = glob.glob(f"{dragen_results_dir_sample}/{lims}.metrics.tsv")[0] # sometimes the metrics file is per-batch
-                metrics = pd.read_csv(metrics, sep="\t")
-                metrics = metrics[metrics["#sample"] == sequence_id]
-                metrics.to_csv(f"{dragen_results_dir_sample}/{sequence_id}.metrics.tsv", sep="\t", index=False)
-                metrics = dragen_results_dir_sample / f"{sequence_id}.metrics.tsv"
-            except IndexError:
-                raise FileNotFoundError(f"metrics file does not exist: {metrics}")
-        out.write(f"{sequence_id}\t{CRAM}\t{STR}\t{metrics}\n")
+        ped = find_pedigree_nonCPHI(project, family_norm, first.family)
+    # CRAM, STR and per-sample metrics (not the batch file: it is only needed until the split has happened)
+    input_paths = [*vcfs[:3], hpo, ped, *(p for inputs in sample_inputs.values() for p in inputs[:3])]
 
+    journal = FamilyJournal(family_dir)
+    steps = ["configured", *(f"sample:{sequence_id}" for sequence_id in sequence_ids)] + (["submitted"] if submit else [])
+    if journal.begin(sequence_ids, fingerprint(input_paths)) and all(journal.done(step) for step in steps):
+        logger.info("Family %s is unchanged since its last setup, skipping", family_norm)
+        return family_dir
+
+    for r, sequence_id in zip(family_rows, sequence_ids):
+        family = r.family
+        family_pchseq = r.family_pchseq
+
+        logger.info("Processing family=%s (norm=%s, pchseq=%s, sample=%s)", family, family_norm, family_pchseq, sequence_id)
+
+        try:
+            if not journal.done("configured"):
+                setup_family_once(
+                    family=family,
+                    project=project,
+                    family_norm=family_norm,
+                    family_pchseq=family_pchseq,
+                    family_dir=family_dir,
+                    sequence_id=sequence_id,
+                    cphi=cphi,
+                    today=today,
+                    DRAGEN_version=DRAGEN_version,
+                    vcfs=vcfs,
+                    hpo=hpo,
+                    ped=ped,
+                )
+                journal.mark("configured")
+
+            if not journal.done(f"sample:{sequence_id}"):
+                add_sample_inputs(
+                    lims=r.lims,
+                    family_dir=family_dir,
+                    family_pchseq=family_pchseq,
+                    project=project,
+                    sequence_id=sequence_id,
+                    cphi=cphi,
+                    inputs=sample_inputs[sequence_id],
+                )
+                # a batch metrics split creates this sample's metrics file
+                journal.mark(f"sample:{sequence_id}", fingerprint(input_paths))
+
+            if submit and r is family_rows[-1] and not journal.done("submitted"):
+                submit_cphi_dragen_anno_slurm(family_dir)
+                journal.mark("submitted")
+        except Exception:
+            logger.exception("Failed to set up family=%s (sample=%s)", family, sequence_id)
+            raise
+    return family_dir
+
+
+def _check_file(path: Optional[Path], problems: list[str], what: str) -> Optional[dict]:
+    """{"path", "size"} for an existing non-empty file; otherwise record a problem"""
+    if path is None:
+        return None
+    try:
+        size = os.stat(path).st_size
+    except OSError:
+        problems.append(f"{what} does not exist: {path}")
+        return {"path": str(path), "size": None}
+    if size == 0:
+        problems.append(f"{what} is empty: {path}")
+    return {"path": str(path), "size": size}
+
+
+def plan_family(
+    family_norm: str,
+    family_rows: list[AnalysisRow],
+    *,
+    analysis_dir: Path,
+    project: str,
+    cphi: bool,
+    today: str,
+    DRAGEN_version: str,
+) -> dict:
+    """
+    Resolve and check (exists, non-empty) everything setup_family would use for one family, without writing.
+    HPO and pedigree files that are not on disk yet are only noted: the run fetches them from Phenotips first.
+    """
+    first = family_rows[0]
+    family_dir = analysis_dir / family_norm / f"DRAGEN_{today}"
+    problems: list[str] = []
+    entry = {
+        "status": "ok",
+        "problems": problems,
+        "family_dir": str(family_dir),
+        "family_dir_exists": family_dir.exists(),
+        "rows": [asdict(r) for r in family_rows],
+        "vcfs": None,
+        "hpo": None,
+        "pedigree": None,
+        "samples": {},
+    }
+
+    joint_geno_dir = None
+    try:
+        small, sv, cnv, joint_geno_dir = find_family_vcfs(
+            family=first.family,
+            project=project,
+            family_pchseq=first.family_pchseq,
+            sequence_id=_strip_cr(first.sequence_id),
+            lims=first.lims,
+            cphi=cphi,
+            DRAGEN_version=DRAGEN_version,
+        )
+        entry["vcfs"] = {
+            "small_variant": _check_file(small, problems, "Small variant VCF"),
+            "sv": _check_file(sv, problems, "SV VCF"),
+            "cnv": _check_file(cnv, problems, "CNV VCF"),
+            "joint_geno_dir": str(joint_geno_dir) if joint_geno_dir else None,
+        }
+        if entry["vcfs"]["small_variant"]["size"]:
+            # every sheet sample must be in the VCF's own header
+            samples = read_vcf_samples(small)
+            entry["vcfs"]["samples"] = samples
+            missing = [seq for seq in (_strip_cr(r.sequence_id) for r in family_rows) if seq not in samples]
+            if missing:
+                problems.append(f"Small variant VCF {small} has no sample(s) {', '.join(missing)} (samples: {', '.join(samples)})")
+    except (FileNotFoundError, KeyError, VCFHeaderError) as e:
+        problems.append(str(e))
+
+    hpo = find_hpo(project, first.family, family_norm)
+    entry["hpo"] = _check_file(hpo, problems, "HPO file") if hpo else None
+    if cphi:
+        ped = find_pedigree(joint_geno_dir, first.family_pchseq, first.sequence_id, family_dir) if joint_geno_dir else None
+    else:
+        ped = find_pedigree_nonCPHI(project, family_norm, first.family)
+    entry["pedigree"] = _check_file(ped, problems, "Pedigree") if ped else None
+
+    for r in family_rows:
+        sequence_id = _strip_cr(r.sequence_id)
+        try:
+            CRAM, STR, metrics, batch_metrics = resolve_sample_inputs(project=project, sequence_id=sequence_id, lims=r.lims, cphi=cphi)
+        except (FileNotFoundError, KeyError) as e:
+            problems.append(str(e))
+            continue
+        entry["samples"][sequence_id] = {
+            "cram": _check_file(CRAM, problems, "CRAM"),
+            "str": _check_file(STR, problems, "STR VCF"),
+            # still to be split from the batch file when batch_metrics is set
+            "metrics": {"path": str(metrics), "size": None} if batch_metrics else _check_file(metrics, problems, "Metrics"),
+            "batch_metrics": _check_file(batch_metrics, problems, "Batch metrics") if batch_metrics else None,
+        }
+
+    if problems:
+        entry["status"] = "error"
+    return entry
+
+
+def planned_vcfs(plan: dict) -> tuple:
+    v = plan["vcfs"]
+    joint_geno_dir = v["joint_geno_dir"]
+    return (
+        Path(v["small_variant"]["path"]),
+        Path(v["sv"]["path"]),
+        Path(v["cnv"]["path"]),
+        Path(joint_geno_dir) if joint_geno_dir else None,
+    )
+
+
+def planned_sample_inputs(plan: dict, sequence_id: str) -> tuple:
+    p = plan["samples"][sequence_id]
+    return (
+        Path(p["cram"]["path"]),
+        Path(p["str"]["path"]),
+        Path(p["metrics"]["path"]),
+        Path(p["batch_metrics"]["path"]) if p["batch_metrics"] else None,
+    )
+
+
+_plan_lock = threading.Lock()
+
+
+def write_plan(plan: dict, path: Path) -> None:
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(plan, indent=2) + "\n")
+    os.replace(tmp, path)
+
+
+def mark_plan_done(plan: dict, path: Path, family_norm: str) -> None:
+    """Record a family as set up in the plan manifest, so re-running the plan skips it"""
+    with _plan_lock:
+        plan["families"][family_norm]["status"] = "done"
+        plan["families"][family_norm]["completed"] = _dt.datetime.now().isoformat(timespec="seconds")
+        write_plan(plan, path)
+
+
+def make_plan(
+    families: dict[str, list[AnalysisRow]],
+    *,
+    analyses: Path,
+    analysis_dir: Path,
+    project: str,
+    cphi: bool,
+    today: str,
+    DRAGEN_version: str,
+    workers: int,
+) -> dict:
+    """Plan every family concurrently; returns the JSON-serializable manifest"""
+    problems: list[str] = []
+    for src in [
+        PIPELINE_ROOT / "CPHI-DRAGEN-anno" / "config" / "config.yaml",
+        PIPELINE_ROOT / "CPHI-DRAGEN-anno" / "workflow" / "CPHI_DRAGEN_anno.sh",
+    ]:
+        _check_file(src, problems, "Pipeline file")
+    kwargs = dict(analysis_dir=analysis_dir, project=project, cphi=cphi, today=today, DRAGEN_version=DRAGEN_version)
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="plan") as pool:
+        futures = {f: pool.submit(plan_family, f, rows, **kwargs) for f, rows in families.items()}
+    return {
+        "created": _dt.datetime.now().isoformat(timespec="seconds"),
+        "analyses": str(analyses),
+        "project": project,
+        "cphi": cphi,
+        "today": today,
+        "DRAGEN_version": DRAGEN_version,
+        "problems": problems,
+        "families": {f: fut.result() for f, fut in futures.items()},
+    }
+
+
+def run_family_setup(family_norm: str, family_rows: list[AnalysisRow], **kwargs) -> FamilySetupResult:
+    """
+    Run setup_family for one family, recording (not raising) any failure so other families carry on.
+    """
+    start = time.perf_counter()
+    family_dir = None
+    try:
+        family_dir = setup_family(family_rows, **kwargs)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return FamilySetupResult(
+        family=family_norm, samples=len(family_rows), seconds=time.perf_counter() - start, family_dir=family_dir, error=error
+    )
+
+
+def log_setup_summary(results: list[FamilySetupResult]) -> None:
+    failed = [r for r in results if r.error]
+    logger.info("Family setup summary: %d succeeded, %d failed", len(results) - len(failed), len(failed))
+    for r in sorted(results, key=lambda r: r.family):
+        status = f"FAILED ({r.error})" if r.error else "ok"
+        logger.info("  %-20s %2d sample(s) %8.1fs  %s", r.family, r.samples, r.seconds, status)
 
 
 def main(argv: list[str]) -> int:
@@ -343,6 +744,16 @@ def main(argv: list[str]) -> int:
     ap.add_argument("--DRAGEN_version", default="4.4.6", help="DRAGEN version, e.g. 4.4.6")
     ap.add_argument("--creds", default=DEFAULT_CREDS, help="Phenotips credentials CSV (default: PT_credentials.csv)")
     ap.add_argument("--today", default=None, help="Override date stamp (YYYY-MM-DD). Default: today.")
+    ap.add_argument("--phenotips-workers", type=int, default=1, help="Number of probands to fetch from Phenotips concurrently (default: 1).")
+    ap.add_argument("--phenotips-rate", type=float, default=0.0, help="Target Phenotips request rate in requests/second (default: 0, unlimited).")
+    ap.add_argument("--hpo-cohort-export", action="store_true", help="Also append HPO gene tables to the project's cohort Parquet dataset (needs pyarrow).")
+    ap.add_argument("--setup-workers", type=int, default=1, help="Number of families to set up concurrently (default: 1).")
+    ap.add_argument("--slurm-array", action="store_true", help="Submit all successfully set up families as one Slurm job array instead of one sbatch per family.")
+    ap.add_argument("--array-max-running", type=int, default=None, help="With --slurm-array, maximum number of families running at once (sbatch --array %%N).")
+    ap.add_argument("--validate-pedigrees", action="store_true", help="Fetch all Phenotips metadata first and check every sample is in its family's pedigree before setting up any family.")
+    ap.add_argument("--plan", type=Path, default=None, help="Dry run: resolve and check every family's inputs without writing anything, and write a JSON manifest to this path.")
+    ap.add_argument("--from-plan", type=Path, default=None, help="Set up the families in a --plan manifest (skipping families with problems or already done); resumable.")
+    ap.add_argument("--plan-workers", type=int, default=16, help="Concurrent input checks with --plan (default: 16).")
     ap.add_argument(
         "--log-level",
         default="INFO",
@@ -353,90 +764,142 @@ def main(argv: list[str]) -> int:
 
     _configure_logging(args.log_level)
 
-    logger.info("Starting DRAGEN_setup (project=%s, analyses=%s)", args.project, args.analyses)
-
-    if not args.analyses.is_file():
-        logger.error("Sample file does not exist: %s", args.analyses)
-        raise SystemExit(f"Error: sample file does not exist: {args.analyses}")
+    plan = None
+    if args.from_plan:
+        plan = json.loads(args.from_plan.read_text())
+        args.project, args.DRAGEN_version, args.today = plan["project"], plan["DRAGEN_version"], plan["today"]
+        cphi = plan["cphi"]
+        logger.info("Executing plan %s (project=%s, created %s)", args.from_plan, args.project, plan["created"])
+    else:
+        logger.info("Starting DRAGEN_setup (project=%s, analyses=%s)", args.project, args.analyses)
+        if args.analyses is None or not args.analyses.is_file():
+            logger.error("Sample file does not exist: %s", args.analyses)
+            raise SystemExit(f"Error: sample file does not exist: {args.analyses}")
+        cphi = args.cphi.lower() == "true"
 
     today = args.today or _dt.date.today().isoformat()
     logger.info("Using date stamp: %s", today)
+    logger.info("Using CPHI: %s", cphi)
 
     analysis_dir = ANALYSES_BASE / args.project
-    ensure_dir(analysis_dir)
     logger.info("Analysis base dir: %s", analysis_dir)
 
-    cphi = args.cphi.lower() == "true"
-    logger.info("Using CPHI: %s", cphi)
-
-    rows = parse_analysis_tsv(args.analyses)
-
-    logger.info("Downloading HPO terms and pedigrees from Phenotips")
-    _run(
-        [
-            "python3",
-            "get_HPO_pedigree_genome_clinic.py",
-            "-sample_sheet",
-            str(args.analyses),
-            "-credentials",
-            args.creds,
-            "-project",
-            args.project,
-            "-rename",
-            "False",
-        ]
-    )
-
-    init_existing_family_dirs(rows, analysis_dir, today)
-
-    last_row_index_by_family: dict[str, int] = {}
-    for idx, r in enumerate(rows):
-        last_row_index_by_family[normalize_family_id(r.family)] = idx
-
-    logger.info("Processing %d analysis row(s)", len(rows))
-    for idx, r in enumerate(rows):
-        family = r.family
-        sequence_id = _strip_cr(r.sequence_id)
-
-        family_norm = normalize_family_id(family)
-        family_pchseq = r.family_pchseq
-        family_dir = analysis_dir / family_norm / f"DRAGEN_{today}"
+    if plan is not None:
+        rows = []
+        for family_norm, entry in plan["families"].items():
+            if entry["status"] == "done":
+                logger.info("Skipping family %s: already set up (%s)", family_norm, entry.get("completed"))
+            elif entry["status"] != "ok":
+                logger.error("Skipping family %s: plan has problems: %s", family_norm, "; ".join(entry["problems"]))
+            else:
+                rows.extend(AnalysisRow(**r) for r in entry["rows"])
+    else:
+        try:
+            rows = parse_analysis_tsv(args.analyses)
+        except ValueError as e:
+            raise SystemExit(f"Error: {e}") from e
+
+    families = group_rows_by_family(rows)
+
+    if args.plan:
+        FILE_INDEX.write_cache = False
+        ARTEFACTS.read_only = True # HPO/pedigree lookups re-scan into an in-memory copy of the registry
+        new_plan = make_plan(
+            families,
+            analyses=args.analyses,
+            analysis_dir=analysis_dir,
+            project=args.project,
+            cphi=cphi,
+            today=today,
+            DRAGEN_version=args.DRAGEN_version,
+            workers=args.plan_workers,
+        )
+        write_plan(new_plan, args.plan)
+        bad = {f: e for f, e in new_plan["families"].items() if e["status"] != "ok"}
+        for problem in new_plan["problems"]:
+            logger.error("%s", problem)
+        for family_norm, entry in bad.items():
+            for problem in entry["problems"]:
+                logger.error("%s: %s", family_norm, problem)
+        logger.info("Wrote plan for %d family(ies) (%d with problems) to %s", len(families), len(bad), args.plan)
+        return 1 if bad or new_plan["problems"] else 0
 
-        logger.info("Processing family=%s (norm=%s, pchseq=%s, sample=%s)", family, family_norm, family_pchseq, sequence_id)
+    ensure_dir(analysis_dir)
 
-        try:
-            setup_family_once(
-                family=family,
-                lims=r.lims,
-                project=args.project,
-                family_norm=family_norm,
-                family_pchseq=family_pchseq,
-                family_dir=family_dir,
-                sequence_id=sequence_id,
-                cphi=cphi,
-                today=today,
-                DRAGEN_version=args.DRAGEN_version,
-            )
+    family_by_sample = {str(r.project_id): family_norm for family_norm, family_rows in families.items() for r in family_rows}
+    logger.info("Processing %d analysis row(s) in %d family(ies)", len(rows), len(families))
 
-            add_sample_inputs(
-                lims=r.lims,
-                family_dir=family_dir,
-                family_pchseq=family_pchseq,
-                project=args.project,
-                sequence_id=sequence_id,
-                cphi=cphi,
-            )
+    # Families are queued for setup as soon as their Phenotips metadata has been written (with
+    # --validate-pedigrees, once all of it is written and every pedigree has passed); a failing
+    # family is recorded in the summary and does not stop the others. Imported here so --help and --plan
+    # never pay for the fetcher's pandas/requests imports.
+    from get_HPO_pedigree_genome_clinic import CohortHPOExport, PhenotipsClient, select_probands
 
-            if idx == last_row_index_by_family[family_norm]:
-                submit_cphi_dragen_anno_slurm(family_dir)
-        except Exception:
-            logger.exception("Failed to set up family=%s (sample=%s)", family, sequence_id)
-            raise
+    logger.info("Downloading HPO terms and pedigrees from Phenotips")
+    client = PhenotipsClient.from_credentials(
+        args.creds,
+        rate=args.phenotips_rate,
+        cohort_export=CohortHPOExport() if args.hpo_cohort_export else None,
+    )
+    probands = select_probands([str(r.project_id) for r in rows], args.project)
+    setup_kwargs = dict(
+        analysis_dir=analysis_dir, project=args.project, cphi=cphi, today=today, DRAGEN_version=args.DRAGEN_version, submit=not args.slurm_array
+    )
+    futures = {}
+
+    def record_done(future) -> None:
+        result = future.result()
+        if not result.error:
+            mark_plan_done(plan, args.from_plan, result.family)
+
+    def submit(pool: ThreadPoolExecutor, family_norm: str) -> None:
+        entry = plan["families"][family_norm] if plan else None
+        future = pool.submit(run_family_setup, family_norm, families[family_norm], plan=entry, **setup_kwargs)
+        if plan:
+            future.add_done_callback(record_done)
+        futures[family_norm] = future
+
+    fetched = client.fetch_families(probands, args.project, rename=False, workers=args.phenotips_workers)
+    if args.validate_pedigrees:
+        for _ in fetched:
+            pass
+        fetched = iter(())
+        problems = validate_pedigrees(families, project=args.project, cphi=cphi)
+        for problem in problems:
+            logger.error("Pedigree validation: %s", problem)
+        if problems:
+            raise SystemExit(f"Pedigree validation failed for {len(problems)} family(ies); nothing was set up")
+
+    with ThreadPoolExecutor(max_workers=max(1, args.setup_workers), thread_name_prefix="setup") as pool:
+        for result in fetched:
+            family_norm = family_by_sample.get(result.sample_id)
+            if family_norm is None or family_norm in futures:
+                continue
+            submit(pool, family_norm)
+        for family_norm in families:
+            if family_norm not in futures:
+                submit(pool, family_norm)
+    results = [f.result() for f in futures.values()]
+    log_setup_summary(results)
+
+    if args.slurm_array:
+        to_submit = [r.family_dir for r in results if not r.error and not FamilyJournal(r.family_dir).done("submitted")]
+        submit_array(
+            to_submit,
+            "CPHI_DRAGEN_anno.sh",
+            work_dir=analysis_dir,
+            job_name=f"DRAGEN_{today}",
+            max_running=args.array_max_running,
+        )
+        for family_dir in to_submit:
+            FamilyJournal(family_dir).mark("submitted")
 
+    if any(r.error for r in results):
+        logger.error("DRAGEN_setup finished with %d failed family(ies)", sum(1 for r in results if r.error))
+        return 1
     logger.info("DRAGEN_setup complete")
     return 0
 
 
 if __name__ == "__main__":
     raise SystemExit(main(sys.argv[1:]))
-
@@ -2,9 +2,9 @@
 """
 Python rewrite of PacBio_setup.sh
 
-Sets up crg2-pacbio analysis directories, downloads HPO terms and pedigrees from Phenotips,
-copies per-sample inputs, rewrites sample IDs in VCFs using bcftools, and validates that
-samples in the analysis TSV are present in the Phenotips pedigree.
+Downloads HPO terms and pedigrees from Phenotips (in-process), validates that samples in the analysis TSV
+are present in the Phenotips pedigree and the family's joint VCFs, then sets up crg2-pacbio analysis directories, copies per-sample
+inputs and rewrites sample IDs in VCFs (bgzf_reheader, or bcftools).
 """
 
 from __future__ import annotations
@@ -12,17 +12,27 @@ from __future__ import annotations
 import argparse
 import csv
 import datetime as _dt
-import glob
 import logging
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Iterable, Optional, Union
 
+from artefact_registry import ArtefactRegistry
+from bgzf_reheader import BGZFError, reheader_samples
+from family_journal import FamilyJournal, fingerprint, write_sample_row
+from file_index import DirectoryIndex
+from file_staging import MODES as STAGING_MODES, stage_file
+from pedigree_check import pedigree_problems
+from slurm_array import submit_array
+from vcf_header import VCFHeaderError, read_vcf_samples
+from vcf_staging import StagingCache
 
 REPO_ROOT_DEFAULT_CRG2_PACBIO = Path.home() / "crg2-pacbio"
 DEFAULT_CREDS = "PT_credentials.csv"
@@ -35,6 +45,13 @@ ANALYSES_BASE = BASE / "analyses"
 
 LOG = logging.getLogger("PacBio_setup")
 
+# files_from_irods directories are listed once per run (and cached across runs) instead of globbed per sample
+FILE_INDEX = DirectoryIndex()
+# sample-renamed joint VCFs are staged here; the files_from_irods originals are never modified
+STAGING = StagingCache()
+# latest HPO/pedigree file per family, registered by get_HPO_pedigree_genome_clinic.py
+ARTEFACTS = ArtefactRegistry(dirs={"hpo": HPO_DIR, "pedigree": PED_DIR})
+
 
 @dataclass(frozen=True)
 class AnalysisRow:
@@ -75,46 +92,18 @@ def _which_or_die(exe: str) -> None:
     LOG.debug("Found executable on PATH: %s", exe)
 
 
-def _latest_matching(glob_pat: str) -> Optional[Path]:
-    matches = [Path(p) for p in glob.glob(glob_pat)]
-    if not matches:
-        return None
-    matches.sort(key=lambda p: p.stat().st_mtime, reverse=True)
-    return matches[0]
-
-
 _PathLikeOrGlob = Union[Path, str]
 
 
-def _is_glob_pattern(s: str) -> bool:
-    # Minimal glob metachar check (* ? [..])
-    return any(ch in s for ch in ("*", "?", "["))
-
-
 def _glob_latest(paths_or_globs: Iterable[_PathLikeOrGlob]) -> Optional[Path]:
     """
     Return the most-recently-modified match among:
       - literal paths that exist
       - glob patterns (e.g. "/path/to/*.vcf.gz")
 
-    This fixes the bash->python mismatch where wildcard strings were previously treated
-    as literal paths and dropped by `.exists()`.
+    Answered from FILE_INDEX's directory listings, so each candidate directory is listed once per run.
     """
-    expanded: list[Path] = []
-    for item in paths_or_globs:
-        s = str(item)
-        if _is_glob_pattern(s):
-            expanded.extend(Path(p) for p in glob.glob(s))
-        else:
-            p = Path(s)
-            if p.exists():
-                expanded.append(p)
-
-    expanded = [p for p in expanded if p.exists()]
-    if not expanded:
-        return None
-    expanded.sort(key=lambda p: p.stat().st_mtime, reverse=True)
-    return expanded[0]
+    return FILE_INDEX.latest(paths_or_globs)
 
 
 def _strip_cr(s: str) -> str:
@@ -167,22 +156,23 @@ def ensure_dir(p: Path) -> None:
     p.mkdir(parents=True, exist_ok=True)
 
 
-def copy_with_sidecars(src_vcfgz: Path, dest_dir: Path) -> Path:
+def stage_with_sidecars(src_vcfgz: Path, dest_dir: Path, mode: str = "auto") -> Path:
     """
-    Copy src_vcfgz plus any sidecar files matching src_vcfgz* into dest_dir.
-    Returns destination .vcf.gz path.
+    Stage src_vcfgz plus any sidecar files matching src_vcfgz* into dest_dir (file_staging: reflink,
+    hardlink, symlink or copy). Returns destination .vcf.gz path. The staged files may be the shared
+    source itself, so they must only be replaced, never modified in place.
     """
     ensure_dir(dest_dir)
-    copied_vcfgz: Optional[Path] = None
+    staged_vcfgz: Optional[Path] = None
     for f in sorted(src_vcfgz.parent.glob(src_vcfgz.name + "*")):
         if f.is_file():
             dest = dest_dir / f.name
-            shutil.copy2(f, dest)
+            stage_file(f, dest, mode)
             if dest.name.endswith(".vcf.gz"):
-                copied_vcfgz = dest
-    if copied_vcfgz is None:
-        raise FileNotFoundError(f"Did not copy a .vcf.gz for {src_vcfgz}")
-    return copied_vcfgz
+                staged_vcfgz = dest
+    if staged_vcfgz is None:
+        raise FileNotFoundError(f"Did not stage a .vcf.gz for {src_vcfgz}")
+    return staged_vcfgz
 
 
 def rewrite_config_yaml(config_path: Path, *, project_family: str, hpo: Optional[Path], ped: Optional[Path]) -> None:
@@ -248,51 +238,100 @@ def pick_sv(project: str, family: str, sequence_id: str) -> Path:
     return picked
 
 def find_hpo(project: str, family: str, project_family: str) -> Optional[Path]:
-    base = HPO_DIR / project
     if ("DSK" in family) or ("GYM" in family):
-        patt = str(base / f"{project_family}*")
-        matches = sorted(base.glob(f"{project_family}*"), key=lambda p: p.stat().st_mtime, reverse=True)
-        return matches[0] if matches else None
+        return ARTEFACTS.latest(project, "hpo", project_family)
     if "GD" in family:
-        matches = sorted(base.glob(f"{family}*"), key=lambda p: p.stat().st_mtime, reverse=True)
-        return matches[0] if matches else None
+        return ARTEFACTS.latest(project, "hpo", family)
     return None
 
 
 def find_pedigree(project: str, family: str, project_family: str) -> Optional[Path]:
-    base = PED_DIR / project
-    matches = sorted(base.glob(f"{project_family}*"), key=lambda p: p.stat().st_mtime, reverse=True)
-    if matches:
-        return matches[0]
-    matches = sorted(base.glob(f"{family}*"), key=lambda p: p.stat().st_mtime, reverse=True)
-    return matches[0] if matches else None
+    return ARTEFACTS.latest(project, "pedigree", project_family) or ARTEFACTS.latest(project, "pedigree", family)
 
 
-def bcftools_reheader_inplace(vcfgz: Path, mapping_file: Path) -> None:
+def bcftools_reheader(vcfgz: Path, mapping_file: Path, out: Optional[Path] = None) -> None:
     """
     Equivalent to:
-      bcftools reheader -s mapping vcfgz | bcftools view -Oz -o vcfgz.vcf.gz
-      mv vcfgz.vcf.gz vcfgz
+      bcftools reheader -s mapping vcfgz | bcftools view -Oz -o out.vcf.gz
+      mv out.vcf.gz out
     but implemented as a single shell pipeline to avoid Python-level pipe/file-object issues.
+    out defaults to vcfgz itself (in place).
     """
-    out_tmp = vcfgz.with_suffix(vcfgz.suffix + ".vcf.gz")  # ".vcf.gz" appended
+    out = out or vcfgz
+    out_tmp = out.with_suffix(out.suffix + ".vcf.gz")  # ".vcf.gz" appended
     cmd = (
         f"bcftools reheader -s {mapping_file} {vcfgz} "
         f"| bcftools view -Oz -o {out_tmp}"
     )
-    LOG.info("Reheadering VCF (in place): %s", vcfgz)
+    LOG.info("Reheadering VCF: %s -> %s", vcfgz, out)
     LOG.debug("  mapping_file=%s", mapping_file)
     subprocess.run(cmd, shell=True, check=True)
-    out_tmp.replace(vcfgz)
+    out_tmp.replace(out)
+    FILE_INDEX.invalidate(out.parent)
 
 
-def bcftools_query_sample(vcfgz: Path) -> str:
-    cp = _run(["bcftools", "query", "-l", str(vcfgz)])
-    line = (cp.stdout or "").splitlines()
-    if not line:
-        raise RuntimeError(f"bcftools query -l returned no samples for {vcfgz}")
-    LOG.debug("Sample in %s: %s", vcfgz, line[0].strip())
-    return line[0].strip()
+def vcf_sample(vcfgz: Path) -> str:
+    """First sample of vcfgz, from its header (vcf_header, no bcftools process)"""
+    samples = read_vcf_samples(vcfgz)
+    if not samples:
+        raise RuntimeError(f"No samples in VCF header of {vcfgz}")
+    LOG.debug("Sample in %s: %s", vcfgz, samples[0])
+    return samples[0]
+
+
+def joint_vcf_problems(renames: dict[Path, dict[str, str]]) -> list[str]:
+    """
+    Problems with a family's joint VCFs: each must have each sample of its rename mapping (sequence_id ->
+    normalized project_id) under either name. Only headers are read (vcf_header). Empty if all pass.
+    """
+    problems = []
+    for vcf, mapping in renames.items():
+        samples = set(read_vcf_samples(vcf))
+        missing = [seq for seq, project_id in mapping.items() if seq not in samples and project_id not in samples]
+        if missing:
+            problems.append(f"{vcf} has no sample(s) {', '.join(missing)} (samples: {', '.join(sorted(samples))})")
+    return problems
+
+
+def sample_renames(vcfgz: Path, mapping: dict[str, str]) -> dict[str, str]:
+    """The renames of mapping (old -> new) that apply to vcfgz: old names in its header, not already new"""
+    samples = set(read_vcf_samples(vcfgz))
+    return {old: new for old, new in mapping.items() if old != new and old in samples}
+
+
+def rewrite_vcf_samples(vcfgz: Path, renames: dict[str, str], tmp_dir: Path, out: Optional[Path] = None) -> None:
+    """
+    Write vcfgz with samples renamed (old -> new) to out (default: in place). Only the header blocks are
+    rewritten (bgzf_reheader; its .tbi/.csi index is shifted to match), falling back to bcftools for VCFs
+    that are not BGZF-compressed.
+    """
+    LOG.info("Renaming %d sample(s) in %s: %s", len(renames), vcfgz, ", ".join(f"{old}->{new}" for old, new in renames.items()))
+    try:
+        reheader_samples(vcfgz, renames, out)
+    except BGZFError as e:
+        LOG.warning("Cannot rewrite the header of %s directly (%s); using bcftools", vcfgz, e)
+    else:
+        FILE_INDEX.invalidate((out or vcfgz).parent)
+        return
+    with tempfile.NamedTemporaryFile("w", delete=False, dir=str(tmp_dir), prefix="sample_rename_", suffix=".txt") as tf:
+        tf.writelines(f"{old} {new}\n" for old, new in renames.items())
+        mapping_file = Path(tf.name)
+    try:
+        bcftools_reheader(vcfgz, mapping_file, out)
+    finally:
+        mapping_file.unlink()
+
+
+def stage_renamed_vcf(vcfgz: Path, mapping: dict[str, str], tmp_dir: Path) -> Path:
+    """
+    Path of a copy of the shared VCF vcfgz with samples renamed (old -> new), staged in the content-addressed
+    STAGING cache (vcfgz itself if no rename applies). vcfgz is never modified.
+    """
+    renames = sample_renames(vcfgz, mapping)
+    if not renames:
+        LOG.info("Sample names already up to date, using as is: %s", vcfgz)
+        return vcfgz
+    return STAGING.stage(vcfgz, renames, lambda src, dest: rewrite_vcf_samples(src, renames, tmp_dir, dest))
 
 
 def parse_analysis_tsv(path: Path) -> list[AnalysisRow]:
@@ -311,74 +350,77 @@ def parse_analysis_tsv(path: Path) -> list[AnalysisRow]:
     return rows
 
 
-def init_existing_family_dirs(analysis_rows: list[AnalysisRow], analysis_dir: Path, today: str) -> None:
-    """
-    Set up analysis directories for families that already exist.
-    """
-    seen: set[str] = set()
-    for r in analysis_rows:
-        if r.family_is_header:
-            continue
-        project_family = r.project_id_raw.split(".", 1)[0].replace("_", "")
-        if not project_family or project_family in seen:
-            continue
-        seen.add(project_family)
-        family_dir = analysis_dir / project_family / f"PacBio_{today}"
-        if family_dir.is_dir():
-            LOG.info("Resetting existing samples.tsv for: %s", family_dir)
-            samples_tsv = family_dir / "samples.tsv"
-            samples_tsv.write_text("sample\tBAM\tcase_or_control\n")
-
-
 def setup_family_once(
     *,
-    family: str,
-    sequence_id: str,
-    project: str,
-    project_id_norm: str,
     project_family: str,
     family_dir: Path,
     crg2_pacbio: Path,
-    today: str,
-) -> tuple[Path, Path]:
-    """
-    Ensure family dir exists and has config + units.tsv + samples.tsv, plus cnv/trgt dirs.
-    Returns (deepvariant_vcfgz, sv_vcfgz).
-    """
-    deepvariant = pick_deepvariant(project, family, sequence_id)
-    sv = pick_sv(project, family, sequence_id)
-
-    if not family_dir.exists():
-        LOG.info("Creating family analysis directory: %s", family_dir)
-        ensure_dir(family_dir)
-
-        # Copy pipeline files
-        for src in [
-            crg2_pacbio / "config.yaml",
-            crg2_pacbio / "crg2-pacbio.sh",
-            crg2_pacbio / "slurm_profile" / "slurm-config.yaml",
-        ]:
-            if not src.exists():
-                raise FileNotFoundError(f"Missing pipeline file: {src}")
-            shutil.copy2(src, family_dir / src.name)
-
-        config_path = family_dir / "config.yaml"
-        jobscript_path = family_dir / "crg2-pacbio.sh"
-        hpo = find_hpo(project, family, project_family)
-        ped = find_pedigree(project, family, project_family)
-        LOG.info("Writing config.yaml (HPO=%s, PED=%s)", str(hpo) if hpo else "None", str(ped) if ped else "None")
-        rewrite_config_yaml(config_path, project_family=project_family, hpo=hpo, ped=ped)
-        rewrite_jobscript(jobscript_path)
-        # Create samples.tsv / units.tsv
-        (family_dir / "samples.tsv").write_text("sample\tBAM\tcase_or_control\n")
-
-        units_tsv = family_dir / "units.tsv"
-        units_tsv.write_text("family\tplatform\tsmall_variant_vcf\tpbsv_vcf\tcnv_dir\n")
-        with units_tsv.open("a") as out:
-            out.write(f"{project_family}\tPACBIO\t{deepvariant}\t{sv}\tcnv/vcfs\n")
-
-        ensure_dir(family_dir / "cnv")
-    return deepvariant, sv
+    hpo: Optional[Path],
+    ped: Optional[Path],
+) -> None:
+    """
+    Create the family dir with config + an empty samples.tsv, plus the cnv dir, from the family's HPO
+    file and pedigree. units.tsv is written once the joint VCFs are staged (write_units_tsv).
+    """
+    LOG.info("Creating family analysis directory: %s", family_dir)
+    ensure_dir(family_dir)
+
+    # Copy pipeline files
+    for src in [
+        crg2_pacbio / "config.yaml",
+        crg2_pacbio / "crg2-pacbio.sh",
+        crg2_pacbio / "slurm_profile" / "slurm-config.yaml",
+    ]:
+        if not src.exists():
+            raise FileNotFoundError(f"Missing pipeline file: {src}")
+        shutil.copy2(src, family_dir / src.name)
+
+    config_path = family_dir / "config.yaml"
+    jobscript_path = family_dir / "crg2-pacbio.sh"
+    LOG.info("Writing config.yaml (HPO=%s, PED=%s)", str(hpo) if hpo else "None", str(ped) if ped else "None")
+    rewrite_config_yaml(config_path, project_family=project_family, hpo=hpo, ped=ped)
+    rewrite_jobscript(jobscript_path)
+    # Create samples.tsv
+    (family_dir / "samples.tsv").write_text("sample\tBAM\tcase_or_control\n")
+
+    ensure_dir(family_dir / "cnv")
+
+
+def write_units_tsv(family_dir: Path, project_family: str, deepvariant: Path, sv: Path) -> None:
+    units_tsv = family_dir / "units.tsv"
+    units_tsv.write_text("family\tplatform\tsmall_variant_vcf\tpbsv_vcf\tcnv_dir\n")
+    with units_tsv.open("a") as out:
+        out.write(f"{project_family}\tPACBIO\t{deepvariant}\t{sv}\tcnv/vcfs\n")
+
+
+def resolve_sample_inputs(*, project: str, sequence_id: str) -> tuple[Path, list[Path]]:
+    """
+    Locate one sample's inputs in files_from_irods: (haplotagged BAM, hificnv VCF(s)).
+    """
+    irods_dir = FILES_FROM_IRODS / project
+    bam = irods_dir / f"{sequence_id}.GRCh38.haplotagged.bam"
+    if not FILE_INDEX.exists(bam):
+        older = FILE_INDEX.glob(irods_dir, f"{sequence_id}*GRCh38.aligned.haplotagged.bam") # older pipeline runs
+        if not older:
+            raise FileNotFoundError(f"No BAM found for {sequence_id}")
+        bam = older[0]
+
+    cnv_src_exact = irods_dir / f"{sequence_id}.GRCh38.hificnv.vcf.gz"
+    if FILE_INDEX.exists(cnv_src_exact):
+        return bam, [cnv_src_exact]
+    patt = f"hificnv*{sequence_id}*.vcf.gz"
+    matches = FILE_INDEX.glob(irods_dir, patt)
+    if not matches:
+        raise FileNotFoundError(f"No CNV VCFs found for {sequence_id} (pattern {patt})")
+    return bam, matches
+
+
+@dataclass
+class CNVStagingResult:
+    sequence_id: str
+    cnv_vcfs: list[Path]
+    seconds: float
+    error: Optional[BaseException] = None
 
 
 def add_sample_inputs(
@@ -387,106 +429,218 @@ def add_sample_inputs(
     project: str,
     sequence_id: str,
     project_id_norm: str,
-    deepvariant: Path,
-    sv: Path,
-) -> None:
-    # samples.tsv
-    bam = FILES_FROM_IRODS / project / f"{sequence_id}.GRCh38.haplotagged.bam"
-    if not bam.exists():
-        try:
-            bam = glob.glob(f"{FILES_FROM_IRODS}/{project}/{sequence_id}*GRCh38.aligned.haplotagged.bam")[0] # older pipeline runs
-        except IndexError:
-            raise FileNotFoundError(f"No BAM found for {sequence_id}")
+    inputs: Optional[tuple] = None,
+) -> list[Path]:
+    """
+    Add one sample to samples.tsv. Returns its CNV VCF source(s), for stage_sample_cnv.
+    The family's joint VCFs are renamed once for all samples afterwards (stage_renamed_vcf).
+    """
+    bam, cnv_sources = inputs or resolve_sample_inputs(project=project, sequence_id=sequence_id)
     project_sample = project_sample_from_project_id(project_id_norm)
     LOG.info("Adding sample to samples.tsv: %s (bam=%s)", project_sample, bam)
-    with (family_dir / "samples.tsv").open("a") as out:
-        out.write(f"{project_sample}\t{bam}\n")
-
-    # CNV copy
-    cnv_dir = family_dir / "cnv" / "vcfs"
-    ensure_dir(cnv_dir)
-    cnv_src_exact = FILES_FROM_IRODS / project / f"{sequence_id}.GRCh38.hificnv.vcf.gz"
-    if cnv_src_exact.exists():
-        LOG.info("Copying CNV VCF: %s", cnv_src_exact)
-        copy_with_sidecars(cnv_src_exact, cnv_dir)
-    else:
-        patt = f"hificnv*{sequence_id}*.vcf.gz"
-        matches = sorted((FILES_FROM_IRODS / project).glob(patt))
-        if not matches:
-            raise FileNotFoundError(f"No CNV VCFs found for {sequence_id} (pattern {patt})")
-        LOG.info("Copying %d CNV VCF(s) matching %s", len(matches), patt)
-        for m in matches:
-            copy_with_sidecars(m, cnv_dir)
-
-    # Replace sample IDs in VCFs
-    # mapping 1: sequence_id -> normalized project_id (deepvariant/sv)
-    with tempfile.NamedTemporaryFile("w", delete=False, dir=str(family_dir), prefix="sample_rename_", suffix=".txt") as tf:
-        tf.write(f"{sequence_id} {project_id_norm}\n")
-        map_seq_to_proj = Path(tf.name)
-    try:
-        bcftools_reheader_inplace(deepvariant, map_seq_to_proj)
-        bcftools_reheader_inplace(sv, map_seq_to_proj)
-    finally:
-        map_seq_to_proj.unlink()
-
-    # CNV vcfs: map each VCF's existing sample ID -> normalized project_id
-    cnv_vcf = Path(glob.glob(f"{cnv_dir}/*{sequence_id}*.vcf.gz")[0])
-    cnv_sample = bcftools_query_sample(cnv_vcf)
-    with tempfile.NamedTemporaryFile("w", delete=False, dir=str(family_dir), prefix="sample_rename_", suffix=".txt") as tf:
-        tf.write(f"{cnv_sample} {project_id_norm}\n")
-        map_cnv_to_proj = Path(tf.name)
+    write_sample_row(family_dir / "samples.tsv", project_sample, (bam,))
+    return cnv_sources
+
+
+def stage_sample_cnv(
+    *, family_dir: Path, sequence_id: str, project_id_norm: str, cnv_sources: list[Path], staging_mode: str = "auto"
+) -> CNVStagingResult:
+    """
+    Stage one sample's CNV VCF(s) in the family's cnv/vcfs with the sample renamed to project_id_norm,
+    and index them. A VCF that needs renaming is written there from its source (which is only read);
+    one that does not is staged with staging_mode. Runs as an independent task per sample; failures
+    are returned, not raised.
+    """
+    start = time.perf_counter()
+    cnv_vcfs: list[Path] = []
     try:
-        bcftools_reheader_inplace(cnv_vcf, map_cnv_to_proj)
-        LOG.info("Indexing CNV VCF with tabix: %s", cnv_vcf)
-        _run(["tabix", str(cnv_vcf)])
-    finally:
-        map_cnv_to_proj.unlink()
+        cnv_dir = family_dir / "cnv" / "vcfs"
+        ensure_dir(cnv_dir)
+        LOG.info("Staging %d CNV VCF(s) for %s", len(cnv_sources), sequence_id)
+        for src in cnv_sources:
+            cnv_vcf = cnv_dir / src.name
+            indexes = [cnv_vcf.with_name(cnv_vcf.name + suffix) for suffix in (".tbi", ".csi")]
+            # drop indexes of an earlier run (possibly links to the source's) rather than overwriting them
+            for index in indexes:
+                if index.exists():
+                    index.unlink()
+            # map the VCF's existing sample ID -> normalized project_id
+            cnv_sample = vcf_sample(src)
+            if cnv_sample != project_id_norm:
+                rewrite_vcf_samples(src, {cnv_sample: project_id_norm}, family_dir, out=cnv_vcf)
+            else:
+                cnv_vcf = stage_with_sidecars(src, cnv_dir, staging_mode)
+            if not any(index.exists() for index in indexes):
+                LOG.info("Indexing CNV VCF with tabix: %s", cnv_vcf)
+                _run(["tabix", "-f", str(cnv_vcf)])
+            cnv_vcfs.append(cnv_vcf)
+    except Exception as e:
+        LOG.exception("Failed to stage CNV VCF(s) for %s", sequence_id)
+        return CNVStagingResult(sequence_id, cnv_vcfs, time.perf_counter() - start, e)
+    return CNVStagingResult(sequence_id, cnv_vcfs, time.perf_counter() - start)
+
+
+def group_rows_by_family(analysis_rows: list[AnalysisRow]) -> dict[str, list[AnalysisRow]]:
+    """
+    Group analysis rows (header excluded) by crg2-pacbio project family, keeping sheet order.
+    """
+    families: dict[str, list[AnalysisRow]] = {}
+    for r in analysis_rows:
+        if r.family_is_header:
+            continue
+        try:
+            project_id_norm = normalize_project_id(r.family, r.project_id_raw)
+        except ValueError as e:
+            raise SystemExit(str(e)) from e
+        families.setdefault(project_family_from_project_id(project_id_norm), []).append(r)
+    return families
 
 
-def validate_pedigrees(analysis_rows: list[AnalysisRow], analyses_path: Path, project: str) -> None:
-    # project_family list: third column, cut '.' -f1, uniq
-    seen: set[str] = set()
+def family_vcfs(family_rows: list[AnalysisRow], project: str) -> tuple[list[tuple[Path, Path]], dict[Path, dict[str, str]]]:
+    """
+    Each sample's (small variant, SV) joint VCFs, and per VCF the renames (sequence_id -> normalized project_id)
+    of every family member in it, applied to each joint VCF in one pass.
+    """
+    vcfs, renames = [], {}
+    for r in family_rows:
+        sequence_id = _strip_cr(r.sequence_id)
+        pair = (pick_deepvariant(project, r.family, sequence_id), pick_sv(project, r.family, sequence_id))
+        vcfs.append(pair)
+        for vcf in pair:
+            renames.setdefault(vcf, {})[sequence_id] = normalize_project_id(r.family, r.project_id_raw)
+    return vcfs, renames
+
+
+def setup_family(
+    family_rows: list[AnalysisRow],
+    *,
+    analysis_dir: Path,
+    project: str,
+    crg2_pacbio: Path,
+    today: str,
+    cnv_workers: int = 4,
+    staging_mode: str = "auto",
+) -> Path:
+    """
+    Set up one family's analysis dir and add each of its samples. The samples' CNV VCFs are staged
+    concurrently, with at most cnv_workers samples (and so tabix processes) in flight, using
+    staging_mode for files that are not rewritten (file_staging). Steps
+    already completed with the same samples and unchanged inputs (family_journal) are skipped.
+    Returns the family dir.
+    """
+    first = family_rows[0]
+    sequence_ids = [_strip_cr(r.sequence_id) for r in family_rows]
+    project_id_norms = [normalize_project_id(r.family, r.project_id_raw) for r in family_rows]
+    project_family = project_family_from_project_id(project_id_norms[0])
+    family_dir = analysis_dir / project_family / f"PacBio_{today}"
+
+    vcfs, renames = family_vcfs(family_rows, project)
+    sample_inputs = [resolve_sample_inputs(project=project, sequence_id=seq) for seq in sequence_ids]
+    hpo = find_hpo(project, first.family, project_family)
+    ped = find_pedigree(project, first.family, project_family)
+    input_paths = list(dict.fromkeys([*(p for pair in vcfs for p in pair), hpo, ped, *(p for bam, cnvs in sample_inputs for p in (bam, *cnvs))]))
+
+    journal = FamilyJournal(family_dir)
+    steps = ["configured", *(f"sample:{seq}" for seq in sequence_ids), "renamed"]
+    if journal.begin(sequence_ids, fingerprint(input_paths)) and all(journal.done(step) for step in steps):
+        LOG.info("Family %s is unchanged since its last setup, skipping", project_family)
+        return family_dir
+
+    if not journal.done("configured"):
+        setup_family_once(
+            project_family=project_family,
+            family_dir=family_dir,
+            crg2_pacbio=crg2_pacbio,
+            hpo=hpo,
+            ped=ped,
+        )
+        journal.mark("configured")
+
+    cnv_tasks = {}
+    for r, sequence_id, project_id_norm, inputs in zip(family_rows, sequence_ids, project_id_norms, sample_inputs):
+        if journal.done(f"sample:{sequence_id}"):
+            continue
+        LOG.info("Processing family=%s sequence_id=%s project_id=%s sample_type=%s", r.family, sequence_id, _strip_cr(r.project_id_raw), r.sample_type)
+        cnv_sources = add_sample_inputs(
+            family_dir=family_dir,
+            project=project,
+            sequence_id=sequence_id,
+            project_id_norm=project_id_norm,
+            inputs=inputs,
+        )
+        cnv_tasks[sequence_id] = dict(family_dir=family_dir, sequence_id=sequence_id, project_id_norm=project_id_norm, cnv_sources=cnv_sources, staging_mode=staging_mode)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, cnv_workers), thread_name_prefix="cnv") as pool:
+        futures = [pool.submit(stage_sample_cnv, **task) for task in cnv_tasks.values()]
+        for fut in as_completed(futures):
+            result = fut.result()
+            if result.error is not None:
+                failed.append(result)
+                continue
+            LOG.info("Staged %d CNV VCF(s) for %s in %.1fs", len(result.cnv_vcfs), result.sequence_id, result.seconds)
+            journal.mark(f"sample:{result.sequence_id}")
+    if failed:
+        raise RuntimeError(f"CNV staging failed for {project_family}: " + "; ".join(f"{r.sequence_id}: {r.error}" for r in failed))
+
+    if not journal.done("renamed"):
+        staged = {vcf: stage_renamed_vcf(vcf, mapping, family_dir) for vcf, mapping in renames.items()}
+        deepvariant, sv = vcfs[0]
+        write_units_tsv(family_dir, project_family, staged[deepvariant], staged[sv])
+        journal.mark("renamed")
+    return family_dir
+
+
+def pedigree_expectations(analysis_rows: list[AnalysisRow]) -> dict[str, tuple[str, set[str]]]:
+    """
+    project_family -> (pedigree family name, LRWGS sample IDs as written in the renamed pedigree), grouping
+    the analysis rows once.
+    """
+    expected: dict[str, tuple[str, set[str]]] = {}
     for r in analysis_rows:
         if r.family_is_header:
             continue
         project_family = r.project_id_raw.split(".", 1)[0]
-        if project_family in ("Decoder_ID", "TG_ID"):
+        if not project_family or project_family in ("Decoder_ID", "TG_ID"):
             continue
-        if not project_family or project_family in seen:
-            continue
-        seen.add(project_family)
-
         if ("DSK" in project_family) or ("GYM" in project_family):
             ped_family = project_family.replace("_", "")
         else:
             ped_family = project_family
+        _, samples = expected.setdefault(project_family, (ped_family, set()))
+        if r.sample_type == "LRWGS":
+            samples.add(_strip_cr(r.project_id_raw).replace("_", "").replace(".", "_"))
+    return expected
 
-        ped_matches = sorted((PED_DIR / project).glob(f"{ped_family}*"), key=lambda p: p.stat().st_mtime, reverse=True)
-        if not ped_matches:
-            raise FileNotFoundError(f"No pedigree found for {project_family} (looked for {ped_family}*)")
-        ped = ped_matches[0]
-        LOG.info("Validating pedigree: %s", ped)
-
-        ped_samples: set[str] = set()
-        with ped.open() as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                parts = line.split()
-                if len(parts) >= 2:
-                    ped_samples.add(parts[1])
-
-        # Samples in analysis TSV for this family: grep project_family | grep LRWGS | awk '{print $3}' | tr -d '_' | tr '.' '_'
-        for rr in analysis_rows:
-            if rr.family_is_header:
-                continue
-            if (project_family not in rr.project_id_raw) or (rr.sample_type != "LRWGS"):
-                continue
-            sample = _strip_cr(rr.project_id_raw).replace("_", "").replace(".", "_")
-            if sample not in ped_samples:
-                raise SystemExit(f"Sample {sample} not found in pedigree for {project_family}, exiting")
-    LOG.info("Pedigree validation passed.")
+
+def validate_pedigrees(analysis_rows: list[AnalysisRow], project: str) -> list[str]:
+    """
+    Check that every LRWGS sample in the analysis TSV is in its family's latest pedigree (artefact registry,
+    pedigree_check). Returns every problem found, empty if all pass.
+    """
+    expected = pedigree_expectations(analysis_rows)
+    pedigrees = {family: ARTEFACTS.latest(project, "pedigree", ped_family) for family, (ped_family, _) in expected.items()}
+    problems = pedigree_problems({family: samples for family, (_, samples) in expected.items()}, pedigrees)
+    if not problems:
+        LOG.info("Pedigree validation passed for %d family(ies).", len(expected))
+    return problems
+
+
+def validate_joint_vcfs(families: dict[str, list[AnalysisRow]], project: str) -> list[str]:
+    """
+    Check that each family's joint VCFs can be found and hold every sample of the family (joint_vcf_problems).
+    Returns every problem found, empty if all pass.
+    """
+    problems = []
+    for project_family, family_rows in families.items():
+        try:
+            family_problems = joint_vcf_problems(family_vcfs(family_rows, project)[1])
+        except (FileNotFoundError, VCFHeaderError) as e:
+            family_problems = [str(e)]
+        problems.extend(f"{project_family}: {problem}" for problem in family_problems)
+    if not problems:
+        LOG.info("Joint VCF samples match the analysis sheet for %d family(ies).", len(families))
+    return problems
 
 
 def _configure_logging(*, level: str = "INFO", log_file: Optional[Path] = None) -> None:
@@ -502,7 +656,7 @@ def _configure_logging(*, level: str = "INFO", log_file: Optional[Path] = None)
         ensure_dir(log_file.parent)
         handlers.append(logging.FileHandler(str(log_file)))
 
-    fmt = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+    fmt = "%(asctime)s %(levelname)s %(name)s (%(threadName)s): %(message)s"
     logging.basicConfig(level=numeric, format=fmt, handlers=handlers)
 
 
@@ -513,6 +667,18 @@ def main(argv: list[str]) -> int:
     ap.add_argument("--creds", default=DEFAULT_CREDS, help="Phenotips credentials CSV (default: PT_credentials.csv)")
     ap.add_argument("--crg2-pacbio", dest="crg2_pacbio", type=Path, default=REPO_ROOT_DEFAULT_CRG2_PACBIO, help="Path to crg2-pacbio repo (default: ~/crg2-pacbio)")
     ap.add_argument("--today", default=None, help="Override date stamp (YYYY-MM-DD). Default: today.")
+    ap.add_argument("--phenotips-workers", type=int, default=1, help="Number of probands to fetch from Phenotips concurrently (default: 1).")
+    ap.add_argument("--phenotips-rate", type=float, default=0.0, help="Target Phenotips request rate in requests/second (default: 0, unlimited).")
+    ap.add_argument("--hpo-cohort-export", action="store_true", help="Also append HPO gene tables to the project's cohort Parquet dataset (needs pyarrow).")
+    ap.add_argument("--cnv-workers", type=int, default=4, help="Samples of a family whose CNV VCFs are copied, renamed and indexed concurrently (default: 4).")
+    ap.add_argument(
+        "--staging-mode",
+        choices=STAGING_MODES,
+        default="auto",
+        help="How CNV VCFs that need no renaming are staged into family dirs (default: auto, the first of reflink, hardlink, copy that works).",
+    )
+    ap.add_argument("--slurm-array", action="store_true", help="Submit crg2-pacbio.sh for all families as one Slurm job array after setup.")
+    ap.add_argument("--array-max-running", type=int, default=None, help="With --slurm-array, maximum number of families running at once (sbatch --array %%N).")
     ap.add_argument("--log-level", default="INFO", help="Logging level (DEBUG, INFO, WARNING, ERROR). Default: INFO.")
     ap.add_argument("--log-file", type=Path, default=None, help="Optional path to write logs (in addition to stderr).")
     args = ap.parse_args(argv)
@@ -536,63 +702,45 @@ def main(argv: list[str]) -> int:
     rows = parse_analysis_tsv(args.analyses)
     LOG.info("Parsed %d row(s) from analysis TSV", len(rows))
 
-    # Download HPO + pedigrees from Phenotips (mirrors bash)
+    families = group_rows_by_family(rows)
+    # Download HPO + pedigrees from Phenotips in-process, then check every family's pedigree and joint VCFs before
+    # any family is set up, so a sample missing from either stops the run before anything is copied or renamed
+    # (imported here so --help and argument errors never pay for the fetcher's pandas/requests imports)
+    from get_HPO_pedigree_genome_clinic import CohortHPOExport, PhenotipsClient, select_probands
+
     LOG.info("Downloading HPO terms + pedigrees from Phenotips")
-    _run(
-        [
-            "python3",
-            "get_HPO_pedigree_genome_clinic.py",
-            "-sample_sheet",
-            str(args.analyses),
-            "-credentials",
-            args.creds,
-            "-project",
-            args.project,
-            "-rename",
-            "True",
-        ]
+    client = PhenotipsClient.from_credentials(
+        args.creds,
+        rate=args.phenotips_rate,
+        cohort_export=CohortHPOExport() if args.hpo_cohort_export else None,
     )
-
-    # If analysis dir already exists for family, reset samples.tsv
-    init_existing_family_dirs(rows, analysis_dir, today)
-
-    for r in rows:
-        if r.family_is_header:
-            continue
-
-        family = r.family
-        sequence_id = _strip_cr(r.sequence_id)
-        LOG.info("Processing family=%s sequence_id=%s project_id=%s sample_type=%s", family, sequence_id, _strip_cr(r.project_id_raw), r.sample_type)
-
-        try:
-            project_id_norm = normalize_project_id(family, r.project_id_raw)
-        except ValueError as e:
-            raise SystemExit(str(e)) from e
-
-        project_family = project_family_from_project_id(project_id_norm)
-        family_dir = analysis_dir / project_family / f"PacBio_{today}"
-
-        deepvariant, sv = setup_family_once(
-            family=family,
-            sequence_id=sequence_id,
-            project=args.project,
-            project_id_norm=project_id_norm,
-            project_family=project_family,
-            family_dir=family_dir,
-            crg2_pacbio=args.crg2_pacbio,
-            today=today,
+    probands = select_probands([r.project_id_raw for r in rows if not r.family_is_header], args.project)
+    for _ in client.fetch_families(probands, args.project, rename=True, workers=args.phenotips_workers):
+        pass
+
+    problems = validate_pedigrees(rows, args.project) + validate_joint_vcfs(families, args.project)
+    if problems:
+        for problem in problems:
+            LOG.error("Validation: %s", problem)
+        raise SystemExit(f"Validation failed with {len(problems)} problem(s), exiting:\n  " + "\n  ".join(problems))
+
+    family_dirs: dict[str, Path] = {}
+    for project_family, family_rows in families.items():
+        family_dirs[project_family] = setup_family(
+            family_rows, analysis_dir=analysis_dir, project=args.project, crg2_pacbio=args.crg2_pacbio, today=today, cnv_workers=args.cnv_workers, staging_mode=args.staging_mode
         )
 
-        add_sample_inputs(
-            family_dir=family_dir,
-            project=args.project,
-            sequence_id=sequence_id,
-            project_id_norm=project_id_norm,
-            deepvariant=deepvariant,
-            sv=sv,
+    if args.slurm_array:
+        to_submit = [family_dir for family_dir in family_dirs.values() if not FamilyJournal(family_dir).done("submitted")]
+        submit_array(
+            to_submit,
+            "crg2-pacbio.sh",
+            work_dir=analysis_dir,
+            job_name=f"PacBio_{today}",
+            max_running=args.array_max_running,
         )
-
-    validate_pedigrees(rows, args.analyses, args.project)
+        for family_dir in to_submit:
+            FamilyJournal(family_dir).mark("submitted")
     LOG.info("Done.")
     return 0
 
@@ -55,8 +55,8 @@ do
 		[ "$sample_type" = "SRWGS" ] && sed -i "s/wes/wgs/" "${ANALYSIS_DIR_FAM}/config_hpf.yaml"
 		
 		# Set HPO terms and pedigree
-		HPO=$(ls /hpf/largeprojects/tgnode/sandbox/mcouse_analysis/HPO/${project}/${family}* | tail -n 1)
-		pedigree=$(ls /hpf/largeprojects/tgnode/sandbox/mcouse_analysis/pedigrees/${project}/${family}* | tail -n 1)
+		HPO=$(python3 artefact_registry.py latest ${project} hpo ${family})
+		pedigree=$(python3 artefact_registry.py latest ${project} pedigree ${family})
 		if [ ! -f $HPO ]; then
 			echo "Warning: No HPO file found for family ${family}"
 		else
@@ -51,7 +51,7 @@ do
 		fi
 	    # check if all samples in analysis TSV are represented in the pedigree  
 		if [ "$family" != "DecoderID" ]; then
-			ped=`ls /hpf/largeprojects/tgnode/sandbox/mcouse_analysis/pedigrees/${project}/${family}* | tail -n 1`
+			ped=`python3 artefact_registry.py latest ${project} pedigree ${family}`
 			echo $ped
 			# get all samples in the pedigree
 			samples=`awk '{print $2}' $ped`
@@ -95,8 +95,8 @@ do
 		[ "$sample_type" = "SRWGS" ] && sed -i "s/wes/wgs/" "${ANALYSIS_DIR_FAM}/config_hpf.yaml"
 		
 		# Set HPO terms and pedigree
-		HPO=$(ls /hpf/largeprojects/tgnode/sandbox/mcouse_analysis/HPO/${project}/${family}* | tail -n 1)
-		pedigree=$(ls /hpf/largeprojects/tgnode/sandbox/mcouse_analysis/pedigrees/${project}/${family}* | tail -n 1)
+		HPO=$(python3 artefact_registry.py latest ${project} hpo ${family})
+		pedigree=$(python3 artefact_registry.py latest ${project} pedigree ${family})
 		if [ ! -f $HPO ]; then
 			echo "Warning: No HPO file found for family ${family}"
 		else
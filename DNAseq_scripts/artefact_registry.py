@@ -0,0 +1,245 @@
+"""
+SQLite registry of the HPO and pedigree files written by get_HPO_pedigree_genome_clinic.py, so the setup scripts
+find a family's latest file with one indexed query instead of globbing `<family>*` and sorting by mtime.
+
+Each artefact is recorded as (project, kind, family, date, path, sha256). The fetcher registers every file it
+writes. A lookup first re-scans the project's directory (HPO/<project>/ or pedigrees/<project>/) if its mtime has
+changed since the last scan, so files written by other tools or dropped in by hand are found too; only new or
+changed files are registered, and entries whose file is gone are dropped. `rebuild` re-scans all of them. Family
+names are matched exactly, or extended after a separator (GD-001 finds GD-001-03), never by bare prefix (DSK01
+does not find DSK010). A read-only registry works on an in-memory copy and never writes to the SQLite file.
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime as _dt
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+from typing import Iterable, Optional
+
+LOG = logging.getLogger("artefact_registry")
+
+BASE = Path("/hpf/largeprojects/tgnode/sandbox/mcouse_analysis")
+DEFAULT_REGISTRY = BASE / "artefact_registry.sqlite"
+DEFAULT_DIRS = {"hpo": BASE / "HPO", "pedigree": BASE / "pedigrees"}
+KINDS = tuple(DEFAULT_DIRS)
+FAMILY_SEPARATORS = ("-", "_", ".")
+
+_HPO_NAME = re.compile(r"^(?P<family>.+)_HPO_(?P<date>\d{4}-\d{2}-\d{2})\.txt$")
+_PED_NAME = re.compile(r"^(?P<family>.+)_pedigree\.ped$")
+
+
+def parse_artefact_name(kind: str, name: str) -> tuple[str, Optional[str]]:
+    """
+    (family, date or None) from an artefact file name: <family>_HPO_<YYYY-MM-DD>.txt, <family>_pedigree.ped,
+    or for older files, the name up to its first '.'
+    """
+    m = (_HPO_NAME if kind == "hpo" else _PED_NAME).match(name)
+    if m:
+        return m.group("family"), m.groupdict().get("date")
+    return name.split(".", 1)[0], None
+
+
+def file_sha256(path: Path) -> str:
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+class ArtefactRegistry:
+    """
+    (project, kind, family) -> dated artefact files, persisted in SQLite. The connection is opened on first use;
+    with read_only set before then, the registry is copied into memory and the file is never written.
+    Safe to share between threads.
+    """
+
+    def __init__(self, db_path: Path = DEFAULT_REGISTRY, dirs: Optional[dict[str, Path]] = None, read_only: bool = False):
+        self.db_path = db_path
+        self.dirs = dict(dirs or DEFAULT_DIRS)
+        self.read_only = read_only
+        self.lock = threading.RLock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self.read_only:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            return sqlite3.connect(str(self.db_path), timeout=60, check_same_thread=False)
+        db = sqlite3.connect(":memory:", check_same_thread=False)
+        try:
+            disk = sqlite3.connect(f"{self.db_path.resolve().as_uri()}?mode=ro", uri=True, timeout=60)
+            try:
+                disk.backup(db)
+            finally:
+                disk.close()
+        except sqlite3.Error as e:
+            LOG.info("Starting from an empty in-memory artefact registry (cannot read %s: %s)", self.db_path, e)
+        return db
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        with self.lock:
+            if self._db is None:
+                db = self._connect()
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS artefacts ("
+                    "path TEXT PRIMARY KEY, project TEXT NOT NULL, kind TEXT NOT NULL, family TEXT NOT NULL, "
+                    "date TEXT NOT NULL, mtime_ns INTEGER NOT NULL, sha256 TEXT, registered TEXT NOT NULL)"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS artefacts_family ON artefacts (project, kind, family, date)")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS backfills ("
+                    "project TEXT, kind TEXT, done TEXT NOT NULL, dir_mtime_ns INTEGER, PRIMARY KEY (project, kind))"
+                )
+                if "dir_mtime_ns" not in [row[1] for row in db.execute("PRAGMA table_info(backfills)")]:
+                    db.execute("ALTER TABLE backfills ADD COLUMN dir_mtime_ns INTEGER") # registries from before directory re-scans
+                db.commit()
+                self._db = db
+            return self._db
+
+    def register(
+        self,
+        project: str,
+        kind: str,
+        path: Path,
+        *,
+        family: Optional[str] = None,
+        date: Optional[str] = None,
+        sha256: Optional[str] = None,
+    ) -> None:
+        """
+        Record path as a kind ("hpo" or "pedigree") artefact of project. family and date default to those in
+        the file name (parse_artefact_name), else the file's mtime date.
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Unknown artefact kind {kind!r} (use one of {', '.join(KINDS)})")
+        path = Path(path)
+        st = path.stat()
+        name_family, name_date = parse_artefact_name(kind, path.name)
+        date = date or name_date or _dt.date.fromtimestamp(st.st_mtime).isoformat()
+        now = _dt.datetime.now().isoformat(timespec="seconds")
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO artefacts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(path), project, kind, family or name_family, date, st.st_mtime_ns, sha256 or file_sha256(path), now),
+            )
+
+    def _dir_mtime(self, project: str, kind: str) -> Optional[int]:
+        try:
+            return os.stat(self.dirs[kind] / project).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def backfill(self, project: str, kind: str) -> int:
+        """
+        Register the new or changed files in the project's kind directory and drop entries whose file is gone;
+        returns the number registered
+        """
+        directory = self.dirs[kind] / project
+        dir_mtime = self._dir_mtime(project, kind) # before listing, so a file added during the scan triggers another
+        try:
+            entries = sorted(os.scandir(directory), key=lambda e: e.name)
+        except FileNotFoundError:
+            entries = []
+        n = 0
+        with self.lock:
+            known = dict(self.db.execute("SELECT path, mtime_ns FROM artefacts WHERE project = ? AND kind = ?", (project, kind)))
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                path = os.path.abspath(entry.path)
+                if known.pop(path, None) != entry.stat().st_mtime_ns:
+                    self.register(project, kind, Path(path))
+                    n += 1
+            with self.db:
+                self.db.executemany("DELETE FROM artefacts WHERE path = ?", ((path,) for path in known if not os.path.exists(path)))
+                self.db.execute(
+                    "INSERT OR REPLACE INTO backfills VALUES (?, ?, ?, ?)",
+                    (project, kind, _dt.datetime.now().isoformat(timespec="seconds"), dir_mtime),
+                )
+        LOG.info("Registered %d new or changed %s file(s) of %s from %s", n, kind, project, directory)
+        return n
+
+    def rebuild(self, projects: Optional[Iterable[str]] = None) -> int:
+        """
+        Drop the entries of projects (default: every project directory under the HPO and pedigree dirs) and
+        register their files again. Returns the number registered.
+        """
+        n = 0
+        for kind in KINDS:
+            if projects is None:
+                try:
+                    kind_projects = sorted(e.name for e in os.scandir(self.dirs[kind]) if e.is_dir())
+                except FileNotFoundError:
+                    kind_projects = []
+            else:
+                kind_projects = list(projects)
+            for project in kind_projects:
+                with self.lock, self.db:
+                    self.db.execute("DELETE FROM artefacts WHERE project = ? AND kind = ?", (project, kind))
+                n += self.backfill(project, kind)
+        return n
+
+    def latest(self, project: str, kind: str, family: str) -> Optional[Path]:
+        """
+        The family's latest kind artefact (by date, then mtime) whose file still exists: an exact family match,
+        else a family that extends it after a separator ('-', '_', '.'). None if there is none. The project's
+        directory is re-scanned first if it has changed since it was last scanned.
+        """
+        with self.lock:
+            scanned = self.db.execute("SELECT dir_mtime_ns FROM backfills WHERE project = ? AND kind = ?", (project, kind)).fetchone()
+            if scanned is None or scanned[0] != self._dir_mtime(project, kind):
+                self.backfill(project, kind)
+            rows = self.db.execute(
+                "SELECT path, family FROM artefacts WHERE project = ? AND kind = ? AND family >= ? AND family < ? "
+                "ORDER BY date DESC, mtime_ns DESC",
+                (project, kind, family, family + "\uffff"),
+            ).fetchall()
+        for exact in (True, False):
+            for path, row_family in rows:
+                if exact != (row_family == family):
+                    continue
+                if not exact and row_family[len(family)] not in FAMILY_SEPARATORS:
+                    continue
+                if os.path.exists(path):
+                    return Path(path)
+        return None
+
+    def close(self) -> None:
+        with self.lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def main(argv: list[str]) -> int:
+    ap = argparse.ArgumentParser(description="Registry of the HPO and pedigree files written by get_HPO_pedigree_genome_clinic.py.")
+    ap.add_argument("--registry", type=Path, default=DEFAULT_REGISTRY, help="SQLite registry")
+    sub = ap.add_subparsers(dest="command", required=True)
+    rebuild = sub.add_parser("rebuild", help="Re-register every file under the HPO and pedigree directories")
+    rebuild.add_argument("--project", action="append", default=None, help="Only this project (repeatable)")
+    latest = sub.add_parser("latest", help="Print the latest HPO or pedigree file of a family (exit status 1 if none)")
+    latest.add_argument("project")
+    latest.add_argument("kind", choices=KINDS)
+    latest.add_argument("family")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    registry = ArtefactRegistry(args.registry)
+    if args.command == "rebuild":
+        n = registry.rebuild(args.project)
+        LOG.info("Registered %d file(s) in %s", n, args.registry)
+        return 0
+    path = registry.latest(args.project, args.kind, args.family)
+    if path is None:
+        return 1
+    print(path)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Benchmark the Phenotips/HPO metadata fetch (PhenotipsClient.fetch_families: eid lookup, pedigree,
+HPO terms, gene mapping and Ensembl fallback) against the local stand-in in phenotips_stub_server.py.
+
+For each family count, reports requests/sec served by the stand-in, p50/p99 per-family latency, and the
+process's peak RSS. All outputs (pedigrees, HPO files, caches, sync state) go to a temporary directory.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import hpo_index
+from get_HPO_pedigree_genome_clinic import PhenotipsClient, select_probands
+from phenotips_stub_server import PhenotipsStub, synthetic_eid, write_synthetic_hpo_sources
+
+
+def _percentile(values: list, pct: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[k]
+
+
+def run_once(stub: PhenotipsStub, work_dir: Path, n_families: int, *, workers: int, max_per_host: int, rate: float, verbose: bool = False) -> dict:
+    """Fetch n_families synthetic probands with a fresh client; return throughput and latency figures"""
+    run_dir = work_dir / f"run_{n_families}_{time.monotonic_ns()}"
+    for sub in ("HPO/SYN", "pedigrees/SYN", "sync"):
+        (run_dir / sub).mkdir(parents=True)
+    g2p, hgnc = write_synthetic_hpo_sources(work_dir / "download")
+    gene_index = hpo_index.load_index(g2p, hgnc, work_dir / "download" / "hpo_gene_index.pkl")
+
+    client = PhenotipsClient(
+        ("bench", "bench"),
+        max_per_host=max_per_host,
+        rate=rate,
+        full_refresh=True,
+        sync_dir=run_dir / "sync",
+        hpo_dir=run_dir / "HPO",
+        ped_dir=run_dir / "pedigrees",
+        registry_path=run_dir / "artefact_registry.sqlite",
+        gene_index=gene_index,
+        symbol_cache=run_dir / "symbols.sqlite",
+        symbol_dump=hgnc,
+        ensembl_url=stub.ensembl_url,
+        **stub.client_urls(),
+    )
+
+    latencies: list = []
+    fetch_family = client.fetch_family
+
+    def timed_fetch_family(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fetch_family(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    client.fetch_family = timed_fetch_family
+
+    quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with quiet:
+        ids = [synthetic_eid(f, m) for f in range(1, n_families + 1) for m in (1, 2, 3)]
+        probands = select_probands(ids, "DECODER")
+        requests_before = stub.state.requests
+        errors = 0
+        start = time.perf_counter()
+        for result in client.fetch_families(probands, "SYN", rename=False, workers=workers):
+            errors += result.error is not None
+        elapsed = time.perf_counter() - start
+    n_requests = stub.state.requests - requests_before
+    client.resolver.close()
+    return {
+        "families": n_families,
+        "requests": n_requests,
+        "seconds": elapsed,
+        "req_per_s": n_requests / elapsed if elapsed else float("nan"),
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "errors": errors,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main(argv: list[str]) -> int:
+    ap = argparse.ArgumentParser(description="Benchmark the Phenotips metadata fetch against a local stand-in server.")
+    ap.add_argument("--families", type=int, nargs="+", default=[10, 100, 1000], help="Family counts to run (default: 10 100 1000)")
+    ap.add_argument("--workers", type=int, default=8, help="Concurrent probands (default: 8)")
+    ap.add_argument("--max-per-host", type=int, default=4, help="Maximum in-flight requests per host (default: 4)")
+    ap.add_argument("--rate", type=float, default=0.0, help="Target request rate, requests/second (default: 0, unlimited)")
+    ap.add_argument("--latency", type=float, default=0.02, help="Stand-in mean response latency in seconds (default: 0.02)")
+    ap.add_argument("--jitter", type=float, default=0.0, help="Stand-in +/- latency jitter in seconds (default: 0)")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="Fraction of stand-in responses that are 503s (default: 0)")
+    ap.add_argument("--verbose", action="store_true", help="Show the fetcher's progress output")
+    args = ap.parse_args(argv)
+
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="benchmark_fetch_") as tmp, PhenotipsStub(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate
+    ) as stub:
+        for n in args.families:
+            rows.append(run_once(stub, Path(tmp), n, workers=args.workers, max_per_host=args.max_per_host, rate=args.rate, verbose=args.verbose))
+            print(f"Finished {n} families")
+
+    print(f"\nworkers={args.workers} max_per_host={args.max_per_host} rate={args.rate or 'unlimited'} latency={args.latency}s error_rate={args.error_rate}")
+    print(f"{'families':>8} {'requests':>8} {'seconds':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>6} {'peak RSS MB':>11}")
+    for r in rows:
+        print(
+            f"{r['families']:>8} {r['requests']:>8} {r['seconds']:>8.2f} {r['req_per_s']:>8.1f} "
+            f"{r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['errors']:>6} {r['peak_rss_mb']:>11.1f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
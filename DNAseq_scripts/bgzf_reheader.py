@@ -0,0 +1,291 @@
+"""
+Rename VCF samples in a bgzipped VCF without recompressing its records.
+
+`bcftools reheader -s map in.vcf.gz | bcftools view -Oz` inflates and deflates every record just to change
+the #CHROM line. Here only the BGZF blocks holding the header are decompressed: the renamed header (plus
+any records that shared the last header block) is compressed into new blocks, and every following block is
+copied byte for byte (copy_file_range / sendfile where available). A .tbi or .csi index next to the VCF is
+rewritten with its virtual offsets shifted to the new block positions, so it does not need rebuilding.
+Renames follow `bcftools reheader -s`: only sample names on the #CHROM line change.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import logging
+import os
+import shutil
+import struct
+import sys
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Callable, Optional
+
+LOG = logging.getLogger("bgzf_reheader")
+
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+BLOCK_DATA_SIZE = 0xFF00  # uncompressed bytes per block, as htslib writes them
+VCF_FIXED_COLUMNS = 9  # #CHROM .. FORMAT
+
+
+class BGZFError(ValueError):
+    pass
+
+
+def _read_block(f: BinaryIO) -> Optional[tuple[int, bytes]]:
+    """(compressed size, decompressed data) of the BGZF block at f's position; None at end of file"""
+    head = f.read(12)
+    if not head:
+        return None
+    if len(head) < 12 or head[:4] != BGZF_MAGIC:
+        raise BGZFError("not a BGZF file (bgzip it, or use bcftools)")
+    xlen = struct.unpack("<H", head[10:12])[0]
+    extra = f.read(xlen)
+    bsize = None
+    i = 0
+    while i + 4 <= len(extra):
+        si1, si2, slen = extra[i], extra[i + 1], struct.unpack("<H", extra[i + 2 : i + 4])[0]
+        if (si1, si2, slen) == (66, 67, 2):
+            bsize = struct.unpack("<H", extra[i + 4 : i + 6])[0]
+        i += 4 + slen
+    if bsize is None:
+        raise BGZFError("gzip member without a BGZF BC field")
+    rest = f.read(bsize + 1 - 12 - xlen)
+    crc, isize = struct.unpack("<II", rest[-8:])
+    data = zlib.decompress(rest[:-8], -15)
+    if len(data) != isize or zlib.crc32(data) != crc:
+        raise BGZFError("corrupt BGZF block (CRC/size mismatch)")
+    return bsize + 1, data
+
+
+def compress_block(data: bytes, level: int = 6) -> bytes:
+    """One BGZF block holding data (at most BLOCK_DATA_SIZE bytes)"""
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    bsize = 12 + 6 + len(cdata) + 8
+    if bsize > 0x10000 and level:
+        return compress_block(data, 0)  # incompressible data: stored blocks always fit
+    header = BGZF_MAGIC + b"\x00\x00\x00\x00\x00\xff" + struct.pack("<HBBHH", 6, 66, 67, 2, bsize - 1)
+    return header + cdata + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def compress_blocks(data: bytes, level: int = 6) -> bytes:
+    return b"".join(compress_block(data[i : i + BLOCK_DATA_SIZE], level) for i in range(0, len(data), BLOCK_DATA_SIZE))
+
+
+def rename_header_samples(header: bytes, mapping: dict[str, str]) -> bytes:
+    """header with the #CHROM line's sample columns renamed old -> new"""
+    lines = header.split(b"\n")
+    for i, line in enumerate(lines):
+        if line.startswith(b"#CHROM"):
+            cols = line.split(b"\t")
+            cols[VCF_FIXED_COLUMNS:] = [mapping.get(s.decode(), s.decode()).encode() for s in cols[VCF_FIXED_COLUMNS:]]
+            lines[i] = b"\t".join(cols)
+            return b"\n".join(lines)
+    raise BGZFError("no #CHROM line in VCF header")
+
+
+def read_header(f: BinaryIO) -> tuple[bytes, int, int, int, int]:
+    """
+    Read the leading blocks of a bgzipped VCF up to the end of its header. Returns (decompressed data of
+    those blocks, header length, offset of the last of those blocks, where that block's data starts in the
+    decompressed data, offset of the first block after them). Data past the header length are records
+    that share the header's last block.
+    """
+    data = bytearray()
+    pos = 0  # start of the first line not yet known to be a header line
+    offset = last_block = last_start = 0
+    while True:
+        block = _read_block(f)
+        if block is None or not block[1] or (pos == len(data) and not block[1].startswith(b"#")):
+            # end of file, an empty (EOF) block, or a block starting with records right after the header
+            if pos != len(data) or b"\n#CHROM" not in b"\n" + data:
+                raise BGZFError("VCF header does not end (no #CHROM line)")
+            return bytes(data), pos, last_block, last_start, offset
+        size, chunk = block
+        last_block, last_start = offset, len(data)
+        offset += size
+        data += chunk
+        while pos < len(data):
+            if not data.startswith(b"#", pos):
+                if b"\n#CHROM" not in b"\n" + data[:pos]:
+                    raise BGZFError("no #CHROM line in VCF header")
+                return bytes(data), pos, last_block, last_start, offset
+            nl = data.find(b"\n", pos)
+            if nl < 0:
+                break
+            pos = nl + 1
+
+
+def _copy_range(src: BinaryIO, dst: BinaryIO, offset: int) -> None:
+    """Copy src from offset to its end onto dst, in the kernel where possible"""
+    dst.flush()
+    size = os.fstat(src.fileno()).st_size
+    in_fd, out_fd = src.fileno(), dst.fileno()
+    out_pos = dst.tell()
+    for copy in ("copy_file_range", "sendfile"):
+        if not hasattr(os, copy):
+            continue
+        try:
+            while offset < size:
+                if copy == "copy_file_range":
+                    n = os.copy_file_range(in_fd, out_fd, size - offset, offset, out_pos)
+                else:
+                    os.lseek(out_fd, out_pos, os.SEEK_SET)
+                    n = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if n == 0:
+                    break
+                offset += n
+                out_pos += n
+            dst.seek(out_pos)
+            return
+        except OSError as e:
+            LOG.debug("%s not usable (%s), falling back", copy, e)
+    src.seek(offset)
+    dst.seek(out_pos)
+    shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+
+
+def _offset_mapper(
+    header_in_last: int, last_block: int, rest_start: int, tail_blocks: list[tuple[int, int]], new_rest_start: int
+) -> Callable[[int], int]:
+    """
+    Old -> new virtual offset (compressed block offset << 16 | offset within block). tail_blocks are the
+    (new block offset, offset within the tail) of the blocks holding the records that shared the last header
+    block, which started at header_in_last within that block.
+    """
+    first_record = tail_blocks[0][0] << 16 if tail_blocks else new_rest_start << 16
+
+    def shift(voffset: int) -> int:
+        coffset, uoffset = voffset >> 16, voffset & 0xFFFF
+        if coffset >= rest_start:
+            return (coffset - rest_start + new_rest_start) << 16 | uoffset
+        if coffset == last_block and uoffset >= header_in_last and tail_blocks:
+            in_tail = uoffset - header_in_last
+            block, start = next((b, st) for b, st in reversed(tail_blocks) if st <= in_tail)
+            return block << 16 | (in_tail - start)
+        return first_record  # inside the header: the first record
+
+    return shift
+
+
+def _shift_index(index: bytes, shift: Callable[[int], int], csi: bool) -> bytes:
+    """Apply shift to every virtual offset of a decompressed .tbi/.csi index"""
+    out = bytearray(index)
+    mv = memoryview(index)
+    u32 = struct.Struct("<I")
+    i32 = struct.Struct("<i")
+    u64 = struct.Struct("<Q")
+
+    def fix(pos: int) -> None:
+        u64.pack_into(out, pos, shift(u64.unpack_from(mv, pos)[0]))
+
+    if csi:
+        if bytes(mv[:4]) != b"CSI\x01":
+            raise BGZFError("not a CSI index")
+        _min_shift, depth, l_aux = struct.unpack_from("<iii", mv, 4)
+        pos = 16 + l_aux
+        pseudo_bin = ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+    else:
+        if bytes(mv[:4]) != b"TBI\x01":
+            raise BGZFError("not a tabix index")
+        l_nm = i32.unpack_from(mv, 32)[0]
+        pos = 36 + l_nm
+        pseudo_bin = 37450
+    n_ref = i32.unpack_from(mv, pos)[0] if csi else i32.unpack_from(mv, 4)[0]
+    if csi:
+        pos += 4
+    for _ in range(n_ref):
+        n_bin = i32.unpack_from(mv, pos)[0]
+        pos += 4
+        for _ in range(n_bin):
+            bin_no = u32.unpack_from(mv, pos)[0]
+            pos += 4
+            if csi:
+                if bin_no != pseudo_bin:
+                    fix(pos)  # loffset
+                pos += 8
+            n_chunk = i32.unpack_from(mv, pos)[0]
+            pos += 4
+            if bin_no == pseudo_bin:
+                # chunk 0: start/end offsets of the reference; chunk 1: mapped/unmapped record counts
+                fix(pos)
+                fix(pos + 8)
+            else:
+                for c in range(n_chunk):
+                    fix(pos + 16 * c)
+                    fix(pos + 16 * c + 8)
+            pos += 16 * n_chunk
+        if not csi:
+            n_intv = i32.unpack_from(mv, pos)[0]
+            pos += 4
+            for k in range(n_intv):
+                fix(pos + 8 * k)
+            pos += 8 * n_intv
+    return bytes(out)
+
+
+def reheader_samples(vcfgz: Path, mapping: dict[str, str], out: Optional[Path] = None, level: int = 6) -> Path:
+    """
+    Rename samples (old -> new) of the bgzipped VCF vcfgz into out (default: vcfgz itself, replaced
+    atomically), rewriting only the header blocks. A .tbi/.csi index next to vcfgz is shifted to match and
+    written next to out. Raises BGZFError if vcfgz is not BGZF-compressed. Returns out.
+    """
+    vcfgz = Path(vcfgz)
+    out = Path(out) if out is not None else vcfgz
+    tmp = out.with_name(f".{out.name}.{os.getpid()}.tmp")
+    with vcfgz.open("rb") as src:
+        data, header_len, last_block, last_start, rest_start = read_header(src)
+        new_header = rename_header_samples(data[:header_len], mapping)
+        tail = data[header_len:]
+        tail_blocks = []
+        index_tmps = []
+        try:
+            with tmp.open("wb") as dst:
+                dst.write(compress_blocks(new_header, level))
+                # records sharing the last header block get blocks of their own, so their offsets stay simple
+                for i in range(0, len(tail), BLOCK_DATA_SIZE):
+                    tail_blocks.append((dst.tell(), i))
+                    dst.write(compress_block(tail[i : i + BLOCK_DATA_SIZE], level))
+                new_rest_start = dst.tell()
+                _copy_range(src, dst, rest_start)
+            LOG.debug("Rewrote %d header byte(s) of %s; copied the remaining blocks unchanged", rest_start, vcfgz)
+
+            shift = _offset_mapper(header_len - last_start, last_block, rest_start, tail_blocks, new_rest_start)
+            for suffix in (".tbi", ".csi"):
+                index = vcfgz.with_name(vcfgz.name + suffix)
+                if not index.exists():
+                    continue
+                with gzip.open(index, "rb") as f:
+                    shifted = _shift_index(f.read(), shift, csi=(suffix == ".csi"))
+                index_tmp = out.with_name(f".{out.name}{suffix}.{os.getpid()}.tmp")
+                index_tmps.append((index_tmp, out.with_name(out.name + suffix)))
+                index_tmp.write_bytes(compress_blocks(shifted) + BGZF_EOF)
+        except BaseException:
+            for path in [tmp, *(t for t, _ in index_tmps)]:
+                if path.exists():
+                    path.unlink()
+            raise
+    # index first, so a new out never exists without its index
+    for index_tmp, index in index_tmps:
+        os.replace(index_tmp, index)
+    os.replace(tmp, out)
+    return out
+
+
+def main(argv: list[str]) -> int:
+    ap = argparse.ArgumentParser(description="Rename samples of a bgzipped VCF without recompressing its records.")
+    ap.add_argument("vcf", type=Path, help="bgzipped VCF (.vcf.gz); its .tbi/.csi index is updated too")
+    ap.add_argument("-s", "--samples", type=Path, required=True, help="File of 'old new' sample name pairs, one per line (as bcftools reheader -s)")
+    ap.add_argument("-o", "--output", type=Path, default=None, help="Output VCF (default: rewrite in place)")
+    args = ap.parse_args(argv)
+
+    mapping = dict(line.split()[:2] for line in args.samples.read_text().splitlines() if len(line.split()) >= 2)
+    reheader_samples(args.vcf, mapping, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,265 @@
+"""
+Streaming MD5/SHA256 checksums with a persistent cache, for verifying files before cleanup.py trashes them.
+
+Files are read in large (8 MiB) blocks and every requested digest is computed in the same pass; many files
+are hashed concurrently in a process pool so a sweep is bound by storage throughput, not by one core.
+Digests are cached in SQLite keyed by (path, size, mtime), so a file is only hashed again once it changes.
+Reference checksums come from `<file>.md5` / `<file>.sha256` sidecars (md5sum format, or a bare digest) or
+from md5sum-format manifests; SHA256 references may also be in iRODS form (`sha2:<base64 digest>`).
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import binascii
+import datetime as _dt
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Optional
+
+LOG = logging.getLogger("checksums")
+
+DEFAULT_CACHE = Path("/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/checksum_cache.sqlite")
+ALGORITHMS = ("md5", "sha256")
+SIDECAR_SUFFIXES = {"md5": ".md5", "sha256": ".sha256"}
+BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def file_digests(path: Path, algorithms: Iterable[str] = ("md5",), block_size: int = BLOCK_SIZE) -> dict[str, str]:
+    """algorithm -> hex digest of path, all computed in one sequential read"""
+    hashes = {alg: hashlib.new(alg) for alg in algorithms}
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            for h in hashes.values():
+                h.update(view[:n])
+    return {alg: h.hexdigest() for alg, h in hashes.items()}
+
+
+def _hash_task(path: str, algorithms: tuple) -> tuple[str, int, int, dict[str, str]]:
+    # runs in a worker process; the stat is taken before reading so a file modified mid-read is re-hashed next time
+    st = os.stat(path)
+    return path, st.st_size, st.st_mtime_ns, file_digests(Path(path), algorithms)
+
+
+def irods_sha256(hex_digest: str) -> str:
+    """iRODS checksum string (sha2:<base64>) for a hex SHA256 digest"""
+    return "sha2:" + base64.b64encode(bytes.fromhex(hex_digest)).decode()
+
+
+def normalize_digest(algorithm: str, value: str) -> Optional[str]:
+    """Lower-case hex digest from a hex or iRODS-style (sha2:<base64>) value; None if unparseable"""
+    value = value.strip()
+    if algorithm == "sha256" and value.startswith("sha2:"):
+        try:
+            return base64.b64decode(value[len("sha2:"):]).hex()
+        except (binascii.Error, ValueError):
+            return None
+    value = value.lower()
+    expected_len = hashlib.new(algorithm).digest_size * 2
+    if len(value) != expected_len or any(c not in "0123456789abcdef" for c in value):
+        return None
+    return value
+
+
+def read_checksum_manifest(path: Path, algorithm: str = "md5") -> dict[str, str]:
+    """file name -> digest from an md5sum/sha256sum-format file ("<digest>  [*]<path>" per line)"""
+    digests = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.strip().split(None, 1)
+            if len(parts) != 2:
+                continue
+            digest = normalize_digest(algorithm, parts[0])
+            if digest is not None:
+                digests[os.path.basename(parts[1].lstrip("*"))] = digest
+    return digests
+
+
+def is_sidecar(path: Path) -> bool:
+    return any(path.name.endswith(suffix) for suffix in SIDECAR_SUFFIXES.values())
+
+
+def reference_digests(path: Path, manifests: Optional[dict[str, dict[str, str]]] = None) -> dict[str, str]:
+    """
+    algorithm -> reference digest for path, from its sidecar files or else from manifests
+    (algorithm -> {file name -> digest})
+    """
+    refs = {}
+    for alg, suffix in SIDECAR_SUFFIXES.items():
+        sidecar = path.with_name(path.name + suffix)
+        try:
+            text = sidecar.read_text().split()
+        except (FileNotFoundError, UnicodeDecodeError):
+            text = []
+        digest = normalize_digest(alg, text[0]) if text else None
+        if digest is None and manifests:
+            digest = manifests.get(alg, {}).get(path.name)
+        if digest is not None:
+            refs[alg] = digest
+    return refs
+
+
+class ChecksumCache:
+    """
+    (path, size, mtime) -> digests, persisted in SQLite. A cached digest is only returned while the file
+    still has the size and mtime it had when it was hashed. Safe to share between threads.
+    """
+
+    def __init__(self, cache_path: Path = DEFAULT_CACHE):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(cache_path), timeout=60, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS checksums ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+            "md5 TEXT, sha256 TEXT, hashed TEXT NOT NULL)"
+        )
+        self.db.commit()
+
+    def get(self, path: Path, size: int, mtime_ns: int) -> dict[str, str]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, md5, sha256 FROM checksums WHERE path = ?", (os.path.abspath(path),)
+            ).fetchone()
+        if row is None or (row[0], row[1]) != (size, mtime_ns):
+            return {}
+        return {alg: digest for alg, digest in zip(ALGORITHMS, row[2:]) if digest}
+
+    def store(self, path: Path, size: int, mtime_ns: int, digests: dict[str, str]) -> None:
+        now = _dt.datetime.now().isoformat(timespec="seconds")
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(path), size, mtime_ns, digests.get("md5"), digests.get("sha256"), now),
+            )
+
+    def close(self) -> None:
+        self.db.close()
+
+
+@dataclass
+class Verification:
+    path: Path
+    digests: dict[str, str] = field(default_factory=dict)
+    references: dict[str, str] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def status(self) -> str:
+        """"ok", "mismatch", "no_reference" or "error" """
+        if self.error:
+            return "error"
+        checked = [alg for alg in self.references if alg in self.digests]
+        if not checked:
+            return "no_reference"
+        return "ok" if all(self.digests[alg] == self.references[alg] for alg in checked) else "mismatch"
+
+
+def compute_digests(
+    paths: Iterable[Path],
+    *,
+    algorithms: Iterable[str] = ("md5",),
+    cache: Optional[ChecksumCache] = None,
+    workers: int = 4,
+) -> dict[Path, dict[str, str]]:
+    """
+    path -> algorithm -> hex digest. Cached digests are reused; the rest are hashed in a pool of
+    workers processes and stored in cache. Files that cannot be read map to {}.
+    """
+    algorithms = tuple(algorithms)
+    result: dict[Path, dict[str, str]] = {}
+    todo = []
+    for path in dict.fromkeys(Path(p) for p in paths):
+        try:
+            st = path.stat()
+        except OSError as e:
+            LOG.warning("Cannot stat %s: %s", path, e)
+            result[path] = {}
+            continue
+        cached = cache.get(path, st.st_size, st.st_mtime_ns) if cache is not None else {}
+        if all(alg in cached for alg in algorithms):
+            result[path] = cached
+        else:
+            todo.append((path, st.st_size))
+    if not todo:
+        return result
+
+    LOG.info("Hashing %d file(s), %.1f GiB (%d cached)", len(todo), sum(size for _, size in todo) / 2**30, len(result))
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(_hash_task, str(path), algorithms): path for path, _ in todo}
+        for fut in as_completed(futures):
+            path = futures[fut]
+            try:
+                _, size, mtime_ns, digests = fut.result()
+            except OSError as e:
+                LOG.warning("Cannot read %s: %s", path, e)
+                result[path] = {}
+                continue
+            if cache is not None:
+                cache.store(path, size, mtime_ns, digests)
+            result[path] = digests
+    return result
+
+
+def verify_files(
+    paths: Iterable[Path],
+    *,
+    sha256: bool = False,
+    cache: Optional[ChecksumCache] = None,
+    manifests: Optional[dict[str, dict[str, str]]] = None,
+    workers: int = 4,
+) -> list[Verification]:
+    """
+    Check each file against its reference checksum(s) (reference_digests). Files without any reference
+    are not hashed and come back as "no_reference".
+    """
+    checks = [Verification(Path(p), references=reference_digests(Path(p), manifests)) for p in paths]
+    algorithms = ["md5", "sha256"] if sha256 else ["md5"]
+    to_hash = [c.path for c in checks if any(alg in c.references for alg in algorithms)]
+    digests = compute_digests(to_hash, algorithms=algorithms, cache=cache, workers=workers)
+    for c in checks:
+        if c.path in digests:
+            c.digests = {alg: d for alg, d in digests[c.path].items() if alg in algorithms}
+            if not c.digests:
+                c.error = "unreadable"
+        c.references = {alg: ref for alg, ref in c.references.items() if alg in algorithms}
+    return checks
+
+
+def main(argv: list[str]) -> int:
+    ap = argparse.ArgumentParser(description="Print (cached) checksums of files in md5sum format.")
+    ap.add_argument("files", nargs="+", type=Path, help="Files to checksum")
+    ap.add_argument("--sha256", action="store_true", help="Print SHA256 (hex and iRODS form) instead of MD5")
+    ap.add_argument("--cache", type=Path, default=DEFAULT_CACHE, help="SQLite checksum cache")
+    ap.add_argument("--workers", type=int, default=4, help="Files hashed concurrently (default: 4)")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    alg = "sha256" if args.sha256 else "md5"
+    cache = ChecksumCache(args.cache)
+    digests = compute_digests(args.files, algorithms=[alg], cache=cache, workers=args.workers)
+    cache.close()
+    for path in args.files:
+        digest = digests.get(path, {}).get(alg)
+        if digest is None:
+            continue
+        print(f"{digest}  {path}" + (f"  {irods_sha256(digest)}" if args.sha256 else ""))
+    return 0 if all(digests.get(p) for p in args.files) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -1,34 +1,90 @@
+import argparse
 import datetime
 import glob
 import logging
-import pandas as pd
 import os
 import pathlib
+import sys
 
-# TODO: check CRAM MD5sums for each sample 
+from checksums import DEFAULT_CACHE, ChecksumCache, is_sidecar, read_checksum_manifest, verify_files
+from sample_sheet import read_sheet, sample_id_column
 
 data_dir = "/hpf/largeprojects/tgnode/data"
 trash_dir = "/hpf/largeprojects/tgnode/trash"
 sample_sheet = "/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/sample_sheets/DECODER/DECODER_analyses.tsv"
 log_file = f"/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/logs/cleanup_{datetime.datetime.now().strftime('%Y-%m-%d')}.log"
+# index files are moved together with their verified data file (x.cram -> x.cram.crai)
+index_suffixes = (".crai", ".bai", ".csi", ".tbi")
 
-logging.basicConfig(filename=log_file, level=logging.INFO)
-
-# Read sample sheet
-sample_sheet = pd.read_csv(sample_sheet, sep="\t")
-sample_sheet_to_delete = sample_sheet[(sample_sheet["Status"] == "Done") & (sample_sheet["Lab"].isin(["DPLM", "GeneDx", "Prevention_Genetics"]))]
-
-# Get list of sequence IDs
-for _, row in sample_sheet_to_delete.iterrows():
-    sequence_ID = row["Sample_ID"]
-    DECODER_ID = row["Decoder_ID"]
-    files = glob.glob(f"{data_dir}/**/{sequence_ID}*", recursive=True)
-    if len(files) == 0:
-        logging.info(f"No files found for {DECODER_ID} {sequence_ID}")
-        continue
-    for file in files:
-        if os.path.exists(file):
-            logging.info(f"{DECODER_ID}: moving {file} to {trash_dir}")
-            os.rename(file, f"{trash_dir}/{os.path.basename(file)}")
+
+def is_companion(file):
+    return is_sidecar(pathlib.Path(file)) or file.endswith(index_suffixes)
+
+
+def move_to_trash(file, DECODER_ID):
+    logging.info(f"{DECODER_ID}: moving {file} to {trash_dir}")
+    os.rename(file, f"{trash_dir}/{os.path.basename(file)}")
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description="Move input files of completed DPLM/GeneDx/Prevention Genetics analyses to trash, after checking their checksums.")
+    ap.add_argument("--workers", type=int, default=8, help="Files hashed concurrently (default: 8)")
+    ap.add_argument("--sha256", action="store_true", help="Also check SHA256 against .sha256 sidecars (hex or iRODS sha2: form)")
+    ap.add_argument("--reference", type=pathlib.Path, action="append", default=[], help="md5sum-format file of reference checksums, used for files without a .md5 sidecar (repeatable)")
+    ap.add_argument("--checksum-cache", type=pathlib.Path, default=DEFAULT_CACHE, help="SQLite cache of file checksums")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(filename=log_file, level=logging.INFO)
+
+    # Read sample sheet
+    rows = read_sheet(sample_sheet, required=("Sample_ID", "Status", "Lab"))
+    ID_col = sample_id_column(rows[0]) if rows else "Decoder_ID"
+    sample_sheet_to_delete = [row for row in rows if row["Status"] == "Done" and row["Lab"] in ("DPLM", "GeneDx", "Prevention_Genetics")]
+
+    # Get list of files per sequence ID
+    candidates = {}  # file -> DECODER_ID
+    for row in sample_sheet_to_delete:
+        sequence_ID = row["Sample_ID"]
+        DECODER_ID = row[ID_col]
+        files = glob.glob(f"{data_dir}/**/{sequence_ID}*", recursive=True)
+        if len(files) == 0:
+            logging.info(f"No files found for {DECODER_ID} {sequence_ID}")
+            continue
+        for file in files:
+            if not os.path.exists(file):
+                logging.info(f"File {file} does not exist")
+            elif not os.path.isfile(file):
+                logging.warning(f"{DECODER_ID}: {file} is not a regular file and cannot be verified, not moving")
+            elif not is_companion(file) or not os.path.exists(os.path.splitext(file)[0]):
+                candidates[file] = DECODER_ID
+
+    # Check every file against its .md5 sidecar / reference checksum before anything is moved
+    manifests = {"md5": {}}
+    for ref in args.reference:
+        manifests["md5"].update(read_checksum_manifest(ref))
+    cache = ChecksumCache(args.checksum_cache)
+    checks = verify_files(candidates, sha256=args.sha256, cache=cache, manifests=manifests, workers=args.workers)
+    cache.close()
+
+    counts = {}
+    for check in checks:
+        file = str(check.path)
+        DECODER_ID = candidates[file]
+        counts[check.status] = counts.get(check.status, 0) + 1
+        if check.status == "ok":
+            move_to_trash(file, DECODER_ID)
+            for companion in glob.glob(glob.escape(file) + ".*"):
+                if is_companion(companion) and companion not in candidates:
+                    move_to_trash(companion, DECODER_ID)
+        elif check.status == "mismatch":
+            logging.error(f"{DECODER_ID}: checksum mismatch for {file} (expected {check.references}, got {check.digests}), not moving")
+        elif check.status == "no_reference":
+            logging.warning(f"{DECODER_ID}: no reference checksum for {file}, not moving")
         else:
-            logging.info(f"File {file} does not exist")
\ No newline at end of file
+            logging.error(f"{DECODER_ID}: could not read {file} ({check.error}), not moving")
+    logging.info(f"Checksum verification: {', '.join(f'{n} {status}' for status, n in sorted(counts.items())) or 'no files'}")
+    return 1 if counts.get("mismatch") or counts.get("error") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
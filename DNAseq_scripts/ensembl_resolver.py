@@ -0,0 +1,281 @@
+"""
+Gene symbol -> Ensembl gene ID resolver backed by a local SQLite cache.
+
+The cache is seeded from an HGNC/Ensembl dump (by default HPO/download/HGNC_ensembl_map.csv) and its
+dump rows are rebuilt whenever the dump or the cache schema changes. Symbols the dump cannot answer
+unambiguously (missing, or mapped to several Ensembl IDs) are optionally looked up on rest.ensembl.org in
+chunks, with retries, and written back to the cache so later runs never hit the network for them again.
+Symbols Ensembl has no match for are cached too, but only for NEGATIVE_TTL and only until the dump changes.
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import datetime as _dt
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+import requests
+
+
+HPO_DOWNLOAD_DIR = Path("/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/HPO/download")
+DEFAULT_DUMP = HPO_DOWNLOAD_DIR / "HGNC_ensembl_map.csv"
+DEFAULT_CACHE = HPO_DOWNLOAD_DIR / "ensembl_symbol_cache.sqlite"
+SCHEMA_VERSION = "1"
+
+ENSEMBL_LOOKUP_URL = "http://rest.ensembl.org/lookup/symbol/homo_sapiens"
+ENSEMBL_BATCH_LIMIT = 1000  # maximum symbols per POST accepted by the Ensembl REST API
+RETRY_STATUS = {429, 500, 502, 503, 504}
+NEGATIVE_TTL = _dt.timedelta(days=7)  # how long a "no such symbol" answer from Ensembl is trusted
+
+SYMBOL_COLUMNS = ("hgnc_symbol", "symbol")
+ENSEMBL_COLUMNS = ("ensembl_gene_id",)
+ALIAS_COLUMNS = ("prev_symbol", "alias_symbol")  # pipe-separated in the HGNC complete set
+
+
+def _chunks(items: list, size: int) -> Iterable[list]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def query_ensembl_batch(
+    session: requests.Session,
+    gene_symbols: list,
+    *,
+    url: str = ENSEMBL_LOOKUP_URL,
+    chunk_size: int = ENSEMBL_BATCH_LIMIT,
+    retries: int = 3,
+    backoff: float = 2.0,
+) -> dict:
+    """
+    Query the Ensembl REST API for gene symbols, chunked to the API batch limit.
+    Returns symbol -> Ensembl ID (None if Ensembl has no such symbol). Symbols from chunks that still
+    fail after all retries are left out of the result, so callers can tell "unknown" from "not found".
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
+    result = {}
+    for chunk in _chunks(list(gene_symbols), chunk_size):
+        for attempt in range(retries + 1):
+            try:
+                response = session.post(url, headers=headers, json={"symbols": chunk})
+                if response.status_code in RETRY_STATUS and attempt < retries:
+                    delay = float(response.headers.get("Retry-After", backoff * 2 ** attempt))
+                    print(f"Ensembl API returned {response.status_code}; retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                response.raise_for_status()
+                data = response.json()
+            except (requests.RequestException, ValueError) as e:
+                if attempt < retries:
+                    print(f"Error querying Ensembl API ({e}); retrying")
+                    time.sleep(backoff * 2 ** attempt)
+                    continue
+                print(f"Error querying Ensembl API, giving up on {len(chunk)} symbol(s): {e}")
+                break
+            for symbol in chunk:
+                result[symbol] = data[symbol]["id"] if symbol in data else None
+            break
+    return result
+
+
+def _pick_column(fieldnames: list, options: tuple) -> Optional[str]:
+    for name in options:
+        if name in fieldnames:
+            return name
+    return None
+
+
+def read_dump(dump: Path) -> dict:
+    """
+    Read an HGNC/Ensembl dump (CSV or TSV) into symbol -> Ensembl ID.
+    Symbols mapped to more than one Ensembl ID are returned with None (left for the live fallback);
+    previous/alias symbols never override approved symbols.
+    """
+    delimiter = "," if dump.suffix == ".csv" else "\t"
+    approved: dict[str, set] = {}
+    aliases: dict[str, set] = {}
+    with dump.open(newline="") as f:
+        rdr = csv.DictReader(f, delimiter=delimiter)
+        symbol_col = _pick_column(rdr.fieldnames or [], SYMBOL_COLUMNS)
+        ensembl_col = _pick_column(rdr.fieldnames or [], ENSEMBL_COLUMNS)
+        if symbol_col is None or ensembl_col is None:
+            raise ValueError(f"{dump} needs one of {SYMBOL_COLUMNS} and one of {ENSEMBL_COLUMNS} columns")
+        alias_cols = [c for c in ALIAS_COLUMNS if c in rdr.fieldnames]
+        for row in rdr:
+            symbol = (row[symbol_col] or "").strip()
+            ensembl_id = (row[ensembl_col] or "").strip()
+            if not symbol or not ensembl_id:
+                continue
+            approved.setdefault(symbol, set()).add(ensembl_id)
+            for col in alias_cols:
+                for alias in (row[col] or "").strip('"').split("|"):
+                    alias = alias.strip()
+                    if alias:
+                        aliases.setdefault(alias, set()).add(ensembl_id)
+    mapping = {}
+    for symbol, ids in aliases.items():
+        mapping[symbol] = next(iter(ids)) if len(ids) == 1 else None
+    for symbol, ids in approved.items():
+        mapping[symbol] = next(iter(ids)) if len(ids) == 1 else None
+    return mapping
+
+
+class EnsemblResolver:
+    """
+    Resolve gene symbols to Ensembl IDs from the local cache, falling back to the Ensembl REST API
+    (when `live` is True) for symbols the cache cannot answer. Symbols Ensembl had no match for are
+    asked again once their cached answer is older than `negative_ttl`.
+    Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        cache_path: Path = DEFAULT_CACHE,
+        dump: Optional[Path] = DEFAULT_DUMP,
+        *,
+        session: Optional[requests.Session] = None,
+        live: bool = True,
+        ensembl_url: str = ENSEMBL_LOOKUP_URL,
+        negative_ttl: _dt.timedelta = NEGATIVE_TTL,
+    ):
+        self.cache_path = cache_path
+        self.dump = dump
+        self.session = session or requests.Session()
+        self.live = live
+        self.ensembl_url = ensembl_url
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        try:
+            self.db = self._open(str(cache_path))
+        except (sqlite3.OperationalError, OSError) as e:
+            # unwritable download dir: still usable for this run, just rebuilt next time
+            print(f"Warning: cannot use Ensembl symbol cache {cache_path} ({e}); using an in-memory cache for this run")
+            self.db = self._open(":memory:")
+
+    def _open(self, database: str) -> sqlite3.Connection:
+        db = sqlite3.connect(database, timeout=60, check_same_thread=False)
+        try:
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS symbols ("
+                "symbol TEXT PRIMARY KEY, ensembl_id TEXT, source TEXT NOT NULL, updated TEXT NOT NULL)"
+            )
+            db.commit()
+            self.db = db
+            if self.dump is not None:
+                self.refresh()
+        except Exception:
+            db.close()
+            raise
+        return db
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _dump_version(self) -> str:
+        st = self.dump.stat()
+        return f"{self.dump.resolve()}:{st.st_size}:{st.st_mtime_ns}"
+
+    def refresh(self, force: bool = False) -> bool:
+        """Rebuild the cache from the dump if the dump or schema changed. Returns True if rebuilt."""
+        with self.lock:
+            version = self._dump_version()
+            if not force and self._meta("schema_version") == SCHEMA_VERSION and self._meta("dump_version") == version:
+                return False
+            print(f"Building Ensembl symbol cache {self.cache_path} from {self.dump}")
+            mapping = read_dump(self.dump)
+            now = _dt.datetime.now().isoformat(timespec="seconds")
+            with self.db:
+                # live lookups are kept across dump updates; the dump answers the symbols it knows, and
+                # symbols Ensembl had no match for are asked again, as the new release may have them
+                self.db.execute("DELETE FROM symbols WHERE source = 'dump' OR ensembl_id IS NULL")
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO symbols VALUES (?, ?, 'dump', ?)",
+                    ((symbol, ensembl_id, now) for symbol, ensembl_id in mapping.items() if ensembl_id is not None),
+                )
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    [("schema_version", SCHEMA_VERSION), ("dump_version", version), ("built", now)],
+                )
+            return True
+
+    def cached(self, symbols: Iterable[str]) -> dict:
+        """
+        Symbols known to the cache -> Ensembl ID (None if Ensembl was asked within the last
+        negative_ttl and had no match; older "no match" answers are left out so they are asked again)
+        """
+        symbols = list(dict.fromkeys(symbols))
+        expired = (_dt.datetime.now() - self.negative_ttl).isoformat(timespec="seconds")
+        found = {}
+        with self.lock:
+            for chunk in _chunks(symbols, 500):
+                marks = ",".join("?" * len(chunk))
+                for symbol, ensembl_id in self.db.execute(
+                    f"SELECT symbol, ensembl_id FROM symbols WHERE symbol IN ({marks})"
+                    " AND (ensembl_id IS NOT NULL OR updated >= ?)",
+                    chunk + [expired],
+                ):
+                    found[symbol] = ensembl_id
+        return found
+
+    def store(self, mapping: dict, source: str = "ensembl_rest") -> None:
+        now = _dt.datetime.now().isoformat(timespec="seconds")
+        try:
+            with self.lock, self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO symbols VALUES (?, ?, ?, ?)",
+                    ((symbol, ensembl_id, source, now) for symbol, ensembl_id in mapping.items()),
+                )
+        except sqlite3.OperationalError as e:
+            print(f"Warning: could not save {len(mapping)} symbol(s) to the Ensembl symbol cache {self.cache_path}: {e}")
+
+    def resolve(self, symbols: Iterable[str]) -> dict:
+        """
+        Resolve symbols to Ensembl IDs. Symbols that could not be resolved at all (not cached and the
+        live lookup is disabled or failed) are left out of the result.
+        """
+        symbols = list(dict.fromkeys(symbols))
+        result = self.cached(symbols)
+        missing = [s for s in symbols if s not in result]
+        if missing and self.live:
+            print(f"Looking up {len(missing)} gene symbol(s) on the Ensembl REST API")
+            fetched = query_ensembl_batch(self.session, missing, url=self.ensembl_url)
+            self.store(fetched)
+            result.update(fetched)
+        elif missing:
+            print(f"Warning: {len(missing)} gene symbol(s) not in the Ensembl symbol cache and live lookups are disabled")
+        return result
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def main(argv: list[str]) -> int:
+    ap = argparse.ArgumentParser(description="Build or query the local gene symbol -> Ensembl ID cache.")
+    ap.add_argument("--dump", type=Path, default=DEFAULT_DUMP, help="HGNC/Ensembl dump (CSV or TSV) to build the cache from")
+    ap.add_argument("--cache", type=Path, default=DEFAULT_CACHE, help="SQLite cache file")
+    ap.add_argument("--rebuild", action="store_true", help="Rebuild the cache even if the dump is unchanged")
+    ap.add_argument("--offline", action="store_true", help="Do not query the Ensembl REST API for unresolved symbols")
+    ap.add_argument("symbols", nargs="*", help="Gene symbols to resolve")
+    args = ap.parse_args(argv)
+
+    resolver = EnsemblResolver(args.cache, args.dump, live=not args.offline)
+    if args.rebuild:
+        resolver.refresh(force=True)
+    for symbol, ensembl_id in resolver.resolve(args.symbols).items():
+        print(f"{symbol}\t{ensembl_id or ''}")
+    resolver.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
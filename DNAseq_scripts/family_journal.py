@@ -0,0 +1,102 @@
+"""
+Per-family setup journal for DRAGEN_setup.py and PacBio_setup.py.
+
+Each family analysis dir keeps a small JSON journal of the setup steps that have completed and a fingerprint
+(path, size, mtime) of every input they used. A re-run with the same samples and unchanged inputs skips the
+completed steps, so finished families cost nothing and a family interrupted half-way resumes at the first
+unfinished step. If the sample list or any input changed, the journal is reset and the family is set up again.
+"""
+
+from __future__ import annotations
+
+import datetime as _dt
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Iterable, Optional
+
+LOG = logging.getLogger("family_journal")
+
+JOURNAL_NAME = ".setup_journal.json"
+JOURNAL_VERSION = 1
+
+
+def fingerprint(paths: Iterable[Optional[Path]]) -> dict[str, Optional[list]]:
+    """path -> [size, mtime_ns] (None for paths that do not exist); None entries in paths are ignored"""
+    prints: dict[str, Optional[list]] = {}
+    for p in paths:
+        if p is None:
+            continue
+        try:
+            st = os.stat(p)
+        except OSError:
+            prints[str(p)] = None
+        else:
+            prints[str(p)] = [st.st_size, st.st_mtime_ns]
+    return prints
+
+
+class FamilyJournal:
+    """Completed setup steps and input fingerprints of one family analysis dir"""
+
+    def __init__(self, family_dir: Path):
+        self.family_dir = family_dir
+        self.path = family_dir / JOURNAL_NAME
+        self.state = self._load()
+
+    def _load(self) -> dict:
+        try:
+            state = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            LOG.warning("Ignoring unreadable setup journal %s: %s", self.path, e)
+            return {}
+        return state if state.get("version") == JOURNAL_VERSION else {}
+
+    def _save(self) -> None:
+        self.family_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(self.state, indent=2) + "\n")
+        os.replace(tmp, self.path)
+
+    def begin(self, samples: list[str], inputs: dict) -> bool:
+        """
+        Start or resume setup for samples with the given input fingerprints. Returns True if the journal's
+        completed steps still apply, False if it was (re)started from scratch.
+        """
+        if self.state.get("samples") == samples and self.state.get("inputs") == inputs:
+            return True
+        if self.state:
+            if self.state.get("samples") != samples:
+                LOG.info("Samples changed for %s; setting the family up again", self.family_dir)
+            else:
+                changed = sorted(p for p in set(inputs) | set(self.state.get("inputs", {})) if inputs.get(p) != self.state["inputs"].get(p))
+                LOG.info("Inputs changed for %s (%s); setting the family up again", self.family_dir, ", ".join(changed))
+        self.state = {"version": JOURNAL_VERSION, "samples": samples, "inputs": inputs, "steps": {}}
+        self._save()
+        return False
+
+    def done(self, step: str) -> bool:
+        return step in self.state.get("steps", {})
+
+    def mark(self, step: str, inputs: Optional[dict] = None) -> None:
+        """
+        Record step as completed. Pass the inputs' current fingerprints if the step itself may have modified
+        them, so the next run does not mistake the family's own changes for new inputs.
+        """
+        self.state.setdefault("steps", {})[step] = _dt.datetime.now().isoformat(timespec="seconds")
+        if inputs is not None:
+            self.state["inputs"] = inputs
+        self._save()
+
+
+def write_sample_row(samples_tsv: Path, sample: str, fields: Iterable[object]) -> None:
+    """
+    Append sample's row to samples_tsv, replacing any row a previous, interrupted run already wrote for it
+    """
+    lines = samples_tsv.read_text().splitlines(keepends=True)
+    kept = [line for line in lines if line.split("\t", 1)[0] != sample]
+    kept.append("\t".join([sample, *map(str, fields)]) + "\n")
+    samples_tsv.write_text("".join(kept))
@@ -0,0 +1,167 @@
+"""
+One-pass directory index for the shared input trees (files_from_irods, PCHSeq output directories).
+
+Each directory is listed once per run with os.scandir (name, size, mtime of every entry) and the existing
+lookup patterns (exact names, wildcard globs, latest-by-mtime) are answered from that in-memory listing
+instead of a glob/stat round trip per pattern. Listings are also pickled to a cache directory and reused
+by later runs until the directory's own mtime changes (i.e. an entry was added, removed or renamed).
+Files rewritten in place keep their cached size/mtime until the directory changes; call invalidate()
+after writing into an indexed directory.
+"""
+
+from __future__ import annotations
+
+import fnmatch
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional, Union
+
+LOG = logging.getLogger("file_index")
+
+DEFAULT_CACHE_DIR = Path("/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/file_index")
+CACHE_VERSION = 1
+
+_PathLikeOrGlob = Union[Path, str]
+
+
+class FileEntry(NamedTuple):
+    size: int
+    mtime: float
+    is_dir: bool
+
+
+def _is_glob_pattern(s: str) -> bool:
+    # Minimal glob metachar check (* ? [..])
+    return any(ch in s for ch in ("*", "?", "["))
+
+
+def _scan(directory: Path) -> dict[str, FileEntry]:
+    entries: dict[str, FileEntry] = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            try:
+                st = entry.stat()  # follows symlinks, like Path.exists()
+            except OSError:
+                continue  # dangling symlink
+            entries[entry.name] = FileEntry(st.st_size, st.st_mtime, entry.is_dir())
+    return entries
+
+
+class DirectoryIndex:
+    """
+    Cached directory listings answering exists/glob/latest lookups without touching the filesystem again.
+    Safe to share between threads.
+    """
+
+    def __init__(self, cache_dir: Optional[Path] = DEFAULT_CACHE_DIR, write_cache: bool = True):
+        self.cache_dir = cache_dir
+        self.write_cache = write_cache
+        self.lock = threading.Lock()
+        self._listings: dict[Path, dict[str, FileEntry]] = {}
+        self._cache_warned = False
+
+    def _cache_path(self, directory: Path) -> Path:
+        return self.cache_dir / f"{hashlib.sha1(str(directory).encode()).hexdigest()}.pkl"
+
+    def _read_cached(self, directory: Path, key: tuple) -> Optional[dict]:
+        try:
+            with self._cache_path(directory).open("rb") as f:
+                cached_key, entries = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            LOG.debug("Ignoring unreadable listing cache for %s: %s", directory, e)
+            return None
+        return entries if cached_key == key else None
+
+    def _write_cached(self, directory: Path, key: tuple, entries: dict) -> None:
+        path = self._cache_path(directory)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with tmp.open("wb") as f:
+                pickle.dump((key, entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError as e:
+            if not self._cache_warned:
+                LOG.warning("Could not write directory listing cache under %s: %s", self.cache_dir, e)
+                self._cache_warned = True
+            if tmp.exists():
+                tmp.unlink()
+
+    def listing(self, directory: Path) -> dict[str, FileEntry]:
+        """name -> FileEntry for every entry of directory (empty if it does not exist), listed at most once"""
+        directory = Path(directory)
+        with self.lock:
+            entries = self._listings.get(directory)
+        if entries is not None:
+            return entries
+        try:
+            st = directory.stat()
+        except OSError:
+            entries = {}
+        else:
+            key = (CACHE_VERSION, st.st_ino, st.st_mtime_ns)
+            entries = self._read_cached(directory, key) if self.cache_dir is not None else None
+            if entries is None:
+                LOG.debug("Scanning %s", directory)
+                entries = _scan(directory)
+                if self.cache_dir is not None and self.write_cache:
+                    self._write_cached(directory, key, entries)
+        with self.lock:
+            self._listings[directory] = entries
+        return entries
+
+    def invalidate(self, directory: Path) -> None:
+        """Forget directory's listing, e.g. after writing files into it"""
+        with self.lock:
+            self._listings.pop(Path(directory), None)
+
+    def stat(self, path: _PathLikeOrGlob) -> Optional[FileEntry]:
+        path = Path(path)
+        return self.listing(path.parent).get(path.name)
+
+    def exists(self, path: _PathLikeOrGlob) -> bool:
+        return self.stat(path) is not None
+
+    def is_dir(self, path: _PathLikeOrGlob) -> bool:
+        entry = self.stat(path)
+        return entry is not None and entry.is_dir
+
+    def glob(self, directory: Path, pattern: str) -> list[Path]:
+        """Entries of directory whose name matches pattern (glob syntax, no '/'), sorted by name"""
+        directory = Path(directory)
+        names = [
+            name
+            for name in self.listing(directory)
+            if fnmatch.fnmatchcase(name, pattern) and (pattern.startswith(".") or not name.startswith("."))
+        ]
+        return [directory / name for name in sorted(names)]
+
+    def latest(self, paths_or_globs: Iterable[_PathLikeOrGlob]) -> Optional[Path]:
+        """
+        Return the most-recently-modified match among literal paths that exist and glob patterns
+        (e.g. "/path/to/*.vcf.gz"); None if nothing matches.
+        """
+        found: dict[Path, float] = {}
+        for item in paths_or_globs:
+            p = Path(item)
+            if _is_glob_pattern(str(p.parent)):
+                # wildcard directories are rare; let glob walk them
+                for m in glob.glob(str(p)):
+                    found[Path(m)] = os.stat(m).st_mtime
+            elif _is_glob_pattern(p.name):
+                for m in self.glob(p.parent, p.name):
+                    found[m] = self.listing(p.parent)[m.name].mtime
+            else:
+                entry = self.stat(p)
+                if entry is not None:
+                    found[p] = entry.mtime
+        if not found:
+            return None
+        return max(found, key=found.get)
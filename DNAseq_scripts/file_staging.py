@@ -0,0 +1,106 @@
+"""
+Stage input files into analysis directories without copying them when the filesystem allows it.
+
+Strategies, cheapest first:
+  - reflink: FICLONE clone sharing the source's blocks copy-on-write (btrfs, XFS with reflink, ...)
+  - hardlink: another name for the source's inode (same filesystem only)
+  - symlink: a link to the source path (only on request: it breaks if the source is moved or trashed)
+  - copy: full shutil.copy2
+"auto" tries reflink, then hardlink, then copy for each file, and remembers per (source filesystem,
+destination filesystem) pair the strategies that cannot work there at all (EXDEV, EOPNOTSUPP, ...), so those
+are not tried again. Per-file failures (EPERM from fs.protected_hardlinks on another user's file, EMLINK)
+only move that file on to the next strategy. Staged files must be treated as read-only: anything that changes a staged
+file has to write a new file and rename it over the staged one, never modify it in place, because a
+hardlinked or symlinked file is the shared source itself.
+"""
+
+from __future__ import annotations
+
+import errno
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # not on Linux/Unix
+    fcntl = None
+
+LOG = logging.getLogger("file_staging")
+
+MODES = ("auto", "reflink", "hardlink", "symlink", "copy")
+AUTO_ORDER = ("reflink", "hardlink", "copy")
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+
+# errors meaning "this strategy does not work here", as opposed to a real I/O problem
+_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EMLINK}
+# the subset that holds for every file of a (source filesystem, destination filesystem) pair
+_PAIR_UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.ENOSYS}
+
+_unsupported: dict[tuple[int, int], set[str]] = {}
+_logged: dict[tuple[int, int], str] = {}
+_lock = threading.Lock()
+
+
+def _reflink(src: Path, dest: Path) -> None:
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "FICLONE not available")
+    with open(src, "rb") as s, open(dest, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            dest.unlink()
+            raise
+    shutil.copystat(src, dest)
+
+
+def _place(src: Path, dest: Path, mode: str) -> None:
+    if mode == "reflink":
+        _reflink(src, dest)
+    elif mode == "hardlink":
+        os.link(src, dest)
+    elif mode == "symlink":
+        os.symlink(os.path.abspath(src), dest)
+    elif mode == "copy":
+        shutil.copy2(src, dest)
+    else:
+        raise ValueError(f"Unknown staging mode {mode!r} (use one of {', '.join(MODES)})")
+
+
+def stage_file(src: Path, dest: Path, mode: str = "auto") -> str:
+    """
+    Stage src at dest (replacing dest atomically if it exists) with the given strategy; with "auto", the
+    cheapest one that works for this file. Returns the strategy used.
+    """
+    src, dest = Path(src), Path(dest)
+    tmp = dest.with_name(f".{dest.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    if mode != "auto":
+        _place(src, tmp, mode)
+        os.replace(tmp, dest)
+        return mode
+
+    key = (os.stat(src).st_dev, os.stat(dest.parent).st_dev)
+    with _lock:
+        candidates = [m for m in AUTO_ORDER if m not in _unsupported.get(key, ())]
+    for candidate in candidates:
+        try:
+            _place(src, tmp, candidate)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or candidate == "copy":
+                raise
+            LOG.debug("Staging by %s not supported for %s -> %s: %s", candidate, src, dest.parent, e)
+            if e.errno in _PAIR_UNSUPPORTED:
+                with _lock:
+                    _unsupported.setdefault(key, set()).add(candidate)
+            continue
+        with _lock:
+            first = _logged.get(key) != candidate
+            _logged[key] = candidate
+        if first:
+            LOG.info("Staging files from %s into %s by %s", src.parent, dest.parent, candidate)
+        os.replace(tmp, dest)
+        return candidate
+    raise OSError(f"Could not stage {src} at {dest}")
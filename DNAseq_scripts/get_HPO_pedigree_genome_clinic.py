@@ -1,8 +1,173 @@
+"""
+Retrieve pedigrees and HPO terms from Genome Clinic Phenotips.
+
+Importable without side effects: DRAGEN_setup.py and PacBio_setup.py create one PhenotipsClient and
+call fetch_families() in-process, reusing its session, Ensembl resolver and HPO index across families.
+Run as a script for the original command-line behaviour.
+"""
+
 import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from datetime import date
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+from urllib.parse import urlsplit
 from simplejson import JSONDecodeError
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+
+import ensembl_resolver
+import hpo_index
+from artefact_registry import DEFAULT_REGISTRY, ArtefactRegistry, parse_artefact_name
+from sample_sheet import read_credentials, read_sample_ids
+
+BASE_URL = "https://genomeclinic.ccm.sickkids.ca/"
+PID_URL = "https://genomeclinic.ccm.sickkids.ca/rest/patients/eid/"
+PEDIGREE_URL = "https://genomeclinic.ccm.sickkids.ca/get/PhenoTips/FamilyPedigreeInterface"
+HPO_DIR = Path("/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/HPO")
+PED_DIR = Path("/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/pedigrees")
+SYNC_DIR = Path("/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/phenotips_sync")
+COHORT_DIR = Path("/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/HPO/cohort")
+# column types of the HPO gene table as get_HPO_gene_mapping builds it, for reading written tables back
+HPO_TABLE_DTYPES = {"Gene Symbol": str, "Gene ID": str, "Number of occurrences": int, "Features": str, "HPO IDs": str}
+
+
+class RateLimiter:
+    """
+    Spread request start times so that no more than `rate` requests per second are issued.
+    A rate of 0 disables throttling.
+    """
+    def __init__(self, rate: float = 0.0):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class ThrottledSession(requests.Session):
+    """
+    requests.Session shared by all fetch threads so TLS connections are kept alive and reused.
+    - At most `max_per_host` requests are in flight per host (and the connection pool is sized to match)
+    - Request starts are spaced to hit a target `rate` (requests/second; 0 = unlimited)
+    Credentials are passed per request, so Phenotips auth is never sent to Ensembl.
+    """
+    def __init__(self, max_per_host: int = 4, rate: float = 0.0):
+        super().__init__()
+        self.max_per_host = max(1, max_per_host)
+        self.limiter = RateLimiter(rate)
+        self.host_slots = {}
+        self.host_lock = threading.Lock()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.max_per_host, pool_block=True)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def _slots(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self.host_lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.host_slots[host]
+
+    def request(self, method, url, *args, **kwargs):
+        with self._slots(url):
+            self.limiter.wait()
+            return super().request(method, url, *args, **kwargs)
+
+
+class SyncState:
+    """
+    Per-project record of the last Phenotips sync for each sample: Phenotips ID and modification date of the
+    sample and of the record the HPO terms came from, the HPO gene index and descendant expansion (hp.obo
+    closure, max depth) used, HPO term set, and the pedigree/HPO files written (with a hash of the HPO gene
+    table, and of the one last added to the cohort export).
+    Lets reruns skip rebuilding HPO gene tables whose inputs have not changed and avoid writing identical files.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            self.records = json.loads(path.read_text())
+        except FileNotFoundError:
+            self.records = {}
+        except ValueError:
+            print(f"Warning: ignoring unreadable sync state {path}")
+            self.records = {}
+
+    def get(self, sample_id: str) -> dict:
+        with self.lock:
+            return dict(self.records.get(sample_id, {}))
+
+    def is_current(self, sample_id: str, **inputs) -> bool:
+        """True if the sample's HPO gene table was built from the same inputs (field=value) and its files still exist"""
+        record = self.get(sample_id)
+        if any(record.get(key) != value for key, value in inputs.items()):
+            return False
+        files = [record.get("pedigree"), record.get("hpo")]
+        return record.get("hpo") is not None and all(Path(f).exists() for f in files if f)
+
+    def update(self, sample_id: str, **fields) -> None:
+        with self.lock:
+            self.records.setdefault(sample_id, {}).update(fields)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(self.records, indent=1, sort_keys=True))
+            os.replace(tmp, self.path)
+
+
+class CohortHPOExport:
+    """
+    Cohort-wide Parquet dataset of HPO gene tables, one dataset per project under COHORT_DIR/<project>.
+    Each fetched proband is appended as its own file, hive-partitioned by fetch date
+    (fetch_date=YYYY-MM-DD/<family>.<proband>.parquet), with family and proband columns, so the whole
+    cohort can be read as one dataset with column pruning. Requires pyarrow.
+    """
+    def __init__(self, root: Path = COHORT_DIR):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise SystemExit("Error: the cohort HPO export needs pyarrow (pip install pyarrow)")
+        self.root = root
+
+    def append(self, project: str, family: str, proband: str, hpo_genes: pd.DataFrame, fetch_date: Optional[str] = None) -> Path:
+        fetch_date = fetch_date or date.today().strftime("%Y-%m-%d")
+        part_dir = self.root / project / f"fetch_date={fetch_date}"
+        part_dir.mkdir(parents=True, exist_ok=True)
+        part = part_dir / f"{family}.{proband}.parquet"
+        tmp = part_dir / f".{part.name}.{os.getpid()}.{threading.get_ident()}.tmp" # dot files are ignored by dataset readers
+        table = hpo_genes.copy()
+        table.insert(0, "proband", proband)
+        table.insert(0, "family", family)
+        table.to_parquet(tmp, index=False)
+        os.replace(tmp, part)
+        print(f"Appended HPO gene table for {proband} to cohort dataset {self.root / project}")
+        return part
+
+
+def read_cohort_hpo(project: str, columns: Optional[list] = None, genes: Optional[list] = None, root: Path = COHORT_DIR) -> pd.DataFrame:
+    """
+    Read a project's cohort HPO gene dataset (all fetch dates), optionally only some columns and/or
+    the rows for some gene symbols, e.g. read_cohort_hpo("DECODER", ["family", "Gene Symbol"], ["FBN1"])
+    """
+    filters = [("Gene Symbol", "in", list(genes))] if genes else None
+    return pd.read_parquet(root / project, columns=columns, filters=filters)
+
 
 def sample_id_to_family_id(sample_id: str, project: str) -> str:
     """
@@ -38,43 +203,70 @@ def normalize_sample_id(sample_id: str, project: str) -> str:
     else:
         return sample_id
 
-def get_pedigree_info(ped) -> [dict, str]:
+def index_pedigree(pedigree: dict) -> [dict, dict, dict]:
+    """
+    Index the pedigree object once so per-member lookups are O(1):
+    - Phenotips ID -> first pedigree node carrying that ID
+    - Phenotips ID -> affected (carrier) status, from the first matching node with pedigreeProperties
+    - child node ID -> parent node IDs, from the first relationship listing the child
+    """
+    node_by_pid = {}
+    affected_by_pid = {}
+    for node in pedigree["members"]:
+        properties = node.get("properties", None)
+        if not properties or properties.get("id", None) is None:
+            continue
+        pid = properties["id"]
+        node_by_pid.setdefault(pid, node)
+        pedigree_properties = node.get("pedigreeProperties", None)
+        if pedigree_properties and pid not in affected_by_pid:
+            affected_by_pid[pid] = pedigree_properties.get("carrierStatus", None)
+    parents_by_node = {}
+    for relationship in pedigree["relationships"]:
+        for child in relationship["children"]:
+            parents_by_node.setdefault(child["id"], [id for id in relationship["members"]])
+    return node_by_pid, affected_by_pid, parents_by_node
+
+def get_pedigree_info(ped, sex_lookup=None) -> [dict, str]:
     """
     JSON response contains pedigree and family objects
     The family object contains only those individuals in the pedigree that have been assigned Phenotips IDs
     The pedigree object contains members, an array of pedigree nodes where each node represents a family member,
     and the relationship object, an array describing the relationships between pedigree nodes (parent:child relationships)
+    sex_lookup maps a list of Phenotips IDs to their sex, for members whose pedigree node does not record it
     """
     members = (
         {}
     )  # create dictionary where keys are C4R IDs, and values are Phenotips ID, node ID, affected status, sex, and parental node IDs
     node_to_C4R = {}  # map pedigree node to C4R ID
+    node_by_pid, affected_by_pid, parents_by_node = index_pedigree(ped["pedigree"])
     # iterate through familyMembers dict, rather than members dict, to retrieve only IDs of those with Phenotips ID (others are placeholders in pedigree)
     for member in ped["family"]["familyMembers"]:
         C4R = member["identifier"]
         pid = member["id"]  # Phenotips ID
-        for member in ped["pedigree"]["members"]:
-            properties = member.get("properties", None)
-            if properties:
-                if properties.get("id", None) == pid:
-                    node_id = member["id"] # pedigree node id
-                    sex = member["properties"].get("sex", None)
-                    break
-        if not sex:
-            sex = get_sex(pid)
-
-        node_to_C4R[node_id] = C4R
-        # refer to members dict to retrieve affected status, if it exists
-        affected = get_affected(pid, ped["pedigree"]["members"])
-        # refer to relationships dict to retrieve parent node IDs
-        parents = get_parents(node_id, ped["pedigree"]["relationships"])
+        node = node_by_pid.get(pid)
+        if node is None:
+            print(f"Warning: participant {pid} ({C4R}) has no node in the pedigree")
+            node_id = None
+            sex = None
+        else:
+            node_id = node["id"] # pedigree node id
+            sex = node["properties"].get("sex", None)
+            node_to_C4R[node_id] = C4R
         members[C4R] = {
             "pid": pid,
             "node_id": node_id,
-            "affected": affected,
+            "affected": affected_by_pid.get(pid), # affected status, if it exists
             "sex": sex,
-            "parents": parents,
+            "parents": parents_by_node.get(node_id), # parent node IDs
         }
+    # look up sex in Phenotips for members whose pedigree node does not record it, all at once
+    missing_sex = [members[C4R]["pid"] for C4R in members if not members[C4R]["sex"]]
+    if missing_sex and sex_lookup is not None:
+        sexes = sex_lookup(missing_sex)
+        for C4R in members:
+            if not members[C4R]["sex"]:
+                members[C4R]["sex"] = sexes.get(members[C4R]["pid"])
     # get C4R IDs for parents
     for member in members:
         parents = members[member]["parents"]
@@ -101,182 +293,90 @@ def get_pedigree_info(ped) -> [dict, str]:
     
     return members, proband_id
 
-def get_sex(pid: int) -> str:
-    """Get sex of an individual given Phenotips ID of that individual"""
-    print(f"Querying Phenotips endpoint for participant {pid}")
-    pid_response = requests.get(
-        f"{base_url}/rest/patients/{pid}",
-        auth=auth,
-    )
-    if pid_response.status_code == 200:
-        sex = pid_response.json()["sex"]
-        print(f"Query successful; participant {pid} has sex {sex}")
-    else:
-        # if any participant is not present in Phenotips, exit with error
-        print(
-            f"Query unsuccessful; participant {pid} is not present in Phenotips"
-        )
-
-    return sex
-
-def get_affected(pid: int, members: dict) -> str:
-    """Get affected status of individual"""
-    affected = None
-    for member in members:
-        properties = member.get("properties", None)
-        if properties:
-            if properties.get("id", None) == pid:
-                pedigree_properties = member.get("pedigreeProperties", None)
-                if pedigree_properties:
-                    affected = member["pedigreeProperties"].get("carrierStatus", None)
-                    if not affected:
-                        affected = member["pedigreeProperties"].get("carrierStatus", None)
-                    break
-
-    return affected
-
-def get_parents(node_id: int, relationships: dict) -> list:
-    """
-    Given node ID, retrieve IDs of parent nodes if they exist
-    """
-    for relationship in relationships:
-        parents = None
-        if node_id in [id["id"] for id in relationship["children"]]:
-            parents = [id for id in relationship["members"]]
-            break
-
-    return parents
-
-def write_pedigree(members: dict, family: str, project: str, rename: bool) -> None:
+def write_pedigree(members: dict, family: str, project: str, rename: bool, ped_dir: Path = PED_DIR) -> Path:
     """
-    Write a pedigree text file given dictionary derived from Phenotips pedigree JSON
+    Write a pedigree text file given dictionary derived from Phenotips pedigree JSON.
+    The file is left untouched (mtime included) if its content would not change.
     """
     if rename:
         family = normalize_family_id(family)
-    print(f"Writing pedigree file to /hpf/largeprojects/tgnode/sandbox/mcouse_analysis/pedigrees/{project}/{family}_pedigree.ped")
-    with open(f"/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/pedigrees/{project}/{family}_pedigree.ped", "w") as f:
-        for member in members:
-            family_id = family
-            sample_id = member
-            member = members[member]
-            if member.get("sex") == "M":
-                sex = 1
-            elif member.get("sex") == "F":
-                sex = 2
-            else:
-                sex = "other"
-            affected = member.get("affected")
-            # phenotype: 2 for proband or affected, 0 otherwise
-            if member.get("is_proband"):
-                phenotype = 2
-            else:
-                phenotype = 2 if affected == "affected" else 0
-            paternal_id = 0
-            maternal_id = 0
-            if member.get("parents_eid"):
-                for p in member["parents_eid"]:
-                    parent_sex = members[p]["sex"]
-                    if parent_sex == "M":
-                        paternal_id = p
-                    else:
-                        maternal_id = p
-            # convert IDs to crg2-pacbio compatible IDs
-            if rename:
-                sample_id = normalize_sample_id(sample_id, project)
-                try:
-                    paternal_id = normalize_sample_id(paternal_id, project)
-                except:
-                    pass
-                try:
-                    maternal_id = normalize_sample_id(maternal_id, project)
-                except:
-                    pass
-            f.write(
-                f"{family_id} {sample_id} {paternal_id} {maternal_id} {sex} {phenotype}\n"
-            )
-
-def get_HPO_IDs(proband_id: str) -> pd.DataFrame:
-        """Query G4RD phenotips to get HPO terms for the proband"""
-        hpo = requests.get(
-            f"{base_url}/rest/patients/{proband_id}/suggested-gene-panels",
-            auth=auth,
+    ped_path = ped_dir / project / f"{family}_pedigree.ped"
+    lines = []
+    for member in members:
+        family_id = family
+        sample_id = member
+        member = members[member]
+        if member.get("sex") == "M":
+            sex = 1
+        elif member.get("sex") == "F":
+            sex = 2
+        else:
+            sex = "other"
+        affected = member.get("affected")
+        # phenotype: 2 for proband or affected, 0 otherwise
+        if member.get("is_proband"):
+            phenotype = 2
+        else:
+            phenotype = 2 if affected == "affected" else 0
+        paternal_id = 0
+        maternal_id = 0
+        if member.get("parents_eid"):
+            for p in member["parents_eid"]:
+                parent_sex = members[p]["sex"]
+                if parent_sex == "M":
+                    paternal_id = p
+                else:
+                    maternal_id = p
+        # convert IDs to crg2-pacbio compatible IDs
+        if rename:
+            sample_id = normalize_sample_id(sample_id, project)
+            try:
+                paternal_id = normalize_sample_id(paternal_id, project)
+            except:
+                pass
+            try:
+                maternal_id = normalize_sample_id(maternal_id, project)
+            except:
+                pass
+        lines.append(
+            f"{family_id} {sample_id} {paternal_id} {maternal_id} {sex} {phenotype}\n"
         )
+    content = "".join(lines)
+    if ped_path.exists() and ped_path.read_text() == content:
+        print(f"Pedigree file {ped_path} is unchanged")
+        return ped_path
+    print(f"Writing pedigree file to {ped_path}")
+    ped_path.write_text(content)
+    return ped_path
 
-        hpo = hpo.json()
-        hpo_id = []
-
-        for row in hpo["rows"]:
-            terms = row["terms"]
-            for term in terms:
-                hpo_id.append(term["id"])
-        
-        hpo_id = list(set(hpo_id))
-
-        return hpo_id
-
-def hpo_to_gene_mapping(hpo_ids: list) -> pd.DataFrame:
-    """Map HPO terms to genes"""
-    hpo_mapping = pd.read_csv("/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/HPO/download/genes_to_phenotype.txt", sep="\t").drop(columns=["ncbi_gene_id", "frequency", "disease_id"])
-    hpo_mapping = hpo_mapping.drop_duplicates()
-    hpo_agg = hpo_mapping[hpo_mapping["hpo_id"].isin(hpo_ids)].groupby("gene_symbol").agg(lambda x:  ", ".join(x)).reset_index() # get genes associated with patient HPO terms 
+def hpo_to_gene_mapping(hpo_ids: list, gene_index: hpo_index.HPOGeneIndex) -> pd.DataFrame:
+    """Map HPO terms to genes using the compiled genes_to_phenotype.txt index (see hpo_index.py)"""
+    hpo_agg = gene_index.genes_for_terms(hpo_ids) # get genes associated with patient HPO terms
 
     return hpo_agg
 
-def get_ensembl_from_hgnc(hpo_agg: pd.DataFrame) -> pd.DataFrame:
+def get_ensembl_from_hgnc(hpo_agg: pd.DataFrame, gene_index: hpo_index.HPOGeneIndex) -> pd.DataFrame:
     """Get Ensembl IDs for genes from HGNC mapping"""
-    hgnc_mapping = pd.read_csv("/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/HPO/download/HGNC_ensembl_map.csv")
-    hpo_agg_ens = hpo_agg.merge(hgnc_mapping, left_on="gene_symbol", right_on="hgnc_symbol", how="left")
+    hpo_agg_ens = gene_index.with_ensembl(hpo_agg)
     
     return hpo_agg_ens
 
-def query_ensembl_batch(gene_symbols: list) -> dict:
-    """Query Ensembl REST API to get gene information for multiple genes at once"""
-    ensembl_url = "http://rest.ensembl.org/lookup/symbol/homo_sapiens"
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-    payload = {"symbols": gene_symbols}
-    
-    try:
-        response = requests.post(ensembl_url, headers=headers, json=payload)
-        response.raise_for_status()
-        data = response.json()
-        
-        # Create a mapping of gene symbol to Ensembl ID
-        result = {}
-        for symbol in gene_symbols:
-            if symbol in data:
-                result[symbol] = data[symbol]['id']
-            else:
-                result[symbol] = None
-        return result
-        
-    except (requests.RequestException, JSONDecodeError) as e:
-        print(f"Error querying Ensembl API: {e}")
-        return {}
-    
 def get_dup_genes(hpo_agg_ens: pd.DataFrame) -> list:
     """Get duplicate genes from HGNC mapping"""
-    genes = []
-    dup_genes = []
-    for gene in hpo_agg_ens["gene_symbol"].values:
-        if gene not in genes:
-            genes.append(gene)
-        else:
-            if gene not in dup_genes:
-                dup_genes.append(gene)
+    symbols = hpo_agg_ens["gene_symbol"]
+    dup_genes = symbols[symbols.duplicated()].unique().tolist()
 
     return dup_genes
 
-def get_HPO_gene_mapping(hpo_ids: list) -> pd.DataFrame:
+def get_HPO_gene_mapping(hpo_ids: list, resolver: ensembl_resolver.EnsemblResolver, gene_index: Optional[hpo_index.HPOGeneIndex] = None) -> pd.DataFrame:
     """Get HPO gene mapping based on patient HPO terms"""
-    hpo_agg = hpo_to_gene_mapping(hpo_ids) # map HPO terms to associated genes
-    hpo_agg_ens = get_ensembl_from_hgnc(hpo_agg) # get Ensembl IDs for genes from HGNC mapping
-    ens_ids = query_ensembl_batch(hpo_agg_ens[hpo_agg_ens["ensembl_gene_id"].isna()]["gene_symbol"].values.tolist()) # get Ensembl IDs for genes without an Ensembl ID after HGNC mapping
+    gene_index = gene_index or hpo_index.load_index()
+    hpo_agg = hpo_to_gene_mapping(hpo_ids, gene_index) # map HPO terms to associated genes
+    hpo_agg_ens = get_ensembl_from_hgnc(hpo_agg, gene_index) # get Ensembl IDs for genes from HGNC mapping
+    ens_ids = resolver.resolve(hpo_agg_ens[hpo_agg_ens["ensembl_gene_id"].isna()]["gene_symbol"].values.tolist()) # get Ensembl IDs for genes without an Ensembl ID after HGNC mapping
     hpo_agg_ens.loc[hpo_agg_ens["ensembl_gene_id"].isna(), "ensembl_gene_id"] = hpo_agg_ens.loc[hpo_agg_ens["ensembl_gene_id"].isna(), "gene_symbol"].map(ens_ids)
-    dup_genes = get_dup_genes(hpo_agg_ens) # some genes are associated with multiple Ensembl IDs (possibly due to different versions over time). Query the REST API to get the latest Ensembl ID for these genes. 
-    dup_ens = query_ensembl_batch(dup_genes)
+    dup_genes = get_dup_genes(hpo_agg_ens) # some genes are associated with multiple Ensembl IDs (possibly due to different versions over time). Resolve these from the symbol cache, which falls back to the REST API for the latest Ensembl ID. 
+    dup_ens = resolver.resolve(dup_genes)
     # Only update ensembl_gene_id for genes that exist in dup_ens dictionary
     mask = hpo_agg_ens["gene_symbol"].isin(dup_ens.keys())
     hpo_agg_ens.loc[mask, "ensembl_gene_id"] = hpo_agg_ens.loc[mask, "gene_symbol"].map(dup_ens)
@@ -289,66 +389,324 @@ def get_HPO_gene_mapping(hpo_ids: list) -> pd.DataFrame:
     
     return hpo_agg_ens
 
-def process_sample(id, fam, auth, pid_url, pedigree_url, project, rename):
-    response = requests.get(f"{pid_url}/{id}", auth=auth)
-    try:
-        pid = response.json().get('id')
-        params={"action": "familyinfo", "document_id": pid}
-        response = requests.get(pedigree_url, params=params, auth=auth)
-        ped_json = response.json()
-        if "family" in ped_json and "pedigree" in ped_json:
-            members, proband_id = get_pedigree_info(ped_json)
-            write_pedigree(members, fam, project, rename)
-            pid_proband = requests.get(f"{pid_url}/{proband_id}", auth=auth).json().get('id')
+def write_hpo(HPO_df: pd.DataFrame, fam: str, project: str, previous: dict, hpo_dir: Path = HPO_DIR) -> [Path, str]:
+    """
+    Write the HPO gene table to a dated file, unless it is identical to the table written last time
+    (in which case the previous file is kept and returned). Returns the HPO file path and table hash.
+    """
+    content = HPO_df.to_csv(sep="\t", index=False)
+    digest = hashlib.sha256(content.encode()).hexdigest()
+    if previous.get("hpo_hash") == digest and previous.get("hpo") and Path(previous["hpo"]).exists():
+        print(f"HPO gene table unchanged; keeping {previous['hpo']}")
+        return Path(previous["hpo"]), digest
+    today = date.today()
+    today = today.strftime("%Y-%m-%d")
+    fam = fam.replace("_", "")
+    hpo_path = hpo_dir / project / f"{fam}_HPO_{today}.txt"
+    print(f"Writing HPO file to {hpo_path}")
+    hpo_path.write_text(content)
+    return hpo_path, digest
+
+def read_hpo(hpo_path: Path) -> pd.DataFrame:
+    """
+    Read an HPO gene table written by write_hpo back with the column types it was written with
+    (otherwise an all-missing Gene ID column comes back as float64)
+    """
+    return pd.read_csv(hpo_path, sep="\t", dtype=HPO_TABLE_DTYPES)
+
+@dataclass
+class FamilyResult:
+    """Pedigree and HPO information fetched from Phenotips for one sample (normally the proband)"""
+    sample_id: str
+    family: str
+    project: str
+    proband_id: Optional[str] = None  # C4R/TG ID of the pedigree proband
+    members: dict = field(default_factory=dict)  # from get_pedigree_info; empty if Phenotips has no pedigree
+    hpo_ids: list = field(default_factory=list)
+    hpo_genes: Optional[pd.DataFrame] = None  # output of get_HPO_gene_mapping
+    pedigree_file: Optional[Path] = None
+    hpo_file: Optional[Path] = None
+    skipped: bool = False  # HPO inputs unchanged since the last sync; the HPO terms and gene table were not refetched
+    error: Optional[str] = None
+
+
+class PhenotipsClient:
+    """
+    Phenotips/HPO fetcher holding one throttled session, one Ensembl resolver and the per-project sync
+    state, so any number of families can be fetched in-process without reconnecting or reloading indexes.
+    """
+    def __init__(
+        self,
+        auth: tuple,
+        *,
+        base_url: str = BASE_URL,
+        pid_url: str = PID_URL,
+        pedigree_url: str = PEDIGREE_URL,
+        max_per_host: int = 4,
+        rate: float = 0.0,
+        offline: bool = False,
+        full_refresh: bool = False,
+        sync_dir: Path = SYNC_DIR,
+        cohort_export: Optional[CohortHPOExport] = None,
+        expand_descendants: bool = False,
+        max_depth: Optional[int] = None,
+        hpo_dir: Path = HPO_DIR,
+        ped_dir: Path = PED_DIR,
+        registry_path: Path = DEFAULT_REGISTRY,
+        gene_index: Optional[hpo_index.HPOGeneIndex] = None,
+        closure: Optional[hpo_index.HPOClosure] = None,
+        symbol_cache: Path = ensembl_resolver.DEFAULT_CACHE,
+        symbol_dump: Path = ensembl_resolver.DEFAULT_DUMP,
+        ensembl_url: str = ensembl_resolver.ENSEMBL_LOOKUP_URL,
+    ):
+        self.auth = auth
+        self.base_url = base_url
+        self.pid_url = pid_url
+        self.pedigree_url = pedigree_url
+        self.session = ThrottledSession(max_per_host=max_per_host, rate=rate)
+        self.offline = offline
+        self.full_refresh = full_refresh
+        self.sync_dir = sync_dir
+        self.cohort_export = cohort_export
+        self.expand_descendants = expand_descendants
+        self.max_depth = max_depth
+        self.hpo_dir = hpo_dir
+        self.ped_dir = ped_dir
+        self.registry = ArtefactRegistry(registry_path, {"hpo": hpo_dir, "pedigree": ped_dir}) # every HPO/pedigree file written is registered
+        self.gene_index = gene_index # loaded from the default HPO download dir when first needed
+        self.closure = closure
+        self.lock = threading.Lock()
+        self.symbol_cache = symbol_cache
+        self.symbol_dump = symbol_dump
+        self.ensembl_url = ensembl_url
+        self._resolver = None
+        self._sync_states = {}
+
+    @classmethod
+    def from_credentials(cls, credentials: Path, **kwargs) -> "PhenotipsClient":
+        """Create a client from a CSV with username and password columns"""
+        return cls(read_credentials(credentials), **kwargs)
+
+    @property
+    def resolver(self) -> ensembl_resolver.EnsemblResolver:
+        """Shared symbol -> Ensembl ID resolver (local cache first, Ensembl REST API as an optional fallback)"""
+        with self.lock:
+            if self._resolver is None:
+                self._resolver = ensembl_resolver.EnsemblResolver(
+                    self.symbol_cache,
+                    self.symbol_dump,
+                    session=self.session,
+                    live=not self.offline,
+                    ensembl_url=self.ensembl_url,
+                )
+            return self._resolver
+
+    def sync_state(self, project: str) -> SyncState:
+        """Sync state for a project, loaded once and shared by all workers"""
+        with self.lock:
+            if project not in self._sync_states:
+                self._sync_states[project] = SyncState(self.sync_dir / f"{project}.json")
+            return self._sync_states[project]
+
+    def get_sex(self, pid: int) -> str:
+        """Get sex of an individual given Phenotips ID of that individual"""
+        print(f"Querying Phenotips endpoint for participant {pid}")
+        pid_response = self.session.get(
+            f"{self.base_url}/rest/patients/{pid}",
+            auth=self.auth,
+        )
+        sex = None
+        if pid_response.status_code == 200:
+            sex = pid_response.json()["sex"]
+            print(f"Query successful; participant {pid} has sex {sex}")
         else:
-            print(f"No pedigree family information found for {id}; using sample as proband for HPO terms")
-            pid_proband = pid
-        HPO_ids = get_HPO_IDs(pid_proband)
-        print(f"Number of HPO terms for {id}: {len(HPO_ids)}")
-        HPO_df = get_HPO_gene_mapping(HPO_ids)
-        today = date.today()
-        today = today.strftime("%Y-%m-%d")
-        fam = fam.replace("_", "")
-        print(f"Writing HPO file to /hpf/largeprojects/tgnode/sandbox/mcouse_analysis/HPO/{project}/{fam}_HPO_{today}.txt")
-        HPO_df.to_csv(f"/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/HPO/{project}/{fam}_HPO_{today}.txt", sep="\t", index=False)
-    except JSONDecodeError:
-        print(f"Error: did not retrieve HPO and pedigree information for {id}")
-
-parser = argparse.ArgumentParser(description='Process sample sheet and credentials files')
-parser.add_argument('-sample_sheet', help='Tab-separated sample sheet file', required=False)
-parser.add_argument('-credentials', help='Credentials file containing username and password', required=True)
-parser.add_argument('-sample_id', help='Single sample ID to process', required=False)
-parser.add_argument('-project', help='Project ID', required=False, default="DECODER")
-parser.add_argument('-rename', help='Rename sample IDs (True or False)', required=True)
-args = parser.parse_args()
-
-credentials = pd.read_csv(args.credentials) 
-username = credentials["username"][0]
-password = credentials["password"][0]
-auth = (username, password)
-base_url = "https://genomeclinic.ccm.sickkids.ca/"
-pid_url="https://genomeclinic.ccm.sickkids.ca/rest/patients/eid/"
-pedigree_url=f"https://genomeclinic.ccm.sickkids.ca/get/PhenoTips/FamilyPedigreeInterface"
-
-def main():
+            # if any participant is not present in Phenotips, exit with error
+            print(
+                f"Query unsuccessful; participant {pid} is not present in Phenotips"
+            )
+
+        return sex
+
+    def get_sexes(self, pids: list) -> dict:
+        """
+        Get sex for several Phenotips IDs: still one request per member, but issued concurrently over the shared
+        session (at most max_per_host at a time), so a family waits about one round trip per max_per_host members
+        """
+        pids = list(dict.fromkeys(pids))
+        if len(pids) == 1:
+            return {pids[0]: self.get_sex(pids[0])}
+        with ThreadPoolExecutor(max_workers=min(len(pids), self.session.max_per_host)) as pool:
+            return dict(zip(pids, pool.map(self.get_sex, pids)))
+
+    def get_HPO_IDs(self, proband_id: str) -> list:
+        """Query G4RD phenotips to get HPO terms for the proband"""
+        hpo = self.session.get(
+            f"{self.base_url}/rest/patients/{proband_id}/suggested-gene-panels",
+            auth=self.auth,
+        )
+
+        hpo = hpo.json()
+        hpo_id = []
+
+        for row in hpo["rows"]:
+            terms = row["terms"]
+            for term in terms:
+                hpo_id.append(term["id"])
+        
+        hpo_id = list(set(hpo_id))
+
+        return hpo_id
+
+    def fetch_family(self, id: str, fam: str, project: str, rename: bool) -> FamilyResult:
+        """Fetch pedigree and HPO terms for a sample, write the pedigree/HPO files and return what was fetched"""
+        result = FamilyResult(sample_id=id, family=fam, project=project)
+        response = self.session.get(f"{self.pid_url}/{id}", auth=self.auth)
+        try:
+            patient = response.json()
+            pid = patient.get('id')
+            modified = patient.get("last_modification_date") # no modification date: always treated as changed
+            state = self.sync_state(project)
+            state_key = f"{id}|renamed" if rename else id # renamed and original-ID pedigrees are separate files
+            params={"action": "familyinfo", "document_id": pid}
+            response = self.session.get(self.pedigree_url, params=params, auth=self.auth)
+            ped_json = response.json()
+            if "family" in ped_json and "pedigree" in ped_json:
+                # the family document has no modification date, so the pedigree is always refetched (and only rewritten if changed)
+                members, proband_id = get_pedigree_info(ped_json, self.get_sexes)
+                result.members, result.proband_id = members, proband_id
+                result.pedigree_file = write_pedigree(members, fam, project, rename, self.ped_dir)
+                self.registry.register(project, "pedigree", result.pedigree_file)
+                proband = self.session.get(f"{self.pid_url}/{proband_id}", auth=self.auth).json()
+                pid_proband, proband_modified = proband.get('id'), proband.get("last_modification_date")
+            else:
+                print(f"No pedigree family information found for {id}; using sample as proband for HPO terms")
+                pid_proband, proband_modified = pid, modified
+            gene_index = self.gene_index or hpo_index.load_index()
+            closure = (self.closure or hpo_index.load_closure()) if self.expand_descendants else None
+            inputs = {
+                "pid": pid,
+                "hpo_pid": pid_proband,
+                "hpo_modified": proband_modified,
+                "gene_index": hpo_index.source_version(gene_index.fingerprint),
+                "expand_descendants": self.expand_descendants,
+                "max_depth": self.max_depth if closure is not None else None,
+                "closure": hpo_index.source_version(closure.fingerprint) if closure is not None else None,
+            }
+            if proband_modified and not self.full_refresh and state.is_current(state_key, **inputs):
+                print(f"Phenotips record {pid_proband} for {id} unchanged since {proband_modified}; keeping its HPO gene table")
+                previous = state.get(state_key)
+                pedigree = str(result.pedigree_file) if result.pedigree_file else None
+                if previous.get("pedigree") != pedigree:
+                    state.update(state_key, pedigree=pedigree)
+                result.skipped = True
+                result.hpo_ids = previous.get("hpo_terms", [])
+                result.hpo_file = Path(previous["hpo"])
+                if self.cohort_export is not None and previous.get("cohort_hpo_hash") != previous.get("hpo_hash"):
+                    # not in the cohort dataset yet (e.g. first run with the export on): export the table on disk
+                    result.hpo_genes = read_hpo(result.hpo_file)
+                    fetch_date = parse_artefact_name("hpo", result.hpo_file.name)[1]  # the date the table was written
+                    self.cohort_export.append(project, fam.replace("_", ""), id, result.hpo_genes, fetch_date)
+                    state.update(state_key, cohort_hpo_hash=previous.get("hpo_hash"))
+                return result
+            HPO_ids = self.get_HPO_IDs(pid_proband)
+            print(f"Number of HPO terms for {id}: {len(HPO_ids)}")
+            gene_terms = HPO_ids
+            if closure is not None: # also match genes annotated to more specific child terms
+                gene_terms = closure.descendants(HPO_ids, self.max_depth)
+                print(f"Expanded {len(HPO_ids)} HPO term(s) for {id} to {len(gene_terms)} including descendants")
+            HPO_df = get_HPO_gene_mapping(gene_terms, self.resolver, gene_index)
+            hpo_path, hpo_hash = write_hpo(HPO_df, fam, project, state.get(state_key), self.hpo_dir)
+            self.registry.register(project, "hpo", hpo_path, sha256=hpo_hash)
+            state.update(
+                state_key,
+                **inputs,
+                modified=modified,
+                hpo_terms=sorted(HPO_ids),
+                hpo=str(hpo_path),
+                hpo_hash=hpo_hash,
+                pedigree=str(result.pedigree_file) if result.pedigree_file else None,
+            )
+            result.hpo_ids, result.hpo_genes, result.hpo_file = HPO_ids, HPO_df, hpo_path
+            if self.cohort_export is not None:
+                self.cohort_export.append(project, fam.replace("_", ""), id, HPO_df)
+                state.update(state_key, cohort_hpo_hash=hpo_hash)
+        except JSONDecodeError:
+            print(f"Error: did not retrieve HPO and pedigree information for {id}")
+            result.error = "invalid JSON response from Phenotips"
+        return result
+
+    def fetch_families(self, samples: Iterable, project: str, rename: bool, workers: int = 1) -> Iterator[FamilyResult]:
+        """
+        Fetch (sample ID, family) pairs, yielding each FamilyResult as soon as it is ready so callers can
+        start on a family without waiting for the rest. With workers > 1, results arrive in completion order;
+        concurrency is still bounded per host by the session. The first unexpected error is re-raised.
+        """
+        samples = list(samples)
+        if workers <= 1:
+            for id, fam in samples:
+                yield self.fetch_family(id, fam, project, rename)
+            return
+        print(f"Fetching {len(samples)} proband(s) with {workers} workers")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self.fetch_family, id, fam, project, rename) for id, fam in samples]
+            for future in as_completed(futures):
+                yield future.result()
+
+
+def select_probands(sample_ids: Iterable[str], project: str) -> list:
+    """(sample ID, family) pairs for the proband IDs (.03 / -03) in a list of sample sheet IDs"""
+    probands = []
+    for id in sample_ids:
+        print(id)
+        fam = sample_id_to_family_id(id, project)
+        if '.03' in id or id.endswith("-03"): # proband ID
+            probands.append((id, fam))
+    return probands
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description='Process sample sheet and credentials files')
+    parser.add_argument('-sample_sheet', help='Tab-separated sample sheet file', required=False)
+    parser.add_argument('-credentials', help='Credentials file containing username and password', required=True)
+    parser.add_argument('-sample_id', help='Single sample ID to process', required=False)
+    parser.add_argument('-project', help='Project ID', required=False, default="DECODER")
+    parser.add_argument('-rename', help='Rename sample IDs (True or False)', required=True)
+    parser.add_argument('-workers', help='Number of probands to fetch concurrently (default: 1, sequential)', type=int, default=1)
+    parser.add_argument('-max_per_host', help='Maximum in-flight requests per host (default: 4)', type=int, default=4)
+    parser.add_argument('-rate', help='Target request rate in requests/second across all workers (default: 0, unlimited)', type=float, default=0.0)
+    parser.add_argument('-full_refresh', help='Refetch every sample even if its Phenotips record is unchanged since the last sync', action='store_true')
+    parser.add_argument('-cohort_export', help=f'Also append each HPO gene table to the cohort Parquet dataset under {COHORT_DIR}/<project> (needs pyarrow)', action='store_true')
+    parser.add_argument('-expand_descendants', help='Also map genes annotated to descendants of the patient HPO terms (uses the hp.obo closure in hpo_index.py)', action='store_true')
+    parser.add_argument('-max_depth', help='With -expand_descendants, only include descendants at most this many is_a levels below a patient term', type=int, default=None)
+    parser.add_argument('-offline', help='Resolve Ensembl IDs from the local symbol cache only, without querying rest.ensembl.org', action='store_true')
+    parser.add_argument('-symbol_cache', help=f'SQLite Ensembl symbol cache (default: {ensembl_resolver.DEFAULT_CACHE}; an in-memory cache is used if it cannot be written)', type=Path, default=ensembl_resolver.DEFAULT_CACHE)
+    args = parser.parse_args(argv)
+
+    client = PhenotipsClient.from_credentials(
+        args.credentials,
+        max_per_host=args.max_per_host,
+        rate=args.rate,
+        offline=args.offline,
+        symbol_cache=args.symbol_cache,
+        full_refresh=args.full_refresh,
+        cohort_export=CohortHPOExport() if args.cohort_export else None,
+        expand_descendants=args.expand_descendants,
+        max_depth=args.max_depth,
+    )
     rename = args.rename.lower() == "true"
     project = args.project
     if args.sample_sheet:
-        sample_sheet = pd.read_csv(args.sample_sheet, sep="\t")
-        ID_col = "Decoder_ID" if "Decoder_ID" in sample_sheet.columns else "TG_ID"
-        sample_sheet["DECODER_family"] = sample_sheet[ID_col].str.split('.').str[0]
-        for id in sample_sheet[ID_col].values:
-            print(id)
-            fam = sample_id_to_family_id(id, project)
-            if '.03' in id or id.endswith("-03"): # proband ID
-                process_sample(id, fam, auth, pid_url, pedigree_url, project, rename)
+        probands = select_probands(read_sample_ids(args.sample_sheet), project)
+        for _ in client.fetch_families(probands, project, rename, workers=args.workers):
+            pass
     elif args.sample_id: 
         id = args.sample_id
         fam = sample_id_to_family_id(id, project)
-        process_sample(id, fam, auth, pid_url, pedigree_url, project, rename)
+        client.fetch_family(id, fam, project, rename)
     else:
         print("Error: no sample ID or sample sheet provided")
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,324 @@
+"""
+Compiled HPO -> gene lookup index and HPO ontology closure.
+
+genes_to_phenotype.txt and HGNC_ensembl_map.csv are parsed once, deduplicated, category-encoded and
+pickled next to the source files. The pickle is reused until either source file changes (size/mtime),
+so per-proband gene tables become a keyed row lookup plus a join instead of a full file parse.
+
+hp.obo is compiled the same way into an integer-coded ancestor/descendant closure (CSR arrays with the
+is_a distance of every pair), so a patient's terms can be expanded to all descendant terms, optionally
+limited in depth, with a handful of array operations.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import pickle
+import sys
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+
+HPO_DOWNLOAD_DIR = Path("/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/HPO/download")
+GENES_TO_PHENOTYPE = HPO_DOWNLOAD_DIR / "genes_to_phenotype.txt"
+HGNC_ENSEMBL_MAP = HPO_DOWNLOAD_DIR / "HGNC_ensembl_map.csv"
+INDEX_PATH = HPO_DOWNLOAD_DIR / "hpo_gene_index.pkl"
+HPO_OBO = HPO_DOWNLOAD_DIR / "hp.obo"
+CLOSURE_PATH = HPO_DOWNLOAD_DIR / "hp_closure.pkl"
+INDEX_VERSION = 1
+
+_lock = threading.Lock()
+_loaded: dict[Path, object] = {}
+
+
+def _fingerprint(paths: Iterable[Path]) -> tuple:
+    """Identify the source files (and the index format) an index was built from"""
+    stats = []
+    for p in paths:
+        st = p.stat()
+        stats.append((str(p), st.st_size, st.st_mtime_ns))
+    return (INDEX_VERSION, pd.__version__, tuple(stats))
+
+
+def source_version(fingerprint: tuple) -> str:
+    """The source files of an index fingerprint as "path:size:mtime_ns;...", to record what a result was built from"""
+    return ";".join(f"{path}:{size}:{mtime}" for path, size, mtime in fingerprint[2])
+
+
+@dataclass
+class HPOGeneIndex:
+    annotations: pd.DataFrame  # deduplicated gene_symbol, hpo_id, hpo_name rows (categorical), in file order
+    term_rows: dict  # hpo_id -> sorted row positions in annotations
+    hgnc: pd.DataFrame  # deduplicated HGNC symbol -> Ensembl ID map
+    fingerprint: tuple
+
+    def genes_for_terms(self, hpo_ids: Iterable[str]) -> pd.DataFrame:
+        """
+        Genes annotated to any of hpo_ids, one row per gene with the matching HPO IDs and names
+        joined by ", " (same shape as the original groupby over genes_to_phenotype.txt)
+        """
+        hits = [self.term_rows[h] for h in set(hpo_ids) if h in self.term_rows]
+        if hits:
+            rows = np.sort(np.concatenate(hits))
+        else:
+            rows = np.array([], dtype=np.intp)
+        matched = self.annotations.take(rows).astype(str)
+        return matched.groupby("gene_symbol").agg(", ".join).reset_index()
+
+    def with_ensembl(self, hpo_agg: pd.DataFrame) -> pd.DataFrame:
+        """Left-join HGNC Ensembl IDs onto a gene table"""
+        return hpo_agg.merge(self.hgnc, left_on="gene_symbol", right_on="hgnc_symbol", how="left")
+
+
+def build_index(genes_to_phenotype: Path = GENES_TO_PHENOTYPE, hgnc_map: Path = HGNC_ENSEMBL_MAP) -> HPOGeneIndex:
+    """Parse the source files and build an in-memory index"""
+    fingerprint = _fingerprint([genes_to_phenotype, hgnc_map])
+    print(f"Building HPO gene index from {genes_to_phenotype} and {hgnc_map}")
+    annotations = pd.read_csv(genes_to_phenotype, sep="\t", usecols=["gene_symbol", "hpo_id", "hpo_name"], dtype=str)
+    annotations = annotations[["gene_symbol", "hpo_id", "hpo_name"]].drop_duplicates().reset_index(drop=True)
+    annotations = annotations.astype("category")
+    term_rows = {
+        term: np.asarray(rows, dtype=np.intp)
+        for term, rows in annotations.groupby("hpo_id", observed=True).indices.items()
+    }
+    hgnc = pd.read_csv(hgnc_map).drop_duplicates().reset_index(drop=True)
+    return HPOGeneIndex(annotations=annotations, term_rows=term_rows, hgnc=hgnc, fingerprint=fingerprint)
+
+
+@dataclass
+class HPOClosure:
+    terms: np.ndarray  # term code -> HPO ID
+    codes: dict  # HPO ID (including alt_ids and replaced obsolete IDs) -> term code
+    anc_indptr: np.ndarray  # CSR over term codes: ancestors of each term, the term itself included
+    anc_indices: np.ndarray
+    anc_depth: np.ndarray  # is_a distance (0 for the term itself)
+    desc_indptr: np.ndarray  # CSR over term codes: descendants of each term, the term itself included
+    desc_indices: np.ndarray
+    desc_depth: np.ndarray
+    fingerprint: tuple
+
+    def _encode(self, hpo_ids: Iterable[str]) -> np.ndarray:
+        return np.fromiter({self.codes[h] for h in hpo_ids if h in self.codes}, dtype=np.int32)
+
+    def _gather(self, indptr: np.ndarray, indices: np.ndarray, depth: np.ndarray, hpo_ids: Iterable[str], max_depth: Optional[int]) -> list:
+        codes = self._encode(hpo_ids)
+        if not len(codes):
+            return []
+        starts, ends = indptr[codes], indptr[codes + 1]
+        lengths = ends - starts
+        # positions of every closure entry for the requested terms, without a Python loop
+        offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        positions = offsets + np.arange(lengths.sum())
+        members = indices[positions]
+        if max_depth is not None:
+            members = members[depth[positions] <= max_depth]
+        return self.terms[np.unique(members)].tolist()
+
+    def descendants(self, hpo_ids: Iterable[str], max_depth: Optional[int] = None) -> list:
+        """hpo_ids plus every term below them, at most max_depth is_a steps down (None = unlimited)"""
+        return self._gather(self.desc_indptr, self.desc_indices, self.desc_depth, hpo_ids, max_depth)
+
+    def ancestors(self, hpo_ids: Iterable[str], max_depth: Optional[int] = None) -> list:
+        """hpo_ids plus every term above them, at most max_depth is_a steps up (None = unlimited)"""
+        return self._gather(self.anc_indptr, self.anc_indices, self.anc_depth, hpo_ids, max_depth)
+
+
+def read_obo(obo: Path) -> tuple:
+    """
+    Parse [Term] stanzas of an OBO file.
+    Returns (parents: term -> is_a parents, aliases: alt_id or obsolete ID -> current term).
+    """
+    parents: dict[str, list] = {}
+    aliases: dict[str, str] = {}
+
+    def flush(stanza: dict) -> None:
+        term = stanza.get("id")
+        if not term:
+            return
+        if stanza.get("is_obsolete"):
+            if stanza.get("replaced_by"):
+                aliases[term] = stanza["replaced_by"]
+            return
+        parents[term] = stanza.get("is_a", [])
+        for alt in stanza.get("alt_id", []):
+            aliases[alt] = term
+
+    stanza: dict = {}
+    in_term = False
+    with obo.open() as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("["):
+                if in_term:
+                    flush(stanza)
+                in_term = line == "[Term]"
+                stanza = {}
+                continue
+            if not in_term or ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            value = value.split("!", 1)[0].strip()
+            if key in ("is_a", "alt_id") and value:
+                stanza.setdefault(key, []).append(value.split()[0]) # drop trailing {qualifiers}
+            elif key == "is_obsolete":
+                stanza[key] = value == "true"
+            elif key in ("id", "replaced_by"):
+                stanza[key] = value
+    if in_term:
+        flush(stanza)
+    return parents, aliases
+
+
+def _csr(rows: np.ndarray, cols: np.ndarray, depth: np.ndarray, n: int) -> tuple:
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols[order].astype(np.int32), depth[order].astype(np.int16)
+
+
+def build_closure(obo: Path = HPO_OBO) -> HPOClosure:
+    """Compile the is_a closure of an ontology into integer-coded CSR arrays"""
+    fingerprint = _fingerprint([obo])
+    print(f"Building HPO ontology closure from {obo}")
+    parents, aliases = read_obo(obo)
+    terms = np.array(sorted(parents), dtype=object)
+    codes = {term: i for i, term in enumerate(terms)}
+    # ancestors (with minimum distance) of each term, parents before children
+    ancestors: dict[int, dict] = {}
+    pending = {codes[t]: [codes[p] for p in ps if p in codes] for t, ps in parents.items()}
+    children: dict[int, list] = {}
+    for child, ps in pending.items():
+        for parent in ps:
+            children.setdefault(parent, []).append(child)
+    remaining = {t: len(ps) for t, ps in pending.items()}
+    queue = [t for t, k in remaining.items() if k == 0]
+    while queue:
+        term = queue.pop()
+        anc = {term: 0}
+        for parent in pending[term]:
+            for a, d in ancestors[parent].items():
+                if d + 1 < anc.get(a, d + 2):
+                    anc[a] = d + 1
+        ancestors[term] = anc
+        for child in children.get(term, []):
+            remaining[child] -= 1
+            if remaining[child] == 0:
+                queue.append(child)
+    if len(ancestors) != len(terms):
+        raise ValueError(f"{obo} contains an is_a cycle")
+    rows = np.fromiter((t for t, anc in ancestors.items() for _ in anc), dtype=np.int32)
+    cols = np.fromiter((a for anc in ancestors.values() for a in anc), dtype=np.int32)
+    depth = np.fromiter((d for anc in ancestors.values() for d in anc.values()), dtype=np.int16)
+    anc_indptr, anc_indices, anc_depth = _csr(rows, cols, depth, len(terms))
+    desc_indptr, desc_indices, desc_depth = _csr(cols, rows, depth, len(terms))
+    for alias, term in aliases.items():
+        if term in codes and alias not in codes:
+            codes[alias] = codes[term]
+    return HPOClosure(
+        terms=terms,
+        codes=codes,
+        anc_indptr=anc_indptr,
+        anc_indices=anc_indices,
+        anc_depth=anc_depth,
+        desc_indptr=desc_indptr,
+        desc_indices=desc_indices,
+        desc_depth=desc_depth,
+        fingerprint=fingerprint,
+    )
+
+
+def _read_cached(index_path: Path, fingerprint: tuple) -> Optional[object]:
+    try:
+        with index_path.open("rb") as f:
+            index = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Warning: ignoring unreadable HPO index {index_path}: {e}")
+        return None
+    if getattr(index, "fingerprint", None) != fingerprint:
+        print(f"HPO index {index_path} is stale; rebuilding")
+        return None
+    return index
+
+
+def _write_cached(index: object, index_path: Path) -> None:
+    tmp = index_path.with_name(f".{index_path.name}.{os.getpid()}.tmp")
+    try:
+        with tmp.open("wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, index_path)
+        print(f"Wrote HPO index to {index_path}")
+    except OSError as e:
+        # read-only download dir: still usable for this run, just rebuilt next time
+        print(f"Warning: could not write HPO index {index_path}: {e}")
+        if tmp.exists():
+            tmp.unlink()
+
+
+def load_index(
+    genes_to_phenotype: Path = GENES_TO_PHENOTYPE,
+    hgnc_map: Path = HGNC_ENSEMBL_MAP,
+    index_path: Path = INDEX_PATH,
+    rebuild: bool = False,
+) -> HPOGeneIndex:
+    """
+    Return the HPO gene index, loading it at most once per process.
+    The on-disk copy is rebuilt when the source files have changed since it was written.
+    """
+    with _lock:
+        fingerprint = _fingerprint([genes_to_phenotype, hgnc_map])
+        index = _loaded.get(index_path)
+        if index is not None and index.fingerprint == fingerprint and not rebuild:
+            return index
+        index = None if rebuild else _read_cached(index_path, fingerprint)
+        if index is None:
+            index = build_index(genes_to_phenotype, hgnc_map)
+            _write_cached(index, index_path)
+        _loaded[index_path] = index
+        return index
+
+
+def load_closure(obo: Path = HPO_OBO, closure_path: Path = CLOSURE_PATH, rebuild: bool = False) -> HPOClosure:
+    """
+    Return the HPO ontology closure, loading it at most once per process.
+    The on-disk copy is rebuilt when hp.obo has changed since it was written.
+    """
+    with _lock:
+        fingerprint = _fingerprint([obo])
+        closure = _loaded.get(closure_path)
+        if closure is not None and closure.fingerprint == fingerprint and not rebuild:
+            return closure
+        closure = None if rebuild else _read_cached(closure_path, fingerprint)
+        if closure is None:
+            closure = build_closure(obo)
+            _write_cached(closure, closure_path)
+        _loaded[closure_path] = closure
+        return closure
+
+
+def main(argv: list[str]) -> int:
+    ap = argparse.ArgumentParser(description="Build the cached HPO -> gene lookup index.")
+    ap.add_argument("--genes-to-phenotype", type=Path, default=GENES_TO_PHENOTYPE, help="HPO genes_to_phenotype.txt")
+    ap.add_argument("--hgnc-map", type=Path, default=HGNC_ENSEMBL_MAP, help="HGNC symbol -> Ensembl ID CSV")
+    ap.add_argument("--index", type=Path, default=INDEX_PATH, help="Index file to write")
+    ap.add_argument("--obo", type=Path, default=HPO_OBO, help="HPO ontology (hp.obo) for the closure index")
+    ap.add_argument("--closure", type=Path, default=CLOSURE_PATH, help="Closure index file to write")
+    ap.add_argument("--rebuild", action="store_true", help="Rebuild even if the index is up to date")
+    args = ap.parse_args(argv)
+    index = load_index(args.genes_to_phenotype, args.hgnc_map, args.index, rebuild=args.rebuild)
+    if args.obo.exists():
+        closure = load_closure(args.obo, args.closure, rebuild=args.rebuild)
+        print(f"HPO ontology closure: {len(closure.terms)} term(s), {len(closure.anc_indices)} ancestor/descendant pair(s)")
+    print(f"HPO gene index: {len(index.annotations)} annotation(s), {len(index.term_rows)} HPO term(s), {len(index.hgnc)} HGNC row(s)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
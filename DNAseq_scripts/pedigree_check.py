@@ -0,0 +1,54 @@
+"""
+Up-front pedigree validation for the setup scripts: every sample of the analysis sheet must be in its family's
+pedigree before any analysis dir is set up.
+
+Each family's latest pedigree comes from the artefact registry (one indexed lookup, no directory globbing),
+each pedigree is read once, and membership is checked with set differences. All problems are collected, so
+one run reports every missing pedigree and sample together.
+"""
+
+from __future__ import annotations
+
+import logging
+from pathlib import Path
+from typing import Optional
+
+LOG = logging.getLogger("pedigree_check")
+
+
+def read_pedigree_samples(ped: Path) -> set[str]:
+    """Individual IDs (column 2) of a PED file"""
+    samples: set[str] = set()
+    with ped.open() as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split()
+            if len(parts) >= 2:
+                samples.add(parts[1])
+    return samples
+
+
+def pedigree_problems(expected: dict[str, set[str]], pedigrees: dict[str, Optional[Path]]) -> list[str]:
+    """
+    Problems with each family's pedigree (family -> path, None if none was found) against the sample IDs
+    expected in it (family -> IDs): a missing or unreadable pedigree, or samples not in it. Empty if all pass.
+    """
+    problems = []
+    for family, samples in expected.items():
+        ped = pedigrees.get(family)
+        if ped is None:
+            problems.append(f"{family}: no pedigree found")
+            continue
+        try:
+            ped_samples = read_pedigree_samples(ped)
+        except OSError as e:
+            problems.append(f"{family}: cannot read pedigree {ped}: {e}")
+            continue
+        missing = samples - ped_samples
+        if missing:
+            problems.append(f"{family}: sample(s) {', '.join(sorted(missing))} not in pedigree {ped}")
+        else:
+            LOG.debug("Pedigree %s has all %d sample(s) of %s", ped, len(samples), family)
+    return problems
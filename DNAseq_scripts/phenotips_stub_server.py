@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Genome Clinic Phenotips and Ensembl REST endpoints used by
+get_HPO_pedigree_genome_clinic.py, for benchmarking and profiling the metadata fetch without touching
+production servers.
+
+Serves synthetic (or recorded) responses for:
+  GET  /rest/patients/eid/<eid>                       patient record (Phenotips ID, modification date)
+  GET  /rest/patients/<pid>                           patient record (sex)
+  GET  /rest/patients/<pid>/suggested-gene-panels     HPO terms
+  GET  /get/PhenoTips/FamilyPedigreeInterface         family pedigree JSON (action=familyinfo&document_id=<pid>)
+  POST /lookup/symbol/homo_sapiens                    Ensembl symbol lookup
+with configurable latency and error injection.
+
+Synthetic families are named SYN<n> with members SYN<n>.01 (father), .02 (mother), .03 (proband);
+every fifth family has no pedigree and every third father has no sex recorded in the pedigree.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+
+N_TERMS = 500  # synthetic HPO terms HP:0100000 .. HP:0100499
+N_GENES = 2000  # synthetic genes SYNG1 .. SYNG2000
+TERMS_PER_PATIENT = 12
+GENES_PER_TERM = 20
+
+_EID_RE = re.compile(r"^SYN(\d+)\.0(\d)$")
+_PID_RE = re.compile(r"^P(\d+)_(\d)$")
+
+
+def synthetic_term(i: int) -> str:
+    return f"HP:{100000 + i % N_TERMS:07d}"
+
+
+def synthetic_gene(i: int) -> str:
+    return f"SYNG{i % N_GENES + 1}"
+
+
+def synthetic_eid(family: int, member: int) -> str:
+    return f"SYN{family:05d}.0{member}"
+
+
+def write_synthetic_hpo_sources(out_dir: Path) -> tuple:
+    """
+    Write genes_to_phenotype.txt and HGNC_ensembl_map.csv matching the synthetic terms and genes.
+    About 10% of genes are missing from the HGNC map and 5% map to two Ensembl IDs, so the fetcher
+    exercises its Ensembl fallback. Returns (genes_to_phenotype, hgnc_map) paths.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    g2p = out_dir / "genes_to_phenotype.txt"
+    with g2p.open("w") as f:
+        f.write("ncbi_gene_id\tgene_symbol\thpo_id\thpo_name\tfrequency\tdisease_id\n")
+        for t in range(N_TERMS):
+            for k in range(GENES_PER_TERM):
+                g = (t * 7919 + k * 104729) % N_GENES
+                for disease in ("OMIM:1", "ORPHA:2"):
+                    f.write(f"{g + 1}\t{synthetic_gene(g)}\t{synthetic_term(t)}\tSynthetic phenotype {t}\t-\t{disease}\n")
+    hgnc = out_dir / "HGNC_ensembl_map.csv"
+    with hgnc.open("w") as f:
+        f.write("hgnc_symbol,ensembl_gene_id\n")
+        for g in range(N_GENES):
+            if g % 10 == 9:
+                continue
+            f.write(f"{synthetic_gene(g)},ENSG{g + 1:011d}\n")
+            if g % 20 == 3:
+                f.write(f"{synthetic_gene(g)},ENSG{g + 900000:011d}\n")
+    return g2p, hgnc
+
+
+def _pid(family: int, member: int) -> str:
+    return f"P{family}_{member}"
+
+
+def _pedigree(family: int) -> dict:
+    if family % 5 == 0:
+        return {}
+    sexes = {1: "M", 2: "F", 3: "F" if family % 2 else "M"}
+    members = []
+    for m in (1, 2, 3):
+        properties = {"id": _pid(family, m)}
+        if not (m == 1 and family % 3 == 0):
+            properties["sex"] = sexes[m]
+        node = {"id": m, "properties": properties}
+        if m == 3:
+            node["pedigreeProperties"] = {"carrierStatus": "affected"}
+        members.append(node)
+    members.append({"id": 4})  # placeholder node without a Phenotips record
+    return {
+        "family": {"familyMembers": [{"identifier": synthetic_eid(family, m), "id": _pid(family, m)} for m in (1, 2, 3)]},
+        "pedigree": {
+            "proband": 3,
+            "members": members,
+            "relationships": [{"members": [1, 2], "children": [{"id": 3}]}],
+        },
+    }
+
+
+class StubState:
+    """Shared configuration and request counters for the stand-in server"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, recorded: Optional[dict] = None, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.recorded = recorded or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def delay_and_maybe_fail(self) -> bool:
+        """Sleep for the configured latency; return True if this request should fail"""
+        with self.lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if delay:
+            time.sleep(delay)
+        return fail
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real servers
+    state: StubState
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: str, content_type: str = "application/json") -> None:
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, method: str, payload: Optional[dict]) -> tuple:
+        url = urlsplit(self.path)
+        path = re.sub(r"/+", "/", url.path)
+        key = f"{method} {path}" + (f"?{url.query}" if url.query else "")
+        if key in self.state.recorded:
+            return 200, self.state.recorded[key]
+        if method == "POST" and path == "/lookup/symbol/homo_sapiens":
+            found = {}
+            for symbol in (payload or {}).get("symbols", []):
+                m = re.match(r"^SYNG(\d+)$", symbol)
+                if m and int(m.group(1)) % 7:
+                    found[symbol] = {"id": f"ENSG{int(m.group(1)) + 500000:011d}", "display_name": symbol}
+            return 200, found
+        if path == "/get/PhenoTips/FamilyPedigreeInterface":
+            m = _PID_RE.match(parse_qs(url.query).get("document_id", [""])[0])
+            return (200, _pedigree(int(m.group(1)))) if m else (200, {})
+        m = re.match(r"^/rest/patients/eid/(.+)$", path)
+        if m:
+            e = _EID_RE.match(m.group(1))
+            if not e:
+                return 404, None
+            family, member = int(e.group(1)), int(e.group(2))
+            return 200, {"id": _pid(family, member), "external_id": m.group(1), "last_modification_date": f"2024-01-{family % 28 + 1:02d}T00:00:00.000Z"}
+        m = re.match(r"^/rest/patients/([^/]+)/suggested-gene-panels$", path)
+        if m:
+            p = _PID_RE.match(m.group(1))
+            if not p:
+                return 404, None
+            family = int(p.group(1))
+            terms = [{"id": synthetic_term(family * 31 + k * 17)} for k in range(TERMS_PER_PATIENT)]
+            return 200, {"rows": [{"terms": terms[: TERMS_PER_PATIENT // 2]}, {"terms": terms[TERMS_PER_PATIENT // 2 :]}]}
+        m = re.match(r"^/rest/patients/([^/]+)$", path)
+        if m:
+            p = _PID_RE.match(m.group(1))
+            if not p:
+                return 404, None
+            return 200, {"id": m.group(1), "sex": "M" if p.group(2) == "1" else "F"}
+        return 404, None
+
+    def _handle(self, method: str) -> None:
+        payload = None
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            payload = json.loads(self.rfile.read(length))
+        if self.state.delay_and_maybe_fail():
+            self._send(503, "<html><body>Service Unavailable</body></html>", "text/html")
+            return
+        status, body = self._route(method, payload)
+        if body is None:
+            self._send(status, "<html><body>Not Found</body></html>", "text/html")
+        else:
+            self._send(status, json.dumps(body))
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_POST(self) -> None:
+        self._handle("POST")
+
+
+class PhenotipsStub:
+    """Stand-in server running in a background thread; use as a context manager"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, **state_kwargs):
+        self.state = StubState(**state_kwargs)
+        handler = type("BoundStubHandler", (StubHandler,), {"state": self.state})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def client_urls(self) -> dict:
+        """Keyword arguments pointing a PhenotipsClient (and its Ensembl resolver) at this server"""
+        return {
+            "base_url": f"{self.url}/",
+            "pid_url": f"{self.url}/rest/patients/eid/",
+            "pedigree_url": f"{self.url}/get/PhenoTips/FamilyPedigreeInterface",
+        }
+
+    @property
+    def ensembl_url(self) -> str:
+        return f"{self.url}/lookup/symbol/homo_sapiens"
+
+    def __enter__(self) -> "PhenotipsStub":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main(argv: list[str]) -> int:
+    ap = argparse.ArgumentParser(description="Run a local stand-in for the Phenotips and Ensembl REST endpoints.")
+    ap.add_argument("--host", default="127.0.0.1", help="Interface to bind (default: 127.0.0.1)")
+    ap.add_argument("--port", type=int, default=8088, help="Port to listen on (default: 8088)")
+    ap.add_argument("--latency", type=float, default=0.05, help="Mean response latency in seconds (default: 0.05)")
+    ap.add_argument("--jitter", type=float, default=0.0, help="Uniform +/- latency jitter in seconds (default: 0)")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503 (default: 0)")
+    ap.add_argument("--recorded", type=Path, default=None, help='JSON file of recorded responses keyed by "METHOD /path?query"')
+    args = ap.parse_args(argv)
+
+    recorded = json.loads(args.recorded.read_text()) if args.recorded else None
+    with PhenotipsStub(args.host, args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, recorded=recorded) as stub:
+        print(f"Phenotips/Ensembl stand-in listening on {stub.url} (Ctrl-C to stop)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
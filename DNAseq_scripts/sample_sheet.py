@@ -0,0 +1,74 @@
+"""
+Lightweight sample sheet and credentials readers (stdlib csv only).
+
+Used by the setup scripts, cleanup.py and get_HPO_pedigree_genome_clinic.py so reading a small TSV does not
+pay for importing pandas. Header names and values are stripped of whitespace and stray carriage returns
+(sheets exported from Excel on Windows), and missing columns are reported by name up front.
+"""
+
+from __future__ import annotations
+
+import csv
+from pathlib import Path
+from typing import Iterable
+
+# the sample ID column is Decoder_ID in DECODER sheets and TG_ID in the newer multi-project sheets
+SAMPLE_ID_COLUMNS = ("Decoder_ID", "TG_ID")
+
+
+class SampleSheetError(ValueError):
+    pass
+
+
+def _clean(value: str, strip: bool = True) -> str:
+    value = (value or "").replace("\r", "")
+    return value.strip() if strip else value
+
+
+def read_sheet(path: Path, required: Iterable[str] = (), delimiter: str = "\t", strip: bool = True) -> list[dict[str, str]]:
+    """
+    Rows of a delimited sheet as dicts keyed by header, with cleaned header names and values (values keep
+    surrounding whitespace if strip is False). Raises SampleSheetError if any of the required columns is
+    missing. Blank lines are skipped.
+    """
+    path = Path(path)
+    with path.open(newline="") as f:
+        rdr = csv.reader(f, delimiter=delimiter)
+        header = [_clean(h) for h in next(rdr, [])]
+        missing = [c for c in required if c not in header]
+        if missing:
+            raise SampleSheetError(f"{path}: missing column(s) {', '.join(missing)} (found: {', '.join(header) or 'no header'})")
+        rows = []
+        for parts in rdr:
+            parts = [_clean(p, strip) for p in parts]
+            if not any(p.strip() for p in parts):
+                continue
+            parts += [""] * (len(header) - len(parts))
+            rows.append(dict(zip(header, parts)))
+    return rows
+
+
+def sample_id_column(columns: Iterable[str]) -> str:
+    """Name of the sample ID column (Decoder_ID or TG_ID) among columns"""
+    columns = list(columns)
+    for name in SAMPLE_ID_COLUMNS:
+        if name in columns:
+            return name
+    raise SampleSheetError(f"No sample ID column ({' or '.join(SAMPLE_ID_COLUMNS)}) in sheet columns: {', '.join(columns)}")
+
+
+def read_sample_ids(path: Path) -> list[str]:
+    """Sample IDs (Decoder_ID or TG_ID column) of a sample sheet, in sheet order"""
+    rows = read_sheet(path)
+    if not rows:
+        return []
+    id_col = sample_id_column(rows[0])
+    return [r[id_col] for r in rows if r[id_col]]
+
+
+def read_credentials(path: Path) -> tuple[str, str]:
+    """(username, password) from the first row of a CSV with username and password columns"""
+    rows = read_sheet(path, required=("username", "password"), delimiter=",", strip=False)
+    if not rows:
+        raise SampleSheetError(f"{path}: no credentials row")
+    return rows[0]["username"], rows[0]["password"]
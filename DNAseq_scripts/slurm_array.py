@@ -0,0 +1,105 @@
+"""
+Submit many prepared family analysis directories as one Slurm job array.
+
+Instead of one `sbatch <jobscript>` per family, a manifest of family directories is written and a single
+`sbatch --array=1-N[%M]` job is submitted; array task i changes into the i-th directory of the manifest
+and runs that family's job script. The #SBATCH resource directives of the first family's job script are
+carried over to the array job, and each family directory gets a slurm_array_job.txt recording its
+<array job id>_<task index>.
+"""
+
+from __future__ import annotations
+
+import datetime as _dt
+import logging
+import shlex
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+LOG = logging.getLogger("slurm_array")
+
+JOB_ID_FILE = "slurm_array_job.txt"
+# set per array task by submit_array; ignored when copied from a family job script
+_OVERRIDDEN_DIRECTIVES = ("--array", "-a", "--output", "-o", "--error", "-e", "--chdir", "-D", "--job-name", "-J")
+
+
+def sbatch_directives(jobscript: Path) -> list[str]:
+    """#SBATCH lines of jobscript (resources, partition, ...), minus the ones the array job sets itself"""
+    directives = []
+    for line in jobscript.read_text().splitlines():
+        line = line.strip()
+        if not line.startswith("#SBATCH"):
+            if line and not line.startswith("#"):
+                break  # sbatch stops reading directives at the first command
+            continue
+        args = line[len("#SBATCH"):].split()
+        option = args[0].split("=", 1)[0] if args else ""
+        if option and option not in _OVERRIDDEN_DIRECTIVES:
+            directives.append(line)
+    return directives
+
+
+def write_manifest(family_dirs: list[Path], manifest: Path) -> None:
+    """One line per array task: <task index>\\t<family dir>"""
+    manifest.parent.mkdir(parents=True, exist_ok=True)
+    with manifest.open("w") as out:
+        for i, family_dir in enumerate(family_dirs, start=1):
+            out.write(f"{i}\t{family_dir}\n")
+
+
+def write_array_script(manifest: Path, jobscript_name: str, directives: list[str], path: Path) -> None:
+    lines = ["#!/bin/bash"] + directives + [
+        "set -euo pipefail",
+        f"family_dir=$(awk -F '\\t' -v i=\"$SLURM_ARRAY_TASK_ID\" '$1 == i {{print $2}}' {shlex.quote(str(manifest))})",
+        'cd "$family_dir"',
+        'export SLURM_SUBMIT_DIR="$family_dir"',  # as if the job script had been submitted from there
+        f"exec bash {shlex.quote(jobscript_name)}",
+    ]
+    path.write_text("\n".join(lines) + "\n")
+
+
+def submit_array(
+    family_dirs: list[Path],
+    jobscript_name: str,
+    *,
+    work_dir: Path,
+    job_name: str,
+    max_running: Optional[int] = None,
+) -> Optional[str]:
+    """
+    Submit jobscript_name in each of family_dirs as one Slurm job array and return the array job id.
+    The manifest, array script and task logs are written under work_dir/slurm_array/.
+    """
+    if not family_dirs:
+        LOG.info("No family directories to submit")
+        return None
+    stamp = _dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+    array_dir = work_dir / "slurm_array"
+    log_dir = array_dir / "logs"
+    log_dir.mkdir(parents=True, exist_ok=True)
+    manifest = array_dir / f"{job_name}_{stamp}.manifest.tsv"
+    script = array_dir / f"{job_name}_{stamp}.sh"
+    write_manifest(family_dirs, manifest)
+    write_array_script(manifest, jobscript_name, sbatch_directives(family_dirs[0] / jobscript_name), script)
+
+    array = f"1-{len(family_dirs)}" + (f"%{max_running}" if max_running else "")
+    cmd = [
+        "sbatch",
+        "--parsable",
+        f"--array={array}",
+        f"--job-name={job_name}",
+        f"--output={log_dir}/%x_%A_%a.out",
+        str(script),
+    ]
+    LOG.info("Submitting %d family(ies) as one Slurm job array: %s", len(family_dirs), " ".join(cmd))
+    try:
+        result = subprocess.run(cmd, cwd=str(array_dir), check=True, text=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        LOG.error("sbatch failed (exit %s): %s", e.returncode, (e.stderr or "").strip())
+        raise
+    job_id = result.stdout.strip().split(";", 1)[0]  # --parsable prints <job id>[;<cluster>]
+    for i, family_dir in enumerate(family_dirs, start=1):
+        (family_dir / JOB_ID_FILE).write_text(f"{job_id}_{i}\n")
+    LOG.info("Submitted array job %s (manifest %s)", job_id, manifest)
+    return job_id
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Startup-time benchmark for the setup CLIs.
+
+For each script, runs `python -X importtime -c "import <module>"` in a fresh interpreter and reports the
+total import time and the heaviest direct imports, then times `python <script> --help` wall-clock (median of
+several runs). Use it to check that heavy dependencies (pandas, numpy, requests) stay out of the startup path.
+"""
+
+from __future__ import annotations
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+DEFAULT_SCRIPTS = ["DRAGEN_setup.py", "PacBio_setup.py", "get_HPO_pedigree_genome_clinic.py"]
+
+
+def import_times(module: str, python: str = sys.executable) -> list[tuple]:
+    """(cumulative_us, self_us, depth, name) for every import made by `import module`"""
+    cp = subprocess.run(
+        [python, "-X", "importtime", "-c", f"import {module}"],
+        cwd=str(HERE),
+        capture_output=True,
+        text=True,
+    )
+    if cp.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{cp.stderr.strip().splitlines()[-1] if cp.stderr else ''}")
+    rows = []
+    for line in cp.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((int(cumulative_us), int(self_us), depth, name.strip()))
+    return rows
+
+
+def help_wall_time(script: str, runs: int, python: str = sys.executable) -> float:
+    """Median wall-clock seconds of `python script --help`"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([python, script, "--help"], cwd=str(HERE), capture_output=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main(argv: list[str]) -> int:
+    ap = argparse.ArgumentParser(description="Report import/startup time of the setup CLIs.")
+    ap.add_argument("scripts", nargs="*", default=DEFAULT_SCRIPTS, help=f"Scripts to measure (default: {' '.join(DEFAULT_SCRIPTS)})")
+    ap.add_argument("--top", type=int, default=8, help="Number of heaviest direct imports to list (default: 8)")
+    ap.add_argument("--runs", type=int, default=5, help="Runs of <script> --help to take the median of (default: 5)")
+    args = ap.parse_args(argv)
+
+    for script in args.scripts:
+        module = Path(script).stem
+        try:
+            rows = import_times(module)
+        except RuntimeError as e:
+            print(f"{script}: {e}")
+            continue
+        total = next((cum for cum, _, depth, name in rows if depth == 0 and name == module), 0)
+        print(f"{script}: import {total / 1000:.1f} ms, --help {help_wall_time(script, args.runs) * 1000:.0f} ms (median of {args.runs})")
+        direct = sorted((r for r in rows if r[2] == 1), reverse=True)[: args.top]
+        for cum, _, _, name in direct:
+            print(f"  {cum / 1000:8.1f} ms  {name}")
+        heavy = sorted({name.split(".")[0] for _, _, _, name in rows} & {"pandas", "numpy", "requests", "pyarrow"})
+        print(f"  heavy packages imported: {', '.join(heavy) or 'none'}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
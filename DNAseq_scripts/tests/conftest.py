@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the scripts are flat modules in DNAseq_scripts/, imported by name as the setup scripts do
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,228 @@
+"""
+Round trips of bgzf_reheader.reheader_samples over small synthetic VCFs with controlled BGZF block layouts:
+the output must decompress to the input with only the #CHROM sample names changed, and every virtual offset
+in a .tbi/.csi index next to it must point at the same record in the output as it did in the input.
+"""
+
+import bisect
+import gzip
+import shutil
+import struct
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from bgzf_reheader import BGZF_EOF, BLOCK_DATA_SIZE, BGZFError, _read_block, compress_block, reheader_samples
+
+MAPPING = {"S1": "GD001_03", "S2": "GD001_01"}
+TBI_PSEUDO_BIN = CSI_PSEUDO_BIN = 37450  # CSI with depth 5, as htslib writes it
+LEAF_BIN = 4681
+
+
+def make_header(n_contigs: int = 3) -> bytes:
+    lines = [b"##fileformat=VCFv4.2"]
+    lines += [b"##contig=<ID=chr%d,length=248956422>" % i for i in range(1, n_contigs + 1)]
+    lines.append(b'##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">')
+    lines.append(b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2")
+    return b"\n".join(lines) + b"\n"
+
+
+def make_records(n: int) -> bytes:
+    return b"".join(b"chr1\t%d\t.\tA\tG\t50\tPASS\t.\tGT\t0/1\t1/1\n" % (1000 + 10 * i) for i in range(n))
+
+
+def renamed(data: bytes) -> bytes:
+    lines = data.split(b"\n")
+    for i, line in enumerate(lines):
+        if line.startswith(b"#CHROM"):
+            cols = line.split(b"\t")
+            lines[i] = b"\t".join(cols[:9] + [MAPPING.get(c.decode(), c.decode()).encode() for c in cols[9:]])
+    return b"\n".join(lines)
+
+
+def split(data: bytes, size: int) -> list:
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def write_bgzf(path: Path, chunks: list) -> None:
+    """One BGZF block per chunk, then the EOF block"""
+    path.write_bytes(b"".join(compress_block(c) for c in chunks) + BGZF_EOF)
+
+
+def read_blocks(path: Path) -> tuple:
+    """(decompressed data, compressed offset of each block, where each block's data starts in data)"""
+    data, offsets, starts = b"", [], []
+    offset = 0
+    with path.open("rb") as f:
+        while True:
+            block = _read_block(f)
+            if block is None:
+                return data, offsets, starts
+            offsets.append(offset)
+            starts.append(len(data))
+            offset += block[0]
+            data += block[1]
+
+
+def read_line_at(path: Path, voffset: int) -> bytes:
+    data, offsets, starts = read_blocks(path)
+    pos = starts[offsets.index(voffset >> 16)] + (voffset & 0xFFFF)
+    return data[pos : data.find(b"\n", pos) + 1] if pos < len(data) else b""
+
+
+def record_voffsets(path: Path) -> list:
+    """Virtual offset of every record's first byte, then of the end of the data (as htslib records them)"""
+    data, offsets, starts = read_blocks(path)
+    header_end = data.index(b"\n", data.index(b"#CHROM")) + 1
+    positions = [header_end]
+    while positions[-1] < len(data):
+        positions.append(data.index(b"\n", positions[-1]) + 1)
+
+    def voffset(pos: int) -> int:
+        i = bisect.bisect_right(starts, pos) - 1
+        return offsets[i] << 16 | (pos - starts[i])
+
+    return [voffset(p) for p in positions]
+
+
+def make_tbi(voffsets: list) -> bytes:
+    """Tabix index with a chunk per record, a linear index entry per other record, and the pseudo-bin"""
+    names = b"chr1\0"
+    out = b"TBI\1" + struct.pack("<i6i", 1, 2, 1, 2, 0, ord("#"), 0) + struct.pack("<i", len(names)) + names
+    chunks = list(zip(voffsets, voffsets[1:]))
+    out += struct.pack("<i", 2)
+    out += struct.pack("<Ii", LEAF_BIN, len(chunks)) + b"".join(struct.pack("<QQ", *c) for c in chunks)
+    out += struct.pack("<Ii", TBI_PSEUDO_BIN, 2) + struct.pack("<QQQQ", voffsets[0], voffsets[-1], len(chunks), 0)
+    linear = voffsets[:-1:2]
+    out += struct.pack("<i", len(linear)) + b"".join(struct.pack("<Q", v) for v in linear)
+    return out + struct.pack("<Q", 0)
+
+
+def make_csi(voffsets: list) -> bytes:
+    """CSI index (min_shift 14, depth 5) with the same chunks as make_tbi and a loffset per bin"""
+    aux = b"aux!"
+    out = b"CSI\1" + struct.pack("<iii", 14, 5, len(aux)) + aux + struct.pack("<i", 1)
+    chunks = list(zip(voffsets, voffsets[1:]))
+    out += struct.pack("<i", 2)
+    out += struct.pack("<IQi", LEAF_BIN, voffsets[0], len(chunks)) + b"".join(struct.pack("<QQ", *c) for c in chunks)
+    out += struct.pack("<IQi", CSI_PSEUDO_BIN, 0, 2) + struct.pack("<QQQQ", voffsets[0], voffsets[-1], len(chunks), 0)
+    return out + struct.pack("<Q", 0)
+
+
+def write_index(path: Path, index: bytes) -> None:
+    path.write_bytes(b"".join(compress_block(c) for c in split(index, BLOCK_DATA_SIZE)) + BGZF_EOF)
+
+
+LAYOUTS = {
+    # header and the first records share a block, as `bgzip` writes a small VCF
+    "header_mid_block": lambda h, r: split(h + r, BLOCK_DATA_SIZE),
+    # header in a block of its own, as htslib writers (bcftools view -Oz) do
+    "header_own_block": lambda h, r: [h] + split(r, BLOCK_DATA_SIZE),
+    # small blocks: records straddle blocks, several records share the header's last block
+    "small_blocks": lambda h, r: split(h + r, 700),
+    # header spanning several blocks, with records in its last block and many record blocks after it
+    "multi_block_header": lambda h, r: split(h + r, BLOCK_DATA_SIZE),
+}
+
+
+def layout_input(tmp_path: Path, name: str) -> tuple:
+    header = make_header(4000 if name == "multi_block_header" else 3)
+    records = make_records(6000 if name == "multi_block_header" else 300)
+    vcf = tmp_path / "in.vcf.gz"
+    write_bgzf(vcf, LAYOUTS[name](header, records))
+    return vcf, header + records
+
+
+@pytest.mark.parametrize("layout", sorted(LAYOUTS))
+def test_round_trip_renames_only_the_samples(tmp_path, layout):
+    vcf, data = layout_input(tmp_path, layout)
+    out = reheader_samples(vcf, MAPPING, tmp_path / "out.vcf.gz")
+    assert gzip.decompress(out.read_bytes()) == renamed(data)
+    assert out.read_bytes().endswith(BGZF_EOF)
+    assert read_blocks(out)[0] == renamed(data)  # every block is a valid BGZF block
+    if layout == "multi_block_header":
+        assert len(read_blocks(vcf)[1]) > 3
+
+
+def test_in_place_rewrite(tmp_path):
+    vcf, data = layout_input(tmp_path, "header_mid_block")
+    reheader_samples(vcf, MAPPING)
+    assert gzip.decompress(vcf.read_bytes()) == renamed(data)
+    assert [p.name for p in tmp_path.iterdir()] == ["in.vcf.gz"]  # no temporary files left behind
+
+
+def test_header_only_vcf(tmp_path):
+    vcf = tmp_path / "in.vcf.gz"
+    write_bgzf(vcf, [make_header()])
+    out = reheader_samples(vcf, MAPPING, tmp_path / "out.vcf.gz")
+    assert gzip.decompress(out.read_bytes()) == renamed(make_header())
+    assert out.read_bytes().endswith(BGZF_EOF)
+
+
+def test_unmapped_samples_keep_their_names(tmp_path):
+    vcf, data = layout_input(tmp_path, "header_own_block")
+    out = reheader_samples(vcf, {"S2": "GD001_01"}, tmp_path / "out.vcf.gz")
+    assert b"\tS1\tGD001_01\n" in gzip.decompress(out.read_bytes())
+
+
+@pytest.mark.parametrize("suffix, make_index", [(".tbi", make_tbi), (".csi", make_csi)])
+@pytest.mark.parametrize("layout", sorted(LAYOUTS))
+def test_index_offsets_follow_the_records(tmp_path, layout, suffix, make_index):
+    vcf, _ = layout_input(tmp_path, layout)
+    old_voffsets = record_voffsets(vcf)
+    write_index(vcf.with_name(vcf.name + suffix), make_index(old_voffsets))
+    out = reheader_samples(vcf, MAPPING, tmp_path / "out.vcf.gz")
+
+    index = out.with_name(out.name + suffix)
+    assert index.read_bytes().endswith(BGZF_EOF)
+    new_voffsets = record_voffsets(out)
+    # every offset in the index (chunks, linear index, loffsets, pseudo-bin) shifted to the same records
+    assert gzip.decompress(index.read_bytes()) == make_index(new_voffsets)
+    for old, new in zip(old_voffsets, new_voffsets):
+        assert read_line_at(vcf, old) == read_line_at(out, new)
+
+
+def test_not_bgzf_is_refused(tmp_path):
+    vcf = tmp_path / "in.vcf.gz"
+    vcf.write_bytes(gzip.compress(make_header() + make_records(3)))
+    with pytest.raises(BGZFError):
+        reheader_samples(vcf, MAPPING, tmp_path / "out.vcf.gz")
+    assert not (tmp_path / "out.vcf.gz").exists()
+
+
+needs_bcftools = pytest.mark.skipif(
+    shutil.which("bcftools") is None or shutil.which("tabix") is None, reason="needs bcftools and tabix"
+)
+
+
+def _run(*cmd) -> bytes:
+    return subprocess.run([str(c) for c in cmd], check=True, stdout=subprocess.PIPE).stdout
+
+
+@needs_bcftools
+@pytest.mark.parametrize("layout", sorted(LAYOUTS))
+def test_matches_bcftools_reheader(tmp_path, layout):
+    vcf, _ = layout_input(tmp_path, layout)
+    names = tmp_path / "names.txt"
+    names.write_text("".join(f"{old} {new}\n" for old, new in MAPPING.items()))
+    _run("bcftools", "reheader", "-s", names, "-o", tmp_path / "bcftools.vcf.gz", vcf)
+    out = reheader_samples(vcf, MAPPING, tmp_path / "out.vcf.gz")
+    assert gzip.decompress(out.read_bytes()) == gzip.decompress((tmp_path / "bcftools.vcf.gz").read_bytes())
+    assert _run("bcftools", "view", out) == _run("bcftools", "view", tmp_path / "bcftools.vcf.gz")
+
+
+@needs_bcftools
+@pytest.mark.parametrize("csi", [False, True])
+@pytest.mark.parametrize("layout", sorted(LAYOUTS))
+def test_shifted_htslib_index_answers_region_queries(tmp_path, layout, csi):
+    vcf, _ = layout_input(tmp_path, layout)
+    _run("tabix", "-p", "vcf", *(["-C"] if csi else []), vcf)
+    out = reheader_samples(vcf, MAPPING, tmp_path / "out.vcf.gz")
+    rebuilt = tmp_path / "rebuilt.vcf.gz"
+    shutil.copyfile(out, rebuilt)
+    _run("tabix", "-p", "vcf", *(["-C"] if csi else []), rebuilt)
+    for region in ("chr1", "chr1:1000-1000", "chr1:1500-2500", "chr1:3000-70000", "chr1:60000-61000"):
+        expected = _run("tabix", vcf, region)
+        assert _run("tabix", out, region) == expected
+        assert _run("tabix", rebuilt, region) == expected
@@ -0,0 +1,148 @@
+"""
+In-process VCF header reader, instead of spawning `bcftools query -l` / `bcftools view -h` per file.
+
+Only the leading BGZF blocks holding the header are decompressed (bgzf_reheader.read_header); plain gzip and
+uncompressed VCFs are read line by line up to the #CHROM line. Parsed headers are cached per path and reused
+while the file keeps the size and mtime it had when it was read.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import os
+import re
+import sys
+import threading
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+from bgzf_reheader import VCF_FIXED_COLUMNS, BGZFError, read_header
+
+GZIP_MAGIC = b"\x1f\x8b"
+_ID = re.compile(r"[<,]ID=([^,>]+)")
+_LENGTH = re.compile(r"[<,]length=(\d+)")
+
+_cache: dict[str, tuple[int, int, "VCFHeader"]] = {}
+_cache_lock = threading.Lock()
+
+
+class VCFHeaderError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class VCFHeader:
+    samples: tuple[str, ...]
+    contigs: dict[str, Optional[int]] = field(default_factory=dict)  # name -> length (None if not given)
+    fields: dict[str, list[str]] = field(default_factory=dict)  # INFO/FORMAT/FILTER/ALT -> IDs, in header order
+    meta: dict[str, str] = field(default_factory=dict)  # other ##key=value lines (fileformat, source, ...), last wins
+
+    @property
+    def joint(self) -> bool:
+        return len(self.samples) > 1
+
+
+def parse_header(text: str) -> VCFHeader:
+    """VCFHeader from the header lines of a VCF (## lines and the #CHROM line)"""
+    samples: Optional[tuple[str, ...]] = None
+    contigs: dict[str, Optional[int]] = {}
+    fields: dict[str, list[str]] = {}
+    meta: dict[str, str] = {}
+    for line in text.splitlines():
+        if line.startswith("#CHROM"):
+            samples = tuple(line.rstrip("\r").split("\t")[VCF_FIXED_COLUMNS:])
+            break
+        if not line.startswith("##") or "=" not in line:
+            continue
+        key, value = line[2:].split("=", 1)
+        if not value.startswith("<"):
+            meta[key] = value.rstrip("\r")
+            continue
+        m = _ID.search(value)
+        if m is None:
+            continue
+        if key == "contig":
+            length = _LENGTH.search(value)
+            contigs[m.group(1)] = int(length.group(1)) if length else None
+        else:
+            fields.setdefault(key, []).append(m.group(1))
+    if samples is None:
+        raise VCFHeaderError("no #CHROM line in VCF header")
+    return VCFHeader(samples, contigs, fields, meta)
+
+
+def _read_text_header(f) -> str:
+    lines = []
+    for line in f:
+        if not line.startswith("#"):
+            break
+        lines.append(line)
+        if line.startswith("#CHROM"):
+            break
+    return "".join(lines)
+
+
+def _read(path: Path) -> VCFHeader:
+    with path.open("rb") as f:
+        magic = f.read(2)
+        f.seek(0)
+        if magic != GZIP_MAGIC:
+            with path.open(encoding="utf-8", errors="replace") as t:
+                return parse_header(_read_text_header(t))
+        try:
+            data, header_len, _, _, _ = read_header(f)
+        except BGZFError:
+            pass
+        else:
+            return parse_header(data[:header_len].decode("utf-8", errors="replace"))
+    with gzip.open(path, "rt", encoding="utf-8", errors="replace") as g:
+        return parse_header(_read_text_header(g))
+
+
+def read_vcf_header(path: Path) -> VCFHeader:
+    """Header of a VCF (.vcf.gz or .vcf), cached while the file's size and mtime are unchanged"""
+    path = Path(path)
+    st = path.stat()
+    key = os.path.abspath(path)
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+        return cached[2]
+    try:
+        header = _read(path)
+    except FileNotFoundError:
+        raise
+    except VCFHeaderError as e:
+        raise VCFHeaderError(f"{path}: {e}") from None
+    except (BGZFError, EOFError, OSError, zlib.error) as e:
+        raise VCFHeaderError(f"cannot read VCF header of {path}: {e}") from e
+    with _cache_lock:
+        _cache[key] = (st.st_size, st.st_mtime_ns, header)
+    return header
+
+
+def read_vcf_samples(path: Path) -> list[str]:
+    return list(read_vcf_header(path).samples)
+
+
+def main(argv: list[str]) -> int:
+    ap = argparse.ArgumentParser(description="Print the samples (as bcftools query -l) or contigs of VCFs from their headers.")
+    ap.add_argument("vcfs", nargs="+", type=Path, help="VCFs (.vcf.gz or .vcf)")
+    ap.add_argument("--contigs", action="store_true", help="Print contig names and lengths instead of samples")
+    args = ap.parse_args(argv)
+
+    for vcf in args.vcfs:
+        header = read_vcf_header(vcf)
+        if args.contigs:
+            for name, length in header.contigs.items():
+                print(f"{name}\t{length if length is not None else '.'}")
+        else:
+            print("\n".join(header.samples))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,67 @@
+"""
+Content-addressed cache of sample-renamed VCFs for PacBio_setup.py.
+
+The joint VCFs in files_from_irods are shared by every analysis of a family, so they are never rewritten in
+place. A renamed copy is written under the staging dir instead, at <key[:2]>/<key>/<original name>, where the
+key is derived from the source VCF's MD5 and the sample rename mapping, and units.tsv points at that copy.
+A re-run, a new analysis date or another family sharing the same VCF and names reuses the staged copy, and
+a changed download gets a new key. Source MD5s come from the checksums cache, so each download is hashed once.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+
+from checksums import ChecksumCache, compute_digests
+
+LOG = logging.getLogger("vcf_staging")
+
+DEFAULT_STAGING_DIR = Path("/hpf/largeprojects/tgnode/sandbox/mcouse_analysis/staged_vcfs")
+
+
+def staging_key(md5: str, mapping: dict[str, str]) -> str:
+    return hashlib.sha256(json.dumps({"md5": md5, "rename": sorted(mapping.items())}).encode()).hexdigest()
+
+
+class StagingCache:
+    """
+    Renamed VCFs keyed by (source MD5, rename mapping). Safe to share between threads.
+    """
+
+    def __init__(self, root: Path = DEFAULT_STAGING_DIR, checksum_cache: Optional[Path] = None):
+        self.root = root
+        self.checksum_cache = checksum_cache
+        self.lock = threading.Lock()
+        self._checksums: Optional[ChecksumCache] = None
+
+    def _md5(self, src: Path) -> str:
+        with self.lock:
+            if self._checksums is None:
+                self._checksums = ChecksumCache(self.checksum_cache) if self.checksum_cache else ChecksumCache()
+        md5 = compute_digests([src], cache=self._checksums, workers=1).get(src, {}).get("md5")
+        if md5 is None:
+            raise FileNotFoundError(f"Cannot read {src}")
+        return md5
+
+    def staged_path(self, src: Path, mapping: dict[str, str]) -> Path:
+        key = staging_key(self._md5(src), mapping)
+        return self.root / key[:2] / key / src.name
+
+    def stage(self, src: Path, mapping: dict[str, str], rewrite: Callable[[Path, Path], None]) -> Path:
+        """
+        Path of src with samples renamed by mapping, calling rewrite(src, dest) to create it unless an
+        identical copy is already staged. rewrite must create dest atomically (index files before or after).
+        """
+        dest = self.staged_path(src, mapping)
+        if dest.exists():
+            LOG.info("Reusing staged VCF %s for %s", dest, src)
+            return dest
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        LOG.info("Staging renamed copy of %s at %s", src, dest)
+        rewrite(src, dest)
+        return dest